@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/archive.py - Append-only segmented archive of realtime snapshots
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .delta import DELTA, KEYFRAME, DeltaDecoder, DeltaEncoder
+from .snapshot import header_timestamp
+from bisect import bisect_right
+from datetime import datetime
+from os import listdir, makedirs
+from os.path import exists, join, splitext
+from struct import Struct
+from threading import Lock
+from time import time
+from zlib import compress, decompress
+
+# Default maximum size of a segment, in bytes.
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# Default length of time covered by a segment, in seconds.
+DEFAULT_SEGMENT_PERIOD = 3600
+
+SEGMENT_EXT = '.seg'
+INDEX_EXT = '.idx'
+DELTA_INDEX_EXT = '.didx'
+
+# Index entry: header timestamp, offset in segment, compressed length.
+INDEX_ENTRY = Struct('<QQI')
+
+# Index entry for delta-coded segments: as above, then the kind of record
+# (``monorail.delta.KEYFRAME`` or ``DELTA``).
+DELTA_INDEX_ENTRY = Struct('<QQIB')
+
+
+def _segment_period(timestamp, period):
+  """
+  Gets the name prefix for the segment period containing ``timestamp``.
+  """
+  start = int(timestamp) - (int(timestamp) % period)
+  return datetime.utcfromtimestamp(start).strftime('%Y%m%d%H%M%S')
+
+
+def read_index(path):
+  """
+  Reads a segment index.
+
+  Returns a list of (timestamp, offset, length, kind) tuples, in the order
+  they were written.  ``kind`` is always ``KEYFRAME`` for segments which
+  aren't delta-coded.  A partially written entry at the end of the file is
+  ignored.
+  """
+  with open(path, 'rb') as f:
+    data = f.read()
+
+  if path.endswith(DELTA_INDEX_EXT):
+    count = len(data) // DELTA_INDEX_ENTRY.size
+    return [DELTA_INDEX_ENTRY.unpack_from(data, i * DELTA_INDEX_ENTRY.size) for i in range(count)]
+
+  count = len(data) // INDEX_ENTRY.size
+  return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) + (KEYFRAME,) for i in range(count)]
+
+
+class SegmentArchive(object):
+  def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE,
+               segment_period=DEFAULT_SEGMENT_PERIOD, level=6, keyframe_interval=None):
+    """
+    Archive which stores every snapshot of each feed, appended to a few large
+    compressed segment files rather than many small files.
+
+    Each feed has its own directory, with a new segment started every
+    ``segment_period`` seconds, or when a segment grows past
+    ``segment_size`` bytes.  Every snapshot is compressed on its own, so that
+    it can be read back with a single seek.
+
+    Next to each segment (``.seg``) is an index (``.idx``) of fixed-size
+    entries, giving the header timestamp, offset and length of each snapshot.
+
+    If ``keyframe_interval`` is given, snapshots are delta-coded with
+    ``monorail.delta.DeltaEncoder``: only entities which changed since the
+    last snapshot are stored, with a whole snapshot (keyframe) at the start
+    of each segment and every ``keyframe_interval`` snapshots.  These
+    segments have a ``.didx`` index, which also records the kind of each
+    record.  Snapshots are rebuilt exactly when read back.
+
+    :param path: Directory to store the archive in.
+    :param segment_size: Size of a segment before starting a new one, in bytes.
+    :param segment_period: Number of seconds covered by each segment.
+    :param level: zlib compression level.
+    :param keyframe_interval: Delta-code new segments, with a keyframe this
+                              often (in snapshots).
+    """
+    self.path = path
+    self.segment_size = segment_size
+    self.segment_period = segment_period
+    self.level = level
+    self.keyframe_interval = keyframe_interval
+    self._open = {}
+    self._encoders = {}
+    self._lock = Lock()
+
+
+  def _segments(self, feed):
+    """
+    Gets the names of all segments for a feed, oldest first.
+    """
+    feed_dir = join(self.path, feed)
+    if not exists(feed_dir):
+      return []
+
+    return sorted(splitext(x)[0] for x in listdir(feed_dir)
+                  if x.endswith(INDEX_EXT) or x.endswith(DELTA_INDEX_EXT))
+
+
+  def _index_path(self, feed, name):
+    path = join(self.path, feed, name + DELTA_INDEX_EXT)
+    if exists(path):
+      return path
+    return join(self.path, feed, name + INDEX_EXT)
+
+
+  def _new_segment(self, feed, period):
+    """
+    Starts a new segment for a feed, in the given period.
+    """
+    feed_dir = join(self.path, feed)
+    if not exists(feed_dir):
+      makedirs(feed_dir)
+
+    # Never append to an existing segment, in case we crashed part way through
+    # writing it.
+    num = len([x for x in self._segments(feed) if x.startswith(period)])
+    name = '%s-%04d' % (period, num)
+
+    segment = open(join(feed_dir, name + SEGMENT_EXT), 'ab')
+    index = open(join(feed_dir, name + (DELTA_INDEX_EXT if self.keyframe_interval else INDEX_EXT)), 'ab')
+    return [period, segment, index, 0]
+
+
+  def append(self, feed, data, timestamp=None):
+    """
+    Appends a snapshot of a feed to the archive.
+
+    :param feed: Name of the feed, eg: ``sydtrains_pos``.
+    :param data: The snapshot.
+    :param timestamp: Time of the snapshot, as a UNIX timestamp.  By default,
+                      this is the ``FeedHeader.timestamp``, or the current time
+                      if there is none.
+    """
+    if timestamp is None:
+      timestamp = header_timestamp(data) or int(time())
+
+    period = _segment_period(timestamp, self.segment_period)
+    if not self.keyframe_interval:
+      record = compress(data, self.level)
+
+    with self._lock:
+      current = self._open.get(feed)
+      if current is None or current[0] != period or current[3] >= self.segment_size:
+        if current is not None:
+          current[1].close()
+          current[2].close()
+        current = self._open[feed] = self._new_segment(feed, period)
+        if self.keyframe_interval:
+          # Every segment starts with a keyframe, so it can be read alone.
+          self._encoders.setdefault(feed, DeltaEncoder(self.keyframe_interval)).reset()
+
+      if self.keyframe_interval:
+        kind, record = self._encoders[feed].encode(data)
+        record = compress(record, self.level)
+        entry = DELTA_INDEX_ENTRY.pack(int(timestamp), current[3], len(record), kind)
+      else:
+        entry = INDEX_ENTRY.pack(int(timestamp), current[3], len(record))
+
+      period, segment, index, offset = current
+      segment.write(record)
+      segment.flush()
+
+      # Only index the record once it is written, so that the index never
+      # points at a partial record.
+      index.write(entry)
+      index.flush()
+      current[3] = offset + len(record)
+
+
+  def close(self):
+    """
+    Closes all open segments.
+    """
+    with self._lock:
+      for period, segment, index, offset in self._open.values():
+        segment.close()
+        index.close()
+      self._open.clear()
+
+
+  def _decode(self, f, entries):
+    """
+    Reads records from an open segment, rebuilding each snapshot.  The first
+    entry must be a keyframe.
+
+    Yields tuples of timestamp and data.
+    """
+    decoder = DeltaDecoder()
+    for ts, offset, length, kind in entries:
+      f.seek(offset)
+      yield ts, decoder.decode(kind, decompress(f.read(length)))
+
+
+  def find(self, feed, timestamp):
+    """
+    Finds the snapshot of a feed which was current at ``timestamp``: the last
+    one with a timestamp at or before it.
+
+    Returns a tuple of the snapshot's timestamp and data, or None if there is
+    no snapshot that early.
+    """
+    period = _segment_period(timestamp, self.segment_period)
+
+    # Segment names sort by time, so start with the last segment which could
+    # contain this timestamp and work backwards.
+    for name in reversed(self._segments(feed)):
+      if name[:len(period)] > period:
+        continue
+
+      entries = read_index(self._index_path(feed, name))
+      pos = bisect_right([x[0] for x in entries], timestamp)
+      if pos:
+        # Rebuild it from the keyframe before it.
+        start = pos - 1
+        while entries[start][3] != KEYFRAME:
+          start -= 1
+
+        with open(join(self.path, feed, name + SEGMENT_EXT), 'rb') as f:
+          for result in self._decode(f, entries[start:pos]):
+            pass
+        return result
+
+    return None
+
+
+  def snapshots(self, feed, start=None, end=None):
+    """
+    Iterates over snapshots of a feed, in order.
+
+    Yields tuples of timestamp and data.
+
+    :param start: Only include snapshots at or after this timestamp.
+    :param end: Only include snapshots before this timestamp.
+    """
+    for name in self._segments(feed):
+      if end is not None and name[:14] >= _segment_period(end, 1):
+        break
+
+      entries = read_index(self._index_path(feed, name))
+      wanted = [i for i, x in enumerate(entries)
+                if (start is None or x[0] >= start) and (end is None or x[0] < end)]
+      if not wanted:
+        continue
+
+      # Start from the keyframe before the first snapshot we want, and read
+      # the segment sequentially.
+      first, last = wanted[0], wanted[-1]
+      while entries[first][3] != KEYFRAME:
+        first -= 1
+      wanted = set(wanted)
+
+      with open(join(self.path, feed, name + SEGMENT_EXT), 'rb') as f:
+        for i, result in enumerate(self._decode(f, entries[first:last + 1]), first):
+          if i in wanted:
+            yield result
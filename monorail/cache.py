@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/cache.py - On-disk cache for static datasets
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from hashlib import sha256
+from json import dump, load
+from os import close, fdopen, listdir, makedirs, remove, rename
+from os.path import exists, getsize, join
+from tempfile import mkstemp
+from time import time
+
+# Default maximum size of the cache, in bytes.
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+INDEX_FILE = 'index.json'
+BLOB_DIR = 'blobs'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+  """
+  Gets the SHA-256 hash of a file, as a hex string.
+  """
+  h = sha256()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(HASH_CHUNK_SIZE)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class DownloadCache(object):
+  def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+    """
+    Creates a persistent cache of downloaded files.
+
+    Files are stored by the SHA-256 of their content, so two resources with
+    the same content only take up space once.  Each resource name is mapped
+    to a blob, along with the ETag and Last-Modified headers the server gave
+    us, so that we can make a conditional request next time.
+
+    When the cache grows over ``max_size``, the least recently used blobs are
+    removed.
+
+    :param path: Directory to store the cache in.  Created if it does not exist.
+    :param max_size: Maximum size of all blobs in the cache, in bytes.
+    """
+    self._path = path
+    self._blob_dir = join(path, BLOB_DIR)
+    self._index_path = join(path, INDEX_FILE)
+    self.max_size = max_size
+
+    if not exists(self._blob_dir):
+      makedirs(self._blob_dir)
+
+    self._index = {}
+    if exists(self._index_path):
+      with open(self._index_path, 'rb') as f:
+        self._index = load(f)
+
+
+  def _save(self):
+    """
+    Writes out the index, replacing the old one atomically.
+    """
+    fd, tmp = mkstemp(dir=self._path, prefix='.index')
+    with fdopen(fd, 'w') as f:
+      dump(self._index, f, indent=2)
+    rename(tmp, self._index_path)
+
+
+  def blob_path(self, digest):
+    """
+    Gets the path to a blob with a given SHA-256 hash.
+    """
+    return join(self._blob_dir, digest)
+
+
+  def get(self, key):
+    """
+    Gets the cache entry for a resource, or None if it is not cached.
+
+    Entries are dicts with ``sha256``, ``size``, ``etag``, ``last_modified``
+    and ``accessed`` keys.
+    """
+    entry = self._index.get(key)
+    if entry is None:
+      return None
+
+    if not exists(self.blob_path(entry['sha256'])):
+      # Blob was removed from underneath us.
+      del self._index[key]
+      self._save()
+      return None
+
+    return entry
+
+
+  def conditional_headers(self, key):
+    """
+    Gets headers for a conditional GET of a resource, so the server can reply
+    with 304 Not Modified if our copy is current.
+    """
+    entry = self.get(key)
+    headers = {}
+    if entry is None:
+      return headers
+
+    if entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+      headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+  def touch(self, key):
+    """
+    Marks a cached resource as recently used, and returns the path to it.
+    """
+    entry = self._index[key]
+    entry['accessed'] = time()
+    self._save()
+    return self.blob_path(entry['sha256'])
+
+
+  def temp_file(self):
+    """
+    Creates an empty file in the cache directory to download into.
+
+    Returns the path to the file.  This should be passed to ``store``
+    afterwards, or removed.
+    """
+    fd, tmp = mkstemp(dir=self._path, prefix='.download')
+    close(fd)
+    return tmp
+
+
+  def store(self, key, tmp, headers):
+    """
+    Moves a downloaded file into the cache.
+
+    Returns the path to the cached blob.
+
+    :param key: Name of the resource.
+    :param tmp: Path of the downloaded file, from ``temp_file``.
+    :param headers: Response headers from the server.
+    """
+    digest = file_digest(tmp)
+    blob = self.blob_path(digest)
+
+    if exists(blob):
+      # We already have this content.
+      remove(tmp)
+    else:
+      rename(tmp, blob)
+
+    self._index[key] = dict(
+      sha256=digest,
+      size=getsize(blob),
+      etag=headers.get('ETag'),
+      last_modified=headers.get('Last-Modified'),
+      accessed=time(),
+    )
+
+    self._evict(keep=digest)
+    self._save()
+    return blob
+
+
+  def _evict(self, keep=None):
+    """
+    Removes least recently used blobs until the cache fits in ``max_size``.
+
+    Blobs that are not referred to by the index are always removed.
+
+    :param keep: Digest of a blob that should never be removed.
+    """
+    # Most recent access time for each blob.
+    accessed = {}
+    for entry in self._index.values():
+      digest = entry['sha256']
+      accessed[digest] = max(accessed.get(digest, 0), entry['accessed'])
+
+    for digest in listdir(self._blob_dir):
+      if digest not in accessed:
+        remove(self.blob_path(digest))
+
+    sizes = dict((digest, getsize(self.blob_path(digest)))
+                 for digest in accessed if exists(self.blob_path(digest)))
+    total = sum(sizes.values())
+
+    for digest in sorted(sizes, key=lambda d: accessed[d]):
+      if total <= self.max_size:
+        break
+      if digest == keep:
+        continue
+
+      remove(self.blob_path(digest))
+      total -= sizes[digest]
+
+      for key in [k for k, v in self._index.items() if v['sha256'] == digest]:
+        del self._index[key]
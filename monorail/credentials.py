@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/credentials.py - Spreads requests across several API keys
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+from .metrics import rate_limit_headers
+
+from threading import Lock
+from time import time
+
+# OAuth2 token endpoint the API keys get access tokens from.  This is here
+# rather than in ``monorail.tokens`` so that ``gtfs_harvester`` (which doesn't
+# use requests) can share it.
+TOKEN_URL = 'https://api.transport.nsw.gov.au/auth/oauth/v2/token?scope=user&grant_type=client_credentials'
+
+# Seconds to take a key out of rotation after it gets 429 Too Many Requests,
+# if the server doesn't say how long with Retry-After.
+COOLDOWN = 60
+
+
+def discover_credentials(portal, api_uuid=None):
+  """
+  Gets the (client ID, client secret) of every application registered to a
+  portal account.
+
+  :param portal: ``monorail.opendata.OpenData`` to ask.
+  :param api_uuid: Only get applications which have this API enabled.
+  """
+  return [(app['ApiKey'], app['KeySecret'])
+          for app in portal.iter_applications(api_uuid, select='ApiKey,KeySecret')]
+
+
+def remaining_budget(headers):
+  """
+  Gets the number of requests left in the quota from a response's headers, or
+  None if they don't say.
+
+  If there are several quotas (eg: per second and per day), this is the
+  smallest.
+  """
+  remaining = None
+  for header, value in rate_limit_headers(headers).items():
+    if 'remaining' not in header:
+      continue
+    try:
+      value = int(value)
+    except ValueError:
+      continue
+    remaining = value if remaining is None else min(remaining, value)
+  return remaining
+
+
+class Credential(object):
+  def __init__(self, client_id, client_secret):
+    """
+    One API key in a ``CredentialPool``, and what we know about its load.
+
+    ``tokens`` is free for the user of the pool to keep the key's token in
+    (eg: a ``monorail.tokens.TokenManager``).
+    """
+    self.client_id = client_id
+    self.client_secret = client_secret
+    self.tokens = None
+    self.in_flight = 0
+    self.requests = 0
+    self.throttled = 0
+    self.remaining = None
+    self.cooldown_until = 0.
+
+
+  def cooling_down(self, now=None):
+    return self.cooldown_until > (now or time())
+
+
+  def _load(self):
+    # Fewest requests running, then the most quota left (unknown counts as
+    # plenty, so new keys get tried), then the fewest requests made.
+    return (self.in_flight,
+            -self.remaining if self.remaining is not None else float('-inf'),
+            self.requests)
+
+
+class CredentialPool(object):
+  def __init__(self, credentials, cooldown=COOLDOWN):
+    """
+    Spreads requests across several API keys, so one key's quota doesn't cap
+    how often we can poll.
+
+    Each request goes to the least loaded key: the one with the fewest
+    requests in flight, then the most quota left (from the rate limit headers
+    of its last response).  A key which gets 429 Too Many Requests is taken
+    out of rotation until its cooldown passes; if every key is cooling down,
+    the one which will be back first is used.
+
+    :param credentials: List of (client ID, client secret) tuples.
+    :param cooldown: Seconds to take a key out of rotation after a 429, if
+                     the response has no Retry-After header.
+    """
+    assert credentials, 'at least one API key is required'
+    self.credentials = [Credential(client_id, client_secret)
+                        for client_id, client_secret in credentials]
+    self.cooldown = cooldown
+    self._lock = Lock()
+
+
+  def __len__(self):
+    return len(self.credentials)
+
+
+  def __iter__(self):
+    return iter(self.credentials)
+
+
+  def available(self):
+    """
+    Gets the number of keys which are not cooling down.
+    """
+    now = time()
+    return sum(1 for c in self.credentials if not c.cooling_down(now))
+
+
+  def acquire(self, usable=None):
+    """
+    Picks a key for a request.  Pass it to ``release`` once the response
+    arrives.
+
+    :param usable: Callable which returns False for keys which can't be used
+                   right now (eg: no token yet).  If none are usable, any key
+                   may be returned.
+    """
+    now = time()
+    with self._lock:
+      candidates = [c for c in self.credentials if usable is None or usable(c)] or self.credentials
+      ready = [c for c in candidates if not c.cooling_down(now)]
+      if ready:
+        credential = min(ready, key=Credential._load)
+      else:
+        credential = min(candidates, key=lambda c: c.cooldown_until)
+      credential.in_flight += 1
+      credential.requests += 1
+      return credential
+
+
+  def release(self, credential, status=None, headers=None):
+    """
+    Records the response to a request made with a key from ``acquire``.
+
+    :param status: HTTP status code, or None if the request failed.
+    :param headers: Response headers, to read the remaining quota from.
+    """
+    with self._lock:
+      credential.in_flight -= 1
+      if headers:
+        remaining = remaining_budget(headers)
+        if remaining is not None:
+          credential.remaining = remaining
+
+      if status == 429:
+        cooldown = self.cooldown
+        try:
+          cooldown = float((headers or {}).get('Retry-After'))
+        except (TypeError, ValueError):
+          pass
+        credential.throttled += 1
+        credential.remaining = 0
+        credential.cooldown_until = time() + cooldown
+        print('API key %s... throttled, out of rotation for %gs' % (credential.client_id[:8], cooldown))
+
+
+  def stats(self):
+    """
+    Gets a list of dicts describing the load on each key.
+    """
+    now = time()
+    with self._lock:
+      return [dict(client_id=c.client_id, in_flight=c.in_flight, requests=c.requests,
+                   throttled=c.throttled, remaining=c.remaining,
+                   cooldown=max(0., c.cooldown_until - now))
+              for c in self.credentials]
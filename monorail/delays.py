@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/delays.py - Joins GTFS-realtime trip updates against the timetable
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .spatial import _expand
+from .strings import NO_CODE
+from google.transit import gtfs_realtime_pb2
+import numpy as np
+from time import localtime, mktime
+
+SKIPPED = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+NO_DATA = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.NO_DATA
+
+# Columns of flattened StopTimeUpdates, and their types.
+UPDATE_COLUMNS = (
+  ('trip', np.int32),
+  ('sequence', np.int64),
+  ('stop', np.int32),
+  ('day', np.int64),
+  ('arrival', np.float64),
+  ('arrival_time', np.int64),
+  ('departure', np.float64),
+  ('departure_time', np.int64),
+  ('skipped', np.bool_),
+  ('no_data', np.bool_),
+)
+
+# stop_times keys are packed as trip_id * SEQUENCE_KEY + stop_sequence.
+SEQUENCE_KEY = 1 << 32
+
+
+def service_day(date):
+  """
+  Gets the UNIX timestamp that GTFS times on a service day are relative to:
+  noon minus 12 hours, in the local time zone.
+
+  Set the ``TZ`` environment variable to the feed's time zone (eg:
+  ``Australia/Sydney``) if this isn't the local time zone.
+
+  :param date: Service day, as a YYYYMMDD string.
+  """
+  date = int(date)
+  return int(mktime((date // 10000, date // 100 % 100, date % 100, 12, 0, 0, 0, 0, -1))) - 43200
+
+
+class DelayTable(object):
+  # Columns, and their types.
+  COLUMNS = (
+    ('position', np.int64),
+    ('trip_id', np.int32),
+    ('stop_id', np.int32),
+    ('stop_sequence', np.int32),
+    ('scheduled_arrival', np.int64),
+    ('scheduled_departure', np.int64),
+    ('arrival_delay', np.float64),
+    ('departure_delay', np.float64),
+    ('updated', np.bool_),
+    ('skipped', np.bool_),
+  )
+
+  def __init__(self, columns):
+    """
+    Scheduled and predicted times for every stop of every trip in a
+    TripUpdates feed, stored as NumPy arrays.
+
+    ``position`` is the row in the feed's ``stop_times`` table.  ``trip_id``
+    and ``stop_id`` are codes in the feed's string tables.
+
+    Scheduled times are UNIX timestamps, or 0 if the timetable doesn't have
+    one.  Delays are in seconds, and are NaN
+    where there is no prediction.  ``updated`` is True for stops which had
+    their own StopTimeUpdate; other stops get the delay propagated from the
+    last update before them on the same trip.
+    """
+    for name, dtype in self.COLUMNS:
+      setattr(self, name, columns[name])
+
+
+  def __len__(self):
+    return len(self.position)
+
+
+  @property
+  def predicted_arrival(self):
+    return self.scheduled_arrival + self.arrival_delay
+
+
+  @property
+  def predicted_departure(self):
+    return self.scheduled_departure + self.departure_delay
+
+
+class DelayEngine(object):
+  def __init__(self, feed):
+    """
+    Applies GTFS-realtime TripUpdates to a compiled GTFS feed (from
+    ``monorail.gtfs``), in a single batched pass.
+
+    This precomputes an index of each trip's (offset, length) in the feed's
+    ``stop_times``, which is sorted by trip then stop_sequence.
+    """
+    self.feed = feed
+    stop_times = feed['stop_times']
+    self.stop_times = stop_times
+    self.trip_ids = feed.strings['trip_id']
+    self.stop_ids = feed.strings['stop_id']
+
+    trips, offsets, lengths = np.unique(stop_times['trip_id'], return_index=True, return_counts=True)
+    self.trip_offset = np.full(len(self.trip_ids), -1, dtype=np.int64)
+    self.trip_length = np.zeros(len(self.trip_ids), dtype=np.int64)
+    valid = trips != NO_CODE
+    self.trip_offset[trips[valid]] = offsets[valid]
+    self.trip_length[trips[valid]] = lengths[valid]
+
+    self._keys = (stop_times['trip_id'].astype(np.int64) * SEQUENCE_KEY +
+                  stop_times['stop_sequence'])
+
+
+  def _decode(self, message):
+    """
+    Flattens the StopTimeUpdates in a TripUpdates FeedMessage into arrays.
+    """
+    lookup_trip = self.trip_ids.lookup
+    lookup_stop = self.stop_ids.lookup
+    lengths = self.trip_length
+    nan = float('nan')
+    days = {}
+    rows = dict((name, []) for name, dtype in UPDATE_COLUMNS)
+
+    default_date = None
+    if message.header.timestamp:
+      default_date = '%04d%02d%02d' % localtime(message.header.timestamp)[:3]
+
+    for entity in message.entity:
+      if not entity.HasField('trip_update'):
+        continue
+
+      update = entity.trip_update
+      trip = lookup_trip(update.trip.trip_id)
+      if trip == NO_CODE or not lengths[trip]:
+        # Not in the timetable (eg: an added trip)
+        continue
+
+      date = update.trip.start_date or default_date
+      if date not in days:
+        days[date] = service_day(date) if date else 0
+      day = days[date]
+
+      for stu in update.stop_time_update:
+        arrival = stu.arrival if stu.HasField('arrival') else None
+        departure = stu.departure if stu.HasField('departure') else None
+
+        rows['trip'].append(trip)
+        rows['sequence'].append(stu.stop_sequence if stu.HasField('stop_sequence') else -1)
+        rows['stop'].append(lookup_stop(stu.stop_id) if stu.stop_id else NO_CODE)
+        rows['day'].append(day)
+        rows['arrival'].append(arrival.delay if arrival is not None and arrival.HasField('delay') else nan)
+        rows['arrival_time'].append(arrival.time if arrival is not None else 0)
+        rows['departure'].append(departure.delay if departure is not None and departure.HasField('delay') else nan)
+        rows['departure_time'].append(departure.time if departure is not None else 0)
+        rows['skipped'].append(stu.schedule_relationship == SKIPPED)
+        rows['no_data'].append(stu.schedule_relationship == NO_DATA)
+
+    return dict((name, np.array(rows[name], dtype=dtype)) for name, dtype in UPDATE_COLUMNS)
+
+
+  def _locate(self, trip, sequence, stop):
+    """
+    Finds the stop_times row for each update, or -1 if there isn't one.
+    """
+    keys = trip.astype(np.int64) * SEQUENCE_KEY + sequence
+    pos = np.searchsorted(self._keys, keys)
+    pos = np.minimum(pos, len(self._keys) - 1)
+    found = (sequence >= 0) & (self._keys[pos] == keys)
+    pos = np.where(found, pos, -1)
+
+    # Updates with only a stop_id need to be found by searching the trip.
+    stop_ids = self.stop_times['stop_id']
+    for i in np.nonzero((sequence < 0) & (stop != NO_CODE))[0]:
+      offset = self.trip_offset[trip[i]]
+      matches = np.nonzero(stop_ids[offset:offset + self.trip_length[trip[i]]] == stop[i])[0]
+      if len(matches):
+        pos[i] = offset + matches[0]
+
+    return pos
+
+
+  def apply(self, message):
+    """
+    Applies a TripUpdates feed, giving the scheduled and predicted times for
+    every stop on every trip in it.
+
+    Delays given as absolute times are converted using the trip's start_date
+    (or the date of the feed header's timestamp).  Each stop without its own
+    update gets the delay from the last update before it on the trip, as
+    described in the GTFS-realtime specification.
+
+    :param message: A serialised FeedMessage (bytes) or a parsed
+                    ``FeedMessage``.
+    :returns: ``DelayTable``
+    """
+    if not isinstance(message, gtfs_realtime_pb2.FeedMessage):
+      data = message
+      message = gtfs_realtime_pb2.FeedMessage()
+      message.ParseFromString(data)
+
+    updates = self._decode(message)
+    pos = self._locate(updates['trip'], updates['sequence'], updates['stop'])
+    matched = pos >= 0
+    if not matched.any():
+      return DelayTable(dict((name, np.empty(0, dtype=dtype)) for name, dtype in DelayTable.COLUMNS))
+
+    updates = dict((name, values[matched]) for name, values in updates.items())
+    pos = pos[matched]
+
+    # Every stop on every updated trip.
+    trips = np.unique(updates['trip'])
+    starts = self.trip_offset[trips]
+    segment, rows = _expand(starts, starts + self.trip_length[trips])
+    segment_first = np.searchsorted(segment, np.arange(len(trips)))
+    first = segment_first[segment]
+
+    # Where each update goes in those rows.
+    update_segment = np.searchsorted(trips, updates['trip'])
+    local = segment_first[update_segment] + (pos - starts[update_segment])
+
+    arrival_time = self.stop_times['arrival_time'][rows]
+    departure_time = self.stop_times['departure_time'][rows]
+    day = np.zeros(len(rows), dtype=np.int64)
+    day[local] = updates['day']
+    # Every row in a trip has the same service day.
+    day = np.maximum.reduceat(day, segment_first)[segment]
+    scheduled_arrival = np.where(arrival_time >= 0, day + arrival_time, 0)
+    scheduled_departure = np.where(departure_time >= 0, day + departure_time, 0)
+
+    # Turn absolute times into delays.
+    arrival = updates['arrival']
+    departure = updates['departure']
+    fix = np.isnan(arrival) & (updates['arrival_time'] > 0) & (scheduled_arrival[local] > 0)
+    arrival[fix] = updates['arrival_time'][fix] - scheduled_arrival[local[fix]]
+    fix = np.isnan(departure) & (updates['departure_time'] > 0) & (scheduled_departure[local] > 0)
+    departure[fix] = updates['departure_time'][fix] - scheduled_departure[local[fix]]
+
+    nan = np.nan
+    index = np.arange(len(rows))
+    updated = np.zeros(len(rows), dtype=np.bool_)
+    updated[local] = True
+    skipped = np.zeros(len(rows), dtype=np.bool_)
+    skipped[local] = updates['skipped']
+    own_arrival = np.full(len(rows), nan)
+    own_arrival[local] = np.where(updates['no_data'], nan, arrival)
+    own_departure = np.full(len(rows), nan)
+    own_departure[local] = np.where(updates['no_data'], nan, departure)
+
+    # Delay carried forward from each update: departure if we have it.  NO_DATA
+    # updates carry NaN, so stops after them have no prediction.  A skipped stop
+    # doesn't pass its delay on, so stops after it use the previous update's.
+    carry = np.where(np.isnan(own_departure), own_arrival, own_departure)
+    carry[skipped] = nan
+    last = np.where(updated & ~skipped, index, -1)
+    last = np.maximum.accumulate(last)
+    propagated = np.where(last >= first, carry[np.maximum(last, 0)], nan)
+
+    # An update with only a departure time arrives with the previous delay.
+    before = np.full(len(rows), nan)
+    before[1:] = propagated[:-1]
+    before[index == first] = nan
+    arrival_delay = np.where(updated, before, propagated)
+    arrival_delay = np.where(np.isnan(own_arrival), arrival_delay, own_arrival)
+    departure_delay = np.where(np.isnan(own_departure), propagated, own_departure)
+    no_data = np.zeros(len(rows), dtype=np.bool_)
+    no_data[local] = updates['no_data']
+    no_prediction = skipped | no_data
+    arrival_delay[no_prediction] = nan
+    departure_delay[no_prediction] = nan
+
+    columns = dict(
+      position=rows,
+      trip_id=self.stop_times['trip_id'][rows],
+      stop_id=self.stop_times['stop_id'][rows],
+      stop_sequence=self.stop_times['stop_sequence'][rows],
+      scheduled_arrival=scheduled_arrival,
+      scheduled_departure=scheduled_departure,
+      arrival_delay=arrival_delay,
+      departure_delay=departure_delay,
+      updated=updated,
+      skipped=skipped,
+    )
+    return DelayTable(columns)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/delta.py - Entity-level delta coding of GTFS-realtime snapshots
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from struct import Struct
+
+# Kinds of record.  A keyframe is a whole snapshot; a delta only has the
+# entities which changed since the snapshot before it.
+KEYFRAME = 0
+DELTA = 1
+
+# Write a keyframe at least this often, in snapshots.
+DEFAULT_KEYFRAME_INTERVAL = 60
+
+# Write a keyframe instead if a delta would be more than this fraction of the
+# snapshot's size.
+MAX_DELTA_RATIO = .5
+
+# Delta header: prefix length, suffix length, number of removed, changed and
+# added entities.
+DELTA_HEADER = Struct('<IIIII')
+ID_LENGTH = Struct('<H')
+CHUNK_LENGTH = Struct('<I')
+ADDED_ENTITY = Struct('<II')
+
+# Field numbers in FeedMessage and FeedEntity.
+ENTITY_FIELD = 2
+ID_FIELD = 1
+
+
+def _varint(data, pos):
+  """
+  Reads a varint from a bytearray.  Returns the value and the position after
+  it.
+  """
+  result = shift = 0
+  while True:
+    b = data[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return result, pos
+    shift += 7
+
+
+def _fields(data, start=0, end=None):
+  """
+  Iterates over the fields of a serialised protobuf message in a bytearray,
+  without decoding them.
+
+  Yields tuples of field number, wire type, start of the field (its tag),
+  start of its value and end of the field.  Raises ValueError on groups and
+  damaged data.
+  """
+  pos = start
+  end = len(data) if end is None else end
+  while pos < end:
+    tag_start = pos
+    tag, pos = _varint(data, pos)
+    field, wire_type = tag >> 3, tag & 7
+    if wire_type == 0:
+      value_start = pos
+      _, pos = _varint(data, pos)
+    elif wire_type == 1:
+      value_start = pos
+      pos += 8
+    elif wire_type == 2:
+      length, value_start = _varint(data, pos)
+      pos = value_start + length
+    elif wire_type == 5:
+      value_start = pos
+      pos += 4
+    else:
+      raise ValueError('unsupported wire type %d' % wire_type)
+
+    if pos > end:
+      raise ValueError('truncated message')
+    yield field, wire_type, tag_start, value_start, pos
+
+
+def _entity_id(data, start, end):
+  for field, wire_type, tag_start, value_start, field_end in _fields(data, start, end):
+    if field == ID_FIELD and wire_type == 2:
+      return bytes(data[value_start:field_end])
+  raise ValueError('entity has no id')
+
+
+def split_feed(data):
+  """
+  Splits a serialised FeedMessage into the bytes before its entities (the
+  header), each entity, and the bytes after them.
+
+  Entities are kept exactly as they were serialised, so joining the parts
+  gives back the same bytes.
+
+  Returns a tuple of prefix, a list of (entity id, entity bytes), and suffix.
+  Raises ValueError if the feed can't be split this way (eg: it isn't a
+  FeedMessage, or has duplicate entity ids).
+  """
+  buf = bytearray(data)
+  prefix_end = suffix_start = None
+  entities = []
+  seen = set()
+
+  for field, wire_type, tag_start, value_start, end in _fields(buf):
+    if field == ENTITY_FIELD and wire_type == 2:
+      if suffix_start is not None:
+        raise ValueError('fields between entities')
+      if prefix_end is None:
+        prefix_end = tag_start
+      entity_id = _entity_id(buf, value_start, end)
+      if entity_id in seen:
+        raise ValueError('duplicate entity id %r' % entity_id)
+      seen.add(entity_id)
+      entities.append((entity_id, bytes(buf[tag_start:end])))
+    elif prefix_end is not None and suffix_start is None:
+      suffix_start = tag_start
+
+  if prefix_end is None:
+    prefix_end = len(buf)
+  if suffix_start is None:
+    suffix_start = len(buf)
+  return bytes(buf[:prefix_end]), entities, bytes(buf[suffix_start:])
+
+
+def _chunk_id(chunk):
+  """
+  Gets the entity id of one entity from ``split_feed`` (with its tag).
+  """
+  buf = bytearray(chunk)
+  for field, wire_type, tag_start, value_start, end in _fields(buf):
+    return _entity_id(buf, value_start, end)
+
+
+class _Frame(object):
+  def __init__(self, prefix, entities, suffix):
+    self.prefix = prefix
+    self.suffix = suffix
+    self.ids = [entity_id for entity_id, chunk in entities]
+    self.chunks = dict(entities)
+
+
+  def join(self):
+    chunks = self.chunks
+    return self.prefix + b''.join([chunks[entity_id] for entity_id in self.ids]) + self.suffix
+
+
+class DeltaEncoder(object):
+  def __init__(self, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+    """
+    Encodes a series of snapshots of one feed as keyframes and deltas.
+
+    A delta has the header of the new snapshot, and only the entities (by
+    entity id) which were added, removed or changed since the previous
+    snapshot.  A keyframe is written every ``keyframe_interval`` snapshots,
+    and whenever a delta wouldn't save much (or the snapshot can't be split
+    into entities), so any snapshot can be rebuilt from the last keyframe.
+
+    Entities are compared and stored exactly as they were serialised, so
+    ``DeltaDecoder`` gives back the same bytes.
+    """
+    self.keyframe_interval = keyframe_interval
+    self.reset()
+
+
+  def reset(self):
+    """
+    Makes the next snapshot a keyframe (eg: at the start of a new file).
+    """
+    self._frame = None
+    self._since_keyframe = 0
+
+
+  def _keyframe(self, data, frame):
+    self._frame = frame
+    self._since_keyframe = 1
+    return KEYFRAME, data
+
+
+  def encode(self, data):
+    """
+    Encodes the next snapshot.
+
+    Returns a tuple of the kind of record (``KEYFRAME`` or ``DELTA``) and
+    its contents.
+    """
+    try:
+      frame = _Frame(*split_feed(data))
+    except (ValueError, IndexError):
+      # Not something we can diff; store it whole.
+      return self._keyframe(data, None)
+
+    old = self._frame
+    if old is None or self._since_keyframe >= self.keyframe_interval:
+      return self._keyframe(data, frame)
+
+    old_chunks, new_chunks = old.chunks, frame.chunks
+    removed = [entity_id for entity_id in old.ids if entity_id not in new_chunks]
+    kept = [entity_id for entity_id in frame.ids if entity_id in old_chunks]
+    if kept != [entity_id for entity_id in old.ids if entity_id in new_chunks]:
+      # Entities were reordered, which deltas can't describe.
+      return self._keyframe(data, frame)
+
+    changed = [new_chunks[entity_id] for entity_id in kept
+               if new_chunks[entity_id] != old_chunks[entity_id]]
+    added = [(pos, new_chunks[entity_id]) for pos, entity_id in enumerate(frame.ids)
+             if entity_id not in old_chunks]
+
+    parts = [DELTA_HEADER.pack(len(frame.prefix), len(frame.suffix), len(removed),
+                               len(changed), len(added)), frame.prefix, frame.suffix]
+    for entity_id in removed:
+      parts.append(ID_LENGTH.pack(len(entity_id)))
+      parts.append(entity_id)
+    for chunk in changed:
+      parts.append(CHUNK_LENGTH.pack(len(chunk)))
+      parts.append(chunk)
+    for pos, chunk in added:
+      parts.append(ADDED_ENTITY.pack(pos, len(chunk)))
+      parts.append(chunk)
+
+    delta = b''.join(parts)
+    if len(delta) > len(data) * MAX_DELTA_RATIO:
+      return self._keyframe(data, frame)
+
+    self._frame = frame
+    self._since_keyframe += 1
+    return DELTA, delta
+
+
+class DeltaDecoder(object):
+  def __init__(self):
+    """
+    Rebuilds snapshots from the records made by ``DeltaEncoder``, which must
+    be given to ``decode`` in order, starting from a keyframe.
+    """
+    self._frame = None
+
+
+  def decode(self, kind, record):
+    """
+    Decodes the next record, returning the snapshot.
+    """
+    if kind == KEYFRAME:
+      try:
+        self._frame = _Frame(*split_feed(record))
+      except (ValueError, IndexError):
+        # The encoder couldn't split it either, so no delta follows it.
+        self._frame = None
+      return record
+
+    assert kind == DELTA, 'unknown record kind %r' % kind
+    frame = self._frame
+    assert frame is not None, 'delta without a keyframe'
+
+    prefix_len, suffix_len, removed, changed, added = DELTA_HEADER.unpack_from(record, 0)
+    pos = DELTA_HEADER.size
+    frame.prefix = record[pos:pos + prefix_len]
+    pos += prefix_len
+    frame.suffix = record[pos:pos + suffix_len]
+    pos += suffix_len
+
+    chunks = frame.chunks
+    if removed:
+      gone = set()
+      for i in range(removed):
+        length, = ID_LENGTH.unpack_from(record, pos)
+        pos += ID_LENGTH.size
+        gone.add(record[pos:pos + length])
+        pos += length
+      frame.ids = [entity_id for entity_id in frame.ids if entity_id not in gone]
+      for entity_id in gone:
+        del chunks[entity_id]
+
+    for i in range(changed):
+      length, = CHUNK_LENGTH.unpack_from(record, pos)
+      pos += CHUNK_LENGTH.size
+      chunk = record[pos:pos + length]
+      pos += length
+      chunks[_chunk_id(chunk)] = chunk
+
+    for i in range(added):
+      index, length = ADDED_ENTITY.unpack_from(record, pos)
+      pos += ADDED_ENTITY.size
+      chunk = record[pos:pos + length]
+      pos += length
+      entity_id = _chunk_id(chunk)
+      chunks[entity_id] = chunk
+      frame.ids.insert(index, entity_id)
+
+    return frame.join()
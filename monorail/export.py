@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/export.py - Bulk export of harvested snapshots to Parquet / Arrow
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .replay import POSITIONS_SUFFIX, ReplayIndex, _Reader
+from .strings import NO_CODE, StringTable
+from .vehicles import VehicleTable, _decode_into
+from collections import defaultdict
+from google.protobuf.message import DecodeError
+from google.transit import gtfs_realtime_pb2
+from json import dump, load
+from multiprocessing import Pool
+import numpy as np
+from os import close, fdopen, listdir, makedirs, remove, rename
+from os.path import dirname, exists, join
+from tempfile import mkstemp
+from time import localtime, mktime, time
+
+try:
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  # Only needed to export.
+  pa = pq = None
+
+# Output formats, and their file extensions.
+FORMATS = {
+  'parquet': '.parquet',
+  'arrow': '.arrow',
+}
+
+# Rows to decode before writing them out (as one Parquet row group or Arrow
+# record batch), which bounds the memory used by each worker.
+DEFAULT_BATCH_SIZE = 100000
+
+# Feeds with TripUpdates end with this.
+STOPS_SUFFIX = '_stops'
+
+# Records which partitions have been exported, so an interrupted export can
+# carry on where it stopped.
+MANIFEST_FILE = '_export.json'
+
+# Prefix of partitions' files while they are being written.
+PARTIAL_PREFIX = '.part-'
+
+# Columns of exported vehicle positions.  ``snapshot`` is left out, as
+# ``feed_timestamp`` says which snapshot a row came from.
+POSITION_COLUMNS = tuple((name, dtype) for name, dtype in VehicleTable.COLUMNS
+                         if name != 'snapshot')
+POSITION_STRINGS = ('vehicle_id', 'trip_id', 'route_id')
+
+# Columns of exported StopTimeUpdates, one row per stop.  Delays are NaN and
+# times are 0 where the update doesn't have one.  ``stop_sequence`` is -1 if
+# the update only has a ``stop_id``.
+STOP_UPDATE_COLUMNS = (
+  ('feed_timestamp', np.int64),
+  ('trip_id', np.int32),
+  ('route_id', np.int32),
+  ('start_date', np.int32),
+  ('vehicle_id', np.int32),
+  ('stop_sequence', np.int64),
+  ('stop_id', np.int32),
+  ('arrival_delay', np.float64),
+  ('arrival_time', np.int64),
+  ('departure_delay', np.float64),
+  ('departure_time', np.int64),
+  ('schedule_relationship', np.int8),
+)
+STOP_UPDATE_STRINGS = ('trip_id', 'route_id', 'start_date', 'vehicle_id', 'stop_id')
+
+
+def _decode_positions(message, rows, strings):
+  _decode_into(message, 0, rows, strings['vehicle_id'], strings['trip_id'],
+               strings['route_id'])
+
+
+def _decode_stop_updates(message, rows, strings):
+  feed_timestamp = message.header.timestamp
+  nan = float('nan')
+
+  def code(column, s):
+    return strings[column].code(s) if s else NO_CODE
+
+  for entity in message.entity:
+    if not entity.HasField('trip_update'):
+      continue
+
+    update = entity.trip_update
+    trip = update.trip
+    trip_id = code('trip_id', trip.trip_id)
+    route_id = code('route_id', trip.route_id)
+    start_date = code('start_date', trip.start_date)
+    vehicle_id = code('vehicle_id', update.vehicle.id)
+
+    for stu in update.stop_time_update:
+      arrival = stu.arrival if stu.HasField('arrival') else None
+      departure = stu.departure if stu.HasField('departure') else None
+
+      rows['feed_timestamp'].append(feed_timestamp)
+      rows['trip_id'].append(trip_id)
+      rows['route_id'].append(route_id)
+      rows['start_date'].append(start_date)
+      rows['vehicle_id'].append(vehicle_id)
+      rows['stop_sequence'].append(stu.stop_sequence if stu.HasField('stop_sequence') else -1)
+      rows['stop_id'].append(code('stop_id', stu.stop_id))
+      rows['arrival_delay'].append(arrival.delay if arrival is not None and arrival.HasField('delay') else nan)
+      rows['arrival_time'].append(arrival.time if arrival is not None else 0)
+      rows['departure_delay'].append(departure.delay if departure is not None and departure.HasField('delay') else nan)
+      rows['departure_time'].append(departure.time if departure is not None else 0)
+      rows['schedule_relationship'].append(stu.schedule_relationship)
+
+
+# Feed name suffix -> (columns, string columns, decoder) of the table it is
+# exported to.
+TABLES = {
+  POSITIONS_SUFFIX: (POSITION_COLUMNS, POSITION_STRINGS, _decode_positions),
+  STOPS_SUFFIX: (STOP_UPDATE_COLUMNS, STOP_UPDATE_STRINGS, _decode_stop_updates),
+}
+
+
+def table_for(feed):
+  """
+  Gets the suffix of the table a feed is exported to, or None if it isn't
+  exported (eg: alerts).
+  """
+  for suffix in TABLES:
+    if feed.endswith(suffix):
+      return suffix
+  return None
+
+
+def _schema(columns, strings):
+  return pa.schema([
+    pa.field(name, pa.string() if name in strings else pa.from_numpy_dtype(dtype))
+    for name, dtype in columns])
+
+
+class _Batch(object):
+  def __init__(self, table):
+    """
+    Rows decoded from snapshots, waiting to be written out.
+
+    String columns are interned into a ``StringTable`` per batch, and only
+    turned into strings when the batch is written.
+    """
+    self.columns, self.string_columns, self._decode = TABLES[table]
+    self.schema = _schema(self.columns, self.string_columns)
+    self.clear()
+
+
+  def clear(self):
+    self.rows = defaultdict(list)
+    self.strings = dict((name, StringTable()) for name in self.string_columns)
+
+
+  def __len__(self):
+    return len(self.rows['feed_timestamp'])
+
+
+  def add(self, message):
+    self._decode(message, self.rows, self.strings)
+
+
+  def table(self):
+    """
+    Gets the batch as an Arrow table.  Missing strings and NaN become nulls.
+    """
+    arrays = []
+    for name, dtype in self.columns:
+      values = np.array(self.rows[name], dtype=dtype)
+      if name in self.strings:
+        # NO_CODE picks the None on the end.
+        strings = np.array(self.strings[name].strings + [None], dtype=object)
+        arrays.append(pa.array(strings[values], type=pa.string()))
+      else:
+        arrays.append(pa.array(values, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=self.schema)
+
+
+def _open_writer(path, schema, fmt):
+  if fmt == 'parquet':
+    return pq.ParquetWriter(path, schema)
+  return pa.ipc.new_file(path, schema)
+
+
+def _export_partition(task):
+  """
+  Decodes one partition's snapshots and writes them out.  This runs in the
+  worker processes.
+
+  Returns a tuple of the partition's path, the number of snapshots and rows,
+  the number of snapshots which couldn't be decoded, and the time taken in
+  seconds.
+  """
+  index, count, table, output_dir, path, fmt, batch_size = task
+  started = time()
+  full_path = join(output_dir, path)
+  partition_dir = dirname(full_path)
+  if not exists(partition_dir):
+    try:
+      makedirs(partition_dir)
+    except OSError:
+      # Another worker made it first.
+      if not exists(partition_dir):
+        raise
+
+  # Clean up after an export which was interrupted.
+  for name in listdir(partition_dir):
+    if name.startswith(PARTIAL_PREFIX):
+      remove(join(partition_dir, name))
+
+  batch = _Batch(table)
+  reader = _Reader(index)
+  rows = bad = 0
+  fd, tmp = mkstemp(dir=partition_dir, prefix=PARTIAL_PREFIX, suffix=FORMATS[fmt])
+  close(fd)
+  try:
+    writer = _open_writer(tmp, batch.schema, fmt)
+    try:
+      # The partition's snapshots are the last rows of the index.
+      for row in range(len(index) - count, len(index)):
+        message = gtfs_realtime_pb2.FeedMessage()
+        try:
+          message.ParseFromString(reader.read(row))
+        except DecodeError:
+          bad += 1
+          continue
+
+        batch.add(message)
+        if len(batch) >= batch_size:
+          rows += len(batch)
+          writer.write_table(batch.table())
+          batch.clear()
+
+      if len(batch) or not rows:
+        # Always write something, so the file has the schema.
+        rows += len(batch)
+        writer.write_table(batch.table())
+    finally:
+      writer.close()
+      reader.close()
+    rename(tmp, full_path)
+  except:
+    if exists(tmp):
+      remove(tmp)
+    raise
+
+  return path, count, rows, bad, time() - started
+
+
+def _midnight(timestamp, days=0):
+  """
+  Gets the timestamp of the local midnight starting the day ``timestamp`` is
+  on, or ``days`` days after that.
+  """
+  day = localtime(int(timestamp))
+  # mktime rolls over into the next month.
+  return int(mktime((day.tm_year, day.tm_mon, day.tm_mday + days, 0, 0, 0, 0, 0, -1)))
+
+
+def _days(timestamps):
+  """
+  Splits sorted timestamps into local days.
+
+  Yields tuples of the date (YYYY-MM-DD), and the first and last + 1
+  positions on that day.
+  """
+  lo = 0
+  while lo < len(timestamps):
+    hi = int(np.searchsorted(timestamps, _midnight(timestamps[lo], 1)))
+    yield '%04d-%02d-%02d' % localtime(int(timestamps[lo]))[:3], lo, hi
+    lo = hi
+
+
+def partitions(index, feeds=None, start=None, end=None):
+  """
+  Splits the snapshots in a ``ReplayIndex`` into partitions by feed and
+  local date, skipping feeds which aren't exported.
+
+  Set the ``TZ`` environment variable to change which time zone dates are
+  in.
+
+  Partitions always hold whole days: ``start`` and ``end`` are widened to
+  the days they are in.
+
+  Returns a list of tuples of feed, date, and the first and last + 1 rows
+  of the index in the partition.
+  """
+  if start is not None:
+    start = _midnight(start)
+  if end is not None:
+    # Up to the end of the day the last snapshot before ``end`` is on.
+    end = _midnight(end - 1, 1)
+
+  found = []
+  for code, feed in enumerate(index.feeds.strings):
+    if table_for(feed) is None or (feeds and feed not in feeds):
+      continue
+
+    lo, hi = [int(pos) for pos in np.searchsorted(index.feed, [code, code + 1])]
+    if start is not None:
+      lo += int(np.searchsorted(index.timestamp[lo:hi], start))
+    if end is not None:
+      hi = lo + int(np.searchsorted(index.timestamp[lo:hi], end))
+    for date, first, last in _days(index.timestamp[lo:hi]):
+      found.append((feed, date, lo + first, lo + last))
+  return found
+
+
+def _partition_index(index, lo, hi):
+  """
+  Gets the part of the index a worker needs to read a partition: every row
+  up to ``hi`` of the same feed which is in a file the partition uses, so
+  deltas can be rebuilt from keyframes before the partition starts.
+  """
+  code = index.feed[lo]
+  feed_lo = int(np.searchsorted(index.feed, code))
+  files = np.unique(index.file[lo:hi])
+  candidates = index.file[feed_lo:hi]
+  pos = np.minimum(np.searchsorted(files, candidates), len(files) - 1)
+  return index.select(feed_lo + np.nonzero(files[pos] == candidates)[0])
+
+
+def _load_manifest(path):
+  if not exists(path):
+    return {}
+  with open(path, 'rb') as f:
+    return load(f)
+
+
+def _save_manifest(path, manifest):
+  fd, tmp = mkstemp(dir=dirname(path), prefix='.export', suffix='.json')
+  try:
+    f = fdopen(fd, 'w')
+  except:
+    close(fd)
+    raise
+  with f:
+    dump(manifest, f, indent=2, sort_keys=True)
+  rename(tmp, path)
+
+
+def export(input_dir, output_dir, feeds=None, start=None, end=None, fmt='parquet',
+           processes=None, batch_size=DEFAULT_BATCH_SIZE, force=False):
+  """
+  Exports harvested snapshots to Parquet or Arrow files, decoding them in a
+  pool of processes.
+
+  Vehicle positions (``*_pos`` feeds) and StopTimeUpdates (``*_stops``
+  feeds) are written to ``output_dir/feed=<feed>/date=<YYYY-MM-DD>/``,
+  which ``pyarrow.dataset`` and most query engines read as partition
+  columns.  Each partition is written by one worker, a batch of rows at a
+  time, and replaces the old file atomically when it is complete.
+
+  Exported partitions are recorded in ``_export.json``, with how many
+  snapshots they had.  Partitions are skipped if they are already exported
+  and nothing has been harvested into them since (eg: after an interrupted
+  export is started again).
+
+  This requires ``pyarrow``.
+
+  Yields a tuple for each partition exported: its path (relative to
+  ``output_dir``), the number of snapshots and rows, the number of
+  snapshots which couldn't be decoded, and the time taken in seconds.
+
+  :param input_dir: Directory of snapshots, indexed by
+                    ``monorail.replay.ReplayIndex``.
+  :param feeds: Names of feeds to export.  By default, all of them.
+  :param start: Only export days from the one this timestamp is on.
+  :param end: Only export days before this timestamp (including the day it
+              is on, unless it is midnight).
+  :param fmt: ``parquet`` or ``arrow`` (Arrow IPC file format).
+  :param processes: Number of worker processes.  By default, one per CPU.
+  :param batch_size: Rows each worker decodes before writing them out.
+  :param force: Export every partition, even if it is up to date.
+  """
+  if pa is None:
+    raise ImportError('exporting requires pyarrow')
+  assert fmt in FORMATS, 'unknown format %r' % fmt
+
+  if not exists(output_dir):
+    makedirs(output_dir)
+  manifest_path = join(output_dir, MANIFEST_FILE)
+  manifest = _load_manifest(manifest_path)
+
+  index = ReplayIndex(input_dir)
+  todo = []
+  for feed, date, lo, hi in partitions(index, feeds, start, end):
+    path = join('feed=' + feed, 'date=' + date, 'part-0' + FORMATS[fmt])
+    state = [hi - lo, int(index.timestamp[hi - 1])]
+    if force or manifest.get(path) != state or not exists(join(output_dir, path)):
+      todo.append((path, lo, hi, state))
+
+  # Biggest first, so no worker is left with a big one at the end.
+  todo.sort(key=lambda job: job[1] - job[2])
+  states = dict((path, state) for path, lo, hi, state in todo)
+
+  def tasks():
+    for path, lo, hi, state in todo:
+      table = table_for(index.feeds.strings[index.feed[lo]])
+      yield (_partition_index(index, lo, hi), hi - lo, table, output_dir, path,
+             fmt, batch_size)
+
+  pool = Pool(processes)
+  try:
+    for result in pool.imap_unordered(_export_partition, tasks()):
+      manifest[result[0]] = states[result[0]]
+      _save_manifest(manifest_path, manifest)
+      yield result
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/gtfs.py - Compiles static GTFS feeds into memory-mappable arrays
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .cache import file_digest
+from .strings import NO_CODE, PackedStringTable, StringTable
+from array import array
+import csv
+from io import TextIOWrapper
+from itertools import islice
+from json import dumps, loads
+import mmap
+import numpy as np
+from os import fdopen, makedirs, rename
+from os.path import abspath, dirname, exists, join
+from struct import Struct
+from tempfile import mkstemp
+from zipfile import ZipFile
+
+MAGIC = b'MONORAIL-GTFS\x00\x00\x01'
+HEADER_LENGTH = Struct('<Q')
+ALIGN = 64
+CACHE_EXT = '.gtfs'
+
+# Number of rows to convert at a time.
+CHUNK_ROWS = 65536
+
+# Column types
+ID = 'id'        # Interned into the named string table.
+TIME = 'time'    # HH:MM:SS as seconds past midnight (int32), -1 if missing.
+INT = 'int'      # Integer (int32), -1 if missing.
+SMALL = 'small'  # Small integer (int8), -1 if missing.
+FLOAT = 'float'  # float64, NaN if missing.
+
+# Tables to compile: table name -> ((column, type, string table), ...)
+TABLES = {
+  'agency': (
+    ('agency_id', ID, 'agency_id'),
+    ('agency_name', ID, 'text'),
+  ),
+  'stops': (
+    ('stop_id', ID, 'stop_id'),
+    ('stop_code', ID, 'text'),
+    ('stop_name', ID, 'text'),
+    ('stop_lat', FLOAT, None),
+    ('stop_lon', FLOAT, None),
+    ('location_type', SMALL, None),
+    ('parent_station', ID, 'stop_id'),
+    ('wheelchair_boarding', SMALL, None),
+    ('platform_code', ID, 'text'),
+  ),
+  'routes': (
+    ('route_id', ID, 'route_id'),
+    ('agency_id', ID, 'agency_id'),
+    ('route_short_name', ID, 'text'),
+    ('route_long_name', ID, 'text'),
+    ('route_type', INT, None),
+  ),
+  'trips': (
+    ('route_id', ID, 'route_id'),
+    ('service_id', ID, 'service_id'),
+    ('trip_id', ID, 'trip_id'),
+    ('shape_id', ID, 'shape_id'),
+    ('trip_headsign', ID, 'text'),
+    ('direction_id', SMALL, None),
+    ('block_id', ID, 'block_id'),
+    ('wheelchair_accessible', SMALL, None),
+  ),
+  'stop_times': (
+    ('trip_id', ID, 'trip_id'),
+    ('arrival_time', TIME, None),
+    ('departure_time', TIME, None),
+    ('stop_id', ID, 'stop_id'),
+    ('stop_sequence', INT, None),
+    ('pickup_type', SMALL, None),
+    ('drop_off_type', SMALL, None),
+  ),
+  'calendar': (
+    ('service_id', ID, 'service_id'),
+    ('monday', SMALL, None),
+    ('tuesday', SMALL, None),
+    ('wednesday', SMALL, None),
+    ('thursday', SMALL, None),
+    ('friday', SMALL, None),
+    ('saturday', SMALL, None),
+    ('sunday', SMALL, None),
+    ('start_date', INT, None),
+    ('end_date', INT, None),
+  ),
+  'calendar_dates': (
+    ('service_id', ID, 'service_id'),
+    ('date', INT, None),
+    ('exception_type', SMALL, None),
+  ),
+}
+
+# array typecode and NumPy dtype for each column type.
+TYPES = {
+  ID: ('i', np.int32),
+  TIME: ('i', np.int32),
+  INT: ('i', np.int32),
+  SMALL: ('b', np.int8),
+  FLOAT: ('d', np.float64),
+}
+
+
+def _csv_reader(f):
+  """
+  Creates a CSV reader for a file opened in binary mode.
+  """
+  if bytes is str:
+    # Python 2's csv module wants bytes.
+    return csv.reader(f)
+  return csv.reader(TextIOWrapper(f, 'utf-8-sig'))
+
+
+def parse_time(value):
+  """
+  Parses a GTFS time (H:MM:SS, may be past 24:00:00) into seconds past
+  midnight, or -1 if it is blank.
+  """
+  value = value.strip()
+  if not value:
+    return -1
+  return int(value[:-6]) * 3600 + int(value[-5:-3]) * 60 + int(value[-2:])
+
+
+def _convert(kind, values, strings):
+  """
+  Converts a column of strings from a CSV file to values for an array.
+  """
+  if kind == ID:
+    code = strings.code
+    return [code(v) if v else NO_CODE for v in values]
+
+  if kind == TIME:
+    return [parse_time(v) for v in values]
+
+  if kind == FLOAT:
+    try:
+      return [float(v) for v in values]
+    except ValueError:
+      nan = float('nan')
+      return [float(v) if v.strip() else nan for v in values]
+
+  # INT or SMALL
+  try:
+    return [int(v) for v in values]
+  except ValueError:
+    return [int(v) if v.strip() else -1 for v in values]
+
+
+def iter_rows(zf, member):
+  """
+  Iterates over the rows of a CSV file inside a GTFS zip, without extracting
+  it.
+
+  The first row yielded is the header, with whitespace and byte order marks
+  removed.
+  """
+  with zf.open(member) as f:
+    reader = _csv_reader(f)
+    header = next(reader)
+    if header and isinstance(header[0], bytes):
+      header[0] = header[0].lstrip(b'\xef\xbb\xbf')
+    yield [x.strip() for x in header]
+
+    for row in reader:
+      yield row
+
+
+def compile_table(zf, member, columns, strings, chunk_rows=CHUNK_ROWS):
+  """
+  Compiles a single table from a GTFS zip into arrays.
+
+  Rows are converted in chunks, so only ``chunk_rows`` rows are held as
+  strings at once.
+
+  Returns a dict of column name -> NumPy array.
+
+  :param zf: ``ZipFile`` to read from.
+  :param member: Name of the CSV file in the zip.
+  :param columns: Columns to compile, from ``TABLES``.
+  :param strings: dict of string table name -> ``StringTable``.  Missing
+                  string tables are created.
+  """
+  rows = iter_rows(zf, member)
+  header = next(rows)
+  width = len(header)
+
+  plan = []
+  out = {}
+  for name, kind, table in columns:
+    out[name] = array(TYPES[kind][0])
+    if table is not None and table not in strings:
+      strings[table] = StringTable()
+    plan.append((name, kind, header.index(name) if name in header else None,
+                 strings.get(table)))
+
+  while True:
+    chunk = list(islice(rows, chunk_rows))
+    if not chunk:
+      break
+
+    # Pad short rows, then transpose so we can convert a column at a time.
+    chunk = [row if len(row) >= width else row + [''] * (width - len(row)) for row in chunk]
+    transposed = list(zip(*chunk))
+    del chunk
+
+    for name, kind, idx, table in plan:
+      values = transposed[idx] if idx is not None else ('',) * len(transposed[0])
+      out[name].extend(_convert(kind, values, table))
+
+  return dict((name, np.frombuffer(out[name], dtype=TYPES[kind][1]) if len(out[name])
+               else np.empty(0, dtype=TYPES[kind][1]))
+              for name, kind, table in columns)
+
+
+def _sort_stop_times(stop_times):
+  """
+  Sorts stop_times by trip, then stop_sequence, so that each trip's stops are
+  together and in order.
+  """
+  order = np.lexsort((stop_times['stop_sequence'], stop_times['trip_id']))
+  return dict((name, column[order]) for name, column in stop_times.items())
+
+
+class Feed(object):
+  def __init__(self, tables, strings, source=None, members=None):
+    """
+    A compiled GTFS feed.
+
+    :param tables: dict of table name -> dict of column name -> NumPy array.
+    :param strings: dict of string table name -> ``StringTable``.
+    :param source: SHA-256 of the zip file this was compiled from.
+    :param members: dict of zip member name -> [CRC32, size] that each table
+                    was compiled from.
+    """
+    self.tables = tables
+    self.strings = strings
+    self.source = source
+    self.members = members or {}
+
+
+  def __getitem__(self, table):
+    return self.tables[table]
+
+
+  def __contains__(self, table):
+    return table in self.tables
+
+
+  def save(self, path):
+    """
+    Writes the feed to a file, which can be opened again with ``Feed.open``.
+
+    The file is written to a temporary file first, then renamed into place.
+    """
+    arrays = []
+    for table, columns in self.tables.items():
+      for column, values in columns.items():
+        arrays.append(('tables/%s/%s' % (table, column), values))
+    for name, strings in self.strings.items():
+      data, offsets = strings.pack()
+      arrays.append(('strings/%s/data' % name, data))
+      arrays.append(('strings/%s/offsets' % name, offsets))
+
+    # Work out where each array goes.
+    layout = {}
+    offset = 0
+    for name, values in arrays:
+      values = np.ascontiguousarray(values)
+      layout[name] = dict(dtype=values.dtype.str, shape=list(values.shape), offset=offset)
+      offset += values.nbytes
+      offset += -offset % ALIGN
+
+    header = dumps(dict(
+      source=self.source,
+      members=self.members,
+      tables=sorted(self.tables),
+      strings=sorted(self.strings),
+      arrays=layout,
+    )).encode('utf-8')
+    start = len(MAGIC) + HEADER_LENGTH.size + len(header)
+    start += -start % ALIGN
+
+    fd, tmp = mkstemp(dir=dirname(abspath(path)), prefix='.gtfs')
+    with fdopen(fd, 'wb') as f:
+      f.write(MAGIC)
+      f.write(HEADER_LENGTH.pack(len(header)))
+      f.write(header)
+      for name, values in arrays:
+        f.seek(start + layout[name]['offset'])
+        f.write(np.ascontiguousarray(values).tobytes())
+    rename(tmp, path)
+
+
+  @classmethod
+  def open(cls, path):
+    """
+    Opens a feed written by ``Feed.save``.
+
+    The arrays are memory-mapped read-only, so this is very fast and the pages
+    are shared between processes which have the same file open.
+    """
+    with open(path, 'rb') as f:
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    assert m[:len(MAGIC)] == MAGIC, '%s is not a compiled GTFS feed' % path
+    header_length = HEADER_LENGTH.unpack_from(m, len(MAGIC))[0]
+    header_start = len(MAGIC) + HEADER_LENGTH.size
+    header = loads(m[header_start:header_start + header_length].decode('utf-8'))
+    start = header_start + header_length
+    start += -start % ALIGN
+
+    def get(name):
+      info = header['arrays'][name]
+      dtype = np.dtype(str(info['dtype']))
+      count = int(np.prod(info['shape']))
+      if not count:
+        return np.empty(info['shape'], dtype=dtype)
+      return np.frombuffer(m, dtype=dtype, count=count,
+                           offset=start + info['offset']).reshape(info['shape'])
+
+    tables = {}
+    for name in header['arrays']:
+      if name.startswith('tables/'):
+        kind, table, column = name.split('/', 2)
+        tables.setdefault(table, {})[column] = get(name)
+
+    strings = dict(
+      (name, PackedStringTable(get('strings/%s/data' % name), get('strings/%s/offsets' % name)))
+      for name in header['strings'])
+
+    return cls(tables, strings, header['source'], header['members'])
+
+
+def _member_name(zf, table):
+  """
+  Gets the name of a table's file in a GTFS zip, or None if it is missing.
+  """
+  for info in zf.infolist():
+    if info.filename.rsplit('/', 1)[-1] == table + '.txt':
+      return info.filename
+  return None
+
+
+def compile_gtfs(path, tables=TABLES, digest=None, previous=None):
+  """
+  Compiles a GTFS zip file into a ``Feed``.
+
+  Tables are read straight out of the zip, without extracting them.  Tables
+  which are missing from the zip are skipped.
+
+  If a ``previous`` feed is given, any table whose file in the zip has the
+  same CRC32 and size as the one that ``previous`` was compiled from is reused
+  as-is, rather than being parsed again.  This only needs the zip's central
+  directory, so a refresh where only (say) ``calendar_dates.txt`` changed is
+  very quick.
+
+  String tables carry on from ``previous``, so that the codes in reused tables
+  stay valid.  This means IDs which have been removed from the feed are never
+  removed from the string tables; compile without ``previous`` now and then to
+  clean them out.
+
+  :param path: Path to the GTFS zip file.
+  :param tables: Tables to compile, in the same format as ``TABLES``.
+  :param digest: SHA-256 of the zip file, if already known.
+  :param previous: ``Feed`` compiled from an earlier version of the zip.
+  """
+  strings = dict(previous.strings) if previous is not None else {}
+  copied = set()
+  compiled = {}
+  members = {}
+
+  with ZipFile(path) as zf:
+    for table, columns in tables.items():
+      member = _member_name(zf, table)
+      if member is None:
+        continue
+
+      info = zf.getinfo(member)
+      members[member] = [info.CRC, info.file_size]
+
+      if (previous is not None and table in previous and
+          previous.members.get(member) == members[member] and
+          all(name in previous[table] for name, kind, string_table in columns)):
+        # Unchanged, reuse it.
+        compiled[table] = previous[table]
+        continue
+
+      # We need to add strings to the tables this uses, so take a copy rather
+      # than changing the previous feed's tables.
+      for name, kind, string_table in columns:
+        if string_table in strings and string_table not in copied:
+          strings[string_table] = StringTable(strings[string_table].strings)
+          copied.add(string_table)
+
+      compiled[table] = compile_table(zf, member, columns, strings)
+      if table == 'stop_times':
+        compiled[table] = _sort_stop_times(compiled[table])
+
+  return Feed(compiled, strings, digest or file_digest(path), members)
+
+
+def load_gtfs(path, cache_dir, digest=None, previous=None):
+  """
+  Loads a GTFS zip file, using a compiled copy from ``cache_dir`` if there is
+  one, or compiling and caching it otherwise.
+
+  Compiled copies are named after the SHA-256 of the zip file.  If the zip
+  came from ``OpenData.cached_download``, its file name is already the SHA-256
+  and can be passed as ``digest`` to skip hashing it again.
+
+  If the zip needs to be compiled, unchanged tables are reused from the
+  ``previous`` feed (see ``compile_gtfs``).
+  """
+  if digest is None:
+    digest = file_digest(path)
+
+  if not exists(cache_dir):
+    makedirs(cache_dir)
+  cache_path = join(cache_dir, digest + CACHE_EXT)
+
+  if not exists(cache_path):
+    compile_gtfs(path, digest=digest, previous=previous).save(cache_path)
+
+  return Feed.open(cache_path)
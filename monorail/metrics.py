@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/metrics.py - Request metrics, tracing hooks and Prometheus export
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+import re
+from threading import Lock, Thread
+from time import time
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urlparse import urlsplit
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import urlsplit
+
+# Upper bounds of histogram buckets, in seconds.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300.)
+
+# Response headers which tell us about the request quota.  Any header starting
+# with one of these (case-insensitive) is recorded.
+RATE_LIMIT_HEADERS = ('x-ratelimit-', 'x-rate-limit-', 'ratelimit-', 'x-quota-', 'retry-after')
+
+# Parts of URL paths which are replaced, so endpoints are not one per resource.
+UUID = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def endpoint_name(url):
+  """
+  Gets the endpoint label for a URL: its path, with any UUIDs replaced.
+  """
+  return UUID.sub(':uuid', urlsplit(url).path)
+
+
+def rate_limit_headers(headers):
+  """
+  Picks the quota-related headers out of a response's headers.
+  """
+  return dict((k.lower(), v) for k, v in headers.items()
+              if k.lower().startswith(RATE_LIMIT_HEADERS))
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+  pairs = list(zip(names, values))
+  if extra:
+    pairs.append(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+
+class Histogram(object):
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    """
+    Counts observations into buckets, like a Prometheus histogram.  Not
+    thread-safe by itself; ``Metrics`` holds a lock around it.
+    """
+    self.buckets = tuple(buckets)
+    self.counts = [0] * len(self.buckets)
+    self.count = 0
+    self.sum = 0.
+
+
+  def observe(self, value):
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[i] += 1
+        break
+    self.count += 1
+    self.sum += value
+
+
+class Metrics(object):
+  # name -> (type, help text, label names)
+  FAMILIES = (
+    ('monorail_requests_total', 'counter', 'HTTP requests made.', ('endpoint', 'status')),
+    ('monorail_response_bytes_total', 'counter', 'Bytes of response bodies received.', ('endpoint',)),
+    ('monorail_retries_total', 'counter', 'Requests which were retried.', ('endpoint',)),
+    ('monorail_request_seconds', 'histogram', 'Time taken by HTTP requests.', ('endpoint',)),
+    ('monorail_rate_limit', 'gauge', 'Last value of each quota-related response header.', ('endpoint', 'header')),
+    ('monorail_fetch_seconds', 'histogram', 'Time taken by each fetch of a feed.', ('feed',)),
+    ('monorail_fetch_lag_seconds', 'histogram', 'How late each fetch of a feed started.', ('feed',)),
+    ('monorail_fetch_failures_total', 'counter', 'Failed fetches of a feed.', ('feed',)),
+    ('monorail_last_success_timestamp_seconds', 'gauge', 'When a feed was last fetched successfully.', ('feed',)),
+  )
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    """
+    Collects metrics about HTTP requests and feed fetches.
+
+    Every event is also passed to each hook added with ``add_hook``, so it can
+    be logged or sent elsewhere.  ``render`` gives all metrics in the
+    Prometheus text format, and ``serve`` makes them available over HTTP.
+    """
+    self.buckets = buckets
+    self._hooks = []
+    self._lock = Lock()
+    self._values = dict((name, {}) for name, kind, help, labels in self.FAMILIES)
+
+
+  def add_hook(self, hook):
+    """
+    Adds a callable which is called with ``(kind, event)`` for every event.
+
+    ``kind`` is ``'request'``, ``'retry'`` or ``'fetch'``, and ``event`` is a
+    dict of what happened (the same values as the arguments to the method
+    that recorded it).  Hooks are called on the thread that made the request,
+    so should be quick.
+    """
+    self._hooks.append(hook)
+
+
+  def remove_hook(self, hook):
+    self._hooks.remove(hook)
+
+
+  def _emit(self, kind, event):
+    for hook in self._hooks:
+      try:
+        hook(kind, event)
+      except Exception as e:
+        print('metrics hook failed (%s)' % e)
+
+
+  def _add(self, name, labels, value=1):
+    values = self._values[name]
+    values[labels] = values.get(labels, 0) + value
+
+
+  def _observe(self, name, labels, value):
+    values = self._values[name]
+    if labels not in values:
+      values[labels] = Histogram(self.buckets)
+    values[labels].observe(value)
+
+
+  def request(self, endpoint, status, latency, size=0, headers=None):
+    """
+    Records a HTTP request.
+
+    :param endpoint: Endpoint the request was made to, eg: from
+                     ``endpoint_name``.
+    :param status: HTTP status code, or None if the request failed.
+    :param latency: Seconds the request took.
+    :param size: Bytes of response body received.
+    :param headers: Response headers.  Quota-related ones are recorded.
+    """
+    limits = rate_limit_headers(headers or {})
+    with self._lock:
+      # Labels are all strings, so that they sort together.
+      self._add('monorail_requests_total', (endpoint, str(status) if status is not None else 'error'))
+      self._add('monorail_response_bytes_total', (endpoint,), size)
+      self._observe('monorail_request_seconds', (endpoint,), latency)
+      for header, value in limits.items():
+        try:
+          self._values['monorail_rate_limit'][(endpoint, header)] = float(value)
+        except ValueError:
+          pass
+
+    self._emit('request', dict(endpoint=endpoint, status=status, latency=latency,
+                               size=size, rate_limit=limits))
+
+
+  def retry(self, endpoint, reason=None):
+    """
+    Records that a request had to be made again (eg: after the session
+    expired, or a download was interrupted).
+    """
+    with self._lock:
+      self._add('monorail_retries_total', (endpoint,))
+    self._emit('retry', dict(endpoint=endpoint, reason=reason))
+
+
+  def fetch(self, feed, duration, lag=0., error=None):
+    """
+    Records one fetch of a feed.
+
+    :param feed: Name of the feed.
+    :param duration: Seconds the fetch took.
+    :param lag: Seconds between when the fetch was due and when it started.
+    :param error: Exception if the fetch failed.
+    """
+    with self._lock:
+      self._observe('monorail_fetch_seconds', (feed,), duration)
+      self._observe('monorail_fetch_lag_seconds', (feed,), max(0., lag))
+      if error is None:
+        self._values['monorail_last_success_timestamp_seconds'][(feed,)] = time()
+      else:
+        self._add('monorail_fetch_failures_total', (feed,))
+
+    self._emit('fetch', dict(feed=feed, duration=duration, lag=lag, error=error))
+
+
+  def render(self):
+    """
+    Gets all metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    with self._lock:
+      for name, kind, help, label_names in self.FAMILIES:
+        values = self._values[name]
+        if not values:
+          continue
+
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in sorted(values.items()):
+          if kind != 'histogram':
+            lines.append('%s%s %r' % (name, _labels(label_names, labels), float(value)))
+            continue
+
+          total = 0
+          for bound, count in zip(value.buckets, value.counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (name, _labels(label_names, labels, ('le', repr(bound))), total))
+          lines.append('%s_bucket%s %d' % (name, _labels(label_names, labels, ('le', '+Inf')), value.count))
+          lines.append('%s_sum%s %r' % (name, _labels(label_names, labels), value.sum))
+          lines.append('%s_count%s %d' % (name, _labels(label_names, labels), value.count))
+
+    return '\n'.join(lines) + '\n'
+
+
+  def serve(self, port, host=''):
+    """
+    Serves ``render()`` over HTTP (at any path) from a background thread.
+
+    Returns the server; call ``shutdown()`` on it to stop.
+    """
+    metrics = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+      daemon_threads = True
+      allow_reuse_address = True
+
+    server = Server((host, port), Handler)
+    thread = Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
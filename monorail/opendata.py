@@ -17,7 +17,14 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
+from .cache import DEFAULT_CACHE_SIZE, DownloadCache
+from .metrics import endpoint_name
+from os import remove
+from os.path import exists
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+from threading import Lock, Thread
 from time import time
 
 OPENDATA_ROOT = 'https://opendata.transport.nsw.gov.au/'
@@ -39,9 +46,179 @@ DIRECT_FACILITIES = 'Location_Facilities_Data.zip'
 DIRECT_PARKING = 'OffstreetparkingData.zip'
 DIRECT_LOADING = 'LoadingzoneData.zip'
 
+# How long (in seconds) a session is trusted after it was last confirmed valid,
+# before we ask sessionCheck again.
+SESSION_LIFETIME = 60
+
+# Size of each chunk read when streaming downloads to disk.
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Number of times to resume a download after the connection drops.
+DOWNLOAD_RETRIES = 5
+
+# Number of results to ask for in each page of an OData query.
+PAGE_SIZE = 50
+
+CATALOG_SELECT = 'Uuid,Name,Description,SsgUrl'
+CATALOG_FILTER = 'SpecFilesize gt 0 and PortalStatus eq \'ENABLED\''
+APPLICATION_SELECT = 'Uuid,Name,Description,ApiKey,KeySecret'
+APPLICATION_FILTER = 'Status eq \'ENABLED\''
+
+
+class MeteredSession(requests.Session):
+  def __init__(self, metrics):
+    """
+    ``requests.Session`` which records every request in a
+    ``monorail.metrics.Metrics``.
+
+    Response sizes are counted as the body is read, so streamed downloads are
+    counted correctly (when the response is closed or fully read).
+    """
+    requests.Session.__init__(self)
+    self.metrics = metrics
+
+
+  def request(self, method, url, *args, **kwargs):
+    endpoint = endpoint_name(url)
+    start = time()
+    try:
+      response = requests.Session.request(self, method, url, *args, **kwargs)
+    except requests.RequestException:
+      self.metrics.request(endpoint, None, time() - start)
+      raise
+
+    if not kwargs.get('stream'):
+      self.metrics.request(endpoint, response.status_code, time() - start,
+                           len(response.content), response.headers)
+      return response
+
+    # Streamed: record once the body has been read.
+    metrics = self.metrics
+    iter_content = response.iter_content
+    state = dict(size=0, recorded=False)
+
+    def record():
+      if not state['recorded']:
+        state['recorded'] = True
+        metrics.request(endpoint, response.status_code, time() - start,
+                        state['size'], response.headers)
+
+    def metered_iter_content(*args, **kwargs):
+      for chunk in iter_content(*args, **kwargs):
+        state['size'] += len(chunk)
+        yield chunk
+      record()
+
+    close = response.close
+
+    def metered_close():
+      record()
+      close()
+
+    response.iter_content = metered_iter_content
+    response.close = metered_close
+    return response
+
+
+class Pages(object):
+  def __init__(self, fetch, page_size=PAGE_SIZE):
+    """
+    Iterates over the results of an OData query, a page at a time.
+
+    The first page is requested straight away, so ``total`` is known before
+    iterating (if the server gives a count; otherwise it is None, and pages
+    are fetched until one comes back short).  While the caller works through
+    one page, the next is fetched in the background.
+
+    :param fetch: Callable taking ``(skip, top)`` and returning a tuple of
+                  the results and the total count (or None if unknown).
+    :param page_size: Number of results in each page.
+    """
+    self._fetch = fetch
+    self.page_size = page_size
+    self._first, self.total = fetch(0, page_size)
+
+
+  def _prefetch(self, skip):
+    """
+    Starts fetching the page at ``skip`` in a background thread.  Returns a
+    callable which waits for it.
+    """
+    result = {}
+
+    def run():
+      try:
+        result['page'] = self._fetch(skip, self.page_size)[0]
+      except Exception as e:
+        result['error'] = e
+
+    thread = Thread(target=run, name='odata page %d' % skip)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+      thread.join()
+      if 'error' in result:
+        raise result['error']
+      return result['page']
+    return wait
+
+
+  def __iter__(self):
+    page = self._first
+    skip = 0
+    while page:
+      skip += len(page)
+      if self.total is not None:
+        # The server may give back fewer than we asked for in each page.
+        more = skip < self.total
+      else:
+        more = len(page) >= self.page_size
+      pending = self._prefetch(skip) if more else None
+
+      for row in page:
+        yield row
+
+      if pending is None:
+        return
+      page = pending()
+
+
+def _content_range(headers):
+  """
+  Parses a Content-Range header (eg: ``bytes 1000-1999/2000`` or
+  ``bytes */2000``).
+
+  Returns a tuple of the first byte and the total size of the file, either of
+  which may be None if not given.
+  """
+  value = headers.get('Content-Range', '').strip()
+  if not value.startswith('bytes '):
+    return None, None
+  span, _, size = value[6:].partition('/')
+  try:
+    first = int(span.split('-', 1)[0]) if span.strip() != '*' else None
+    total = int(size) if size.strip() != '*' else None
+  except ValueError:
+    return None, None
+  return first, total
+
+
+def _validator(headers):
+  """
+  Gets a validator for If-Range from a response's headers: a strong ETag, or
+  the Last-Modified date.
+  """
+  etag = headers.get('ETag')
+  if etag and not etag.startswith('W/'):
+    return etag
+  return headers.get('Last-Modified')
+
 
 class OpenData(object):
-  def __init__(self, username, password):
+  def __init__(self, username, password, session_lifetime=SESSION_LIFETIME,
+               cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, pool_size=None,
+               root=OPENDATA_ROOT, metrics=None):
     """
     Creates a session for working with the Transport for NSW Open Data portal.
 
@@ -49,11 +226,40 @@ class OpenData(object):
 
     :param username: The username to use when authenticating to the portal.
     :param password: The password to use when authenticating to the portal.
+    :param session_lifetime: Number of seconds to trust the session after it
+                             was last confirmed valid, without calling
+                             ``session_check`` again.
+    :param cache_dir: Directory to cache static resources in.  If not given,
+                      ``cached_download`` is unavailable.
+    :param cache_size: Maximum size of the cache, in bytes.
+    :param pool_size: Number of connections to keep open to the portal.  Set
+                      this to the number of threads if the ``OpenData`` is
+                      shared between threads.
+    :param root: URL of the portal, with a trailing slash.  Change this to
+                 talk to a different server (eg:
+                 ``monorail.tools.mock_portal``).
+    :param metrics: ``monorail.metrics.Metrics`` to record every request and
+                    retry in.
     """
     self._username = username
     self._password = password
-    self._session = requests.Session()
+    self._session = MeteredSession(metrics) if metrics else requests.Session()
+    self._metrics = metrics
     self._session.headers = STD_HEADERS
+    self._root = root
+    if pool_size:
+      self._session.mount(root, HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    self._session_lock = Lock()
+    self._session_lifetime = session_lifetime
+    self._session_confirmed = None
+    self._cache = DownloadCache(cache_dir, cache_size) if cache_dir else None
+
+
+  def _url(self, url):
+    """
+    Points one of the ``OPENDATA_*`` URLs at this portal's root.
+    """
+    return self._root + url[len(OPENDATA_ROOT):]
 
 
   def session_check(self):
@@ -65,10 +271,88 @@ class OpenData(object):
     
     Returns True if they are valid, False otherwise.
     """
-    response = self._session.get(OPENDATA_SESSION_CHECK, allow_redirects=False)
-    
-    return response.status_code == 200
-    
+    response = self._session.get(self._url(OPENDATA_SESSION_CHECK), allow_redirects=False)
+
+    if response.status_code == 200:
+      self._session_confirmed = time()
+      return True
+
+    self._session_confirmed = None
+    return False
+
+
+  def session_fresh(self):
+    """
+    Returns True if the session was confirmed valid recently enough that we
+    don't need to check it again.
+    """
+    return (self._session_confirmed is not None and
+            (time() - self._session_confirmed) < self._session_lifetime)
+
+
+  def invalidate_session(self):
+    """
+    Forgets that the session was valid, so the next request will check it.
+    """
+    self._session_confirmed = None
+
+
+  def _ensure_session(self):
+    """
+    Makes sure we have a valid session, logging in if required.
+
+    This skips the round-trip to ``sessionCheck`` if the session was confirmed
+    within the last ``session_lifetime`` seconds.
+    """
+    if self.session_fresh():
+      return
+
+    with self._session_lock:
+      # Another thread may have logged in while we were waiting.
+      if self.session_fresh():
+        return
+
+      if not self.session_check():
+        self.login()
+        assert self.session_check()
+
+
+  def _session_expired(self, response):
+    """
+    Returns True if the response shows the server has thrown away our session
+    (we got bounced to the login form, or were unauthorised).
+    """
+    if response.status_code in (401, 403):
+      return True
+
+    if response.status_code in (301, 302, 303, 307):
+      return response.headers.get('Location', '').startswith(self._url(OPENDATA_LOGIN_FORM))
+
+    return False
+
+
+  def _request(self, url, **kwargs):
+    """
+    Makes a GET request to the portal with a valid session.
+
+    If the server reports that our session has expired, we authenticate again
+    and retry the request once.
+    """
+    kwargs.setdefault('allow_redirects', False)
+    self._ensure_session()
+    response = self._session.get(url, **kwargs)
+
+    if self._session_expired(response):
+      if self._metrics:
+        self._metrics.retry(endpoint_name(url), 'session expired')
+      # Give the connection back to the pool (if it was streamed).
+      response.close()
+      self.invalidate_session()
+      self._ensure_session()
+      response = self._session.get(url, **kwargs)
+
+    return response
+
 
   def login(self, username=None, password=None):
     """
@@ -93,10 +377,10 @@ class OpenData(object):
 
     # https://opendata.transport.nsw.gov.au/admin/j_spring_security_check
     # takes POST parameter "username" and "password"
-    response = self._session.post(OPENDATA_LOGIN_URL, params=dict(username=username, password=password), allow_redirects=False)
+    response = self._session.post(self._url(OPENDATA_LOGIN_URL), params=dict(username=username, password=password), allow_redirects=False)
     
     assert response.status_code == 302
-    if response.headers['Location'].startswith(OPENDATA_LOGIN_FORM):
+    if response.headers['Location'].startswith(self._url(OPENDATA_LOGIN_FORM)):
       # Login probably incorrect
       raise Exception, 'Invalid authentication details.'
 
@@ -107,6 +391,52 @@ class OpenData(object):
     self._username = username
     self._password = password
 
+    # Logging in gives us a new session, which needs to go through
+    # sessionCheck to pick up the "gateaugage" cookie.
+    self._session_confirmed = None
+
+
+  def _odata(self, url, select, filter, skip, top):
+    """
+    Gets one page of an OData query.
+
+    Returns a tuple of the results and the total count (or None if the server
+    didn't give one).
+    """
+    response = self._request(self._url(url), params={
+      '$select': select,
+      '$inlinecount': 'allpages',
+      '$filter': filter,
+      '$skip': skip,
+      '$top': top,
+    }, headers=JSON_HEADER)
+
+    result = response.json()
+
+    if 'd' not in result:
+      return [], 0
+
+    count = result['d'].get('__count')
+    return result['d']['results'], (int(count) if count is not None else None)
+
+
+  def iter_catalogs(self, select=CATALOG_SELECT, filter=None, page_size=PAGE_SIZE):
+    """
+    Gets the catalogue of APIs from the portal, a page at a time.
+
+    Returns a ``Pages``, which can be iterated over as results arrive (see
+    ``catalogs`` for what each result looks like).  Its ``total`` is the
+    number of APIs.
+
+    :param select: Comma-separated fields to get for each API.
+    :param filter: OData condition to only select some APIs, eg:
+                   ``"substringof('gtfs', SsgUrl)"``.
+    :param page_size: Number of APIs to get in each request.
+    """
+    filter = CATALOG_FILTER + (' and (%s)' % filter if filter else '')
+    return Pages(lambda skip, top: self._odata(
+      OPENDATA_CATALOGS, select, filter, skip, top), page_size)
+
 
   def catalogs(self):
     """
@@ -121,22 +451,7 @@ class OpenData(object):
         'Uuid': The API's UUID.
       }
     """
-    if not self.session_check():
-      self.login()
-      assert self.session_check()
-
-    response = self._session.get(OPENDATA_CATALOGS, params={
-      '$select': 'Uuid,Name,Description,SsgUrl',
-      '$inlinecount': 'allpages',
-      '$filter': 'SpecFilesize gt 0 and PortalStatus eq \'ENABLED\''
-    }, headers=JSON_HEADER, allow_redirects=False)
-
-    result = response.json()
-    
-    if 'd' not in result:
-      return []
-
-    return result['d']['results']
+    return list(self.iter_catalogs())
 
 
   def swagger(self, api_uuid):
@@ -147,82 +462,287 @@ class OpenData(object):
     https://github.com/OAI/OpenAPI-Specification/blob/master/versions/2.0.md
     """
     api_uuid = str(api_uuid)
-    if not self.session_check():
-      self.login()
-      assert self.session_check()
-
-    response = self._session.get((OPENDATA_SWAGGER % api_uuid), headers=JSON_HEADER, allow_redirects=False)
+    response = self._request(self._url(OPENDATA_SWAGGER % api_uuid), headers=JSON_HEADER)
     result = response.json()
     return result
 
 
+  def iter_applications(self, api_uuid=None, select=APPLICATION_SELECT, filter=None,
+                        page_size=PAGE_SIZE):
+    """
+    Gets the applications (API keys), a page at a time.
+
+    Returns a ``Pages``, which can be iterated over as results arrive.  Its
+    ``total`` is the number of applications.
+
+    :param api_uuid: Only select applications which have the following API UUID enabled for them.
+    :param select: Comma-separated fields to get for each application.
+    :param filter: OData condition to only select some applications.
+    :param page_size: Number of applications to get in each request.
+    """
+    filter = ((('ApiUuid eq %r and ' % str(api_uuid)) if api_uuid else '') +
+              APPLICATION_FILTER + (' and (%s)' % filter if filter else ''))
+    return Pages(lambda skip, top: self._odata(
+      OPENDATA_APPLICATIONS, select, filter, skip, top), page_size)
+
+
   def applications(self, api_uuid=None):
     """
     Gets a list of applications (API keys).
     
     :param api_uuid: Only select applications which have the following API UUID enabled for them.
     """
-    if not self.session_check():
-      self.login()
-      assert self.session_check()
-    
-    response = self._session.get(OPENDATA_APPLICATIONS, params={
-      '$select': 'Uuid,Name,Description,ApiKey,KeySecret',
-      '$inlinecount': 'allpages',
-      '$filter': ((('ApiUuid eq %r and ' % str(api_uuid)) if api_uuid else '') +
-                  'Status eq \'ENABLED\'')
-    }, headers=JSON_HEADER, allow_redirects=False)
-    
-    result = response.json()
-    
-    if 'd' not in result:
-      return []
-
-    return result['d']['results']
+    return list(self.iter_applications(api_uuid))
 
 
   def direct_download(self, filename):
     """
     Allows direct downloads of static resources.
     """
-    if not self.session_check():
-      self.login()
-      assert self.session_check()
+    return self._request(self._url(OPENDATA_DIRECT + filename))
+
+
+  def download(self, filename, output, resume=False, chunk_size=DOWNLOAD_CHUNK_SIZE,
+               retries=DOWNLOAD_RETRIES, progress=None):
+    """
+    Downloads a static resource, streaming it to a file in chunks so that it is
+    never held in memory all at once.
+
+    If the connection drops part way through, the download is continued from
+    where it left off with a HTTP Range request.  The request has an If-Range
+    header with the file's ETag (or Last-Modified date), so if the file changed
+    in the mean time, the server sends all of it again instead.
+
+    Returns the size of the file, in bytes.
+
+    :param filename: Name of the resource to download, eg: ``DIRECT_GTFS``.
+    :param output: Path to write the file to, or a file-like object opened in
+                   binary mode.
+    :param resume: If ``output`` is a path to a partially downloaded file,
+                   continue the download from the end of that file rather than
+                   starting again.  There is nothing to tell whether the file
+                   on the server has changed since that part was downloaded
+                   (other than its size), so only use this if it is known not
+                   to have.
+    :param chunk_size: Number of bytes to read and write at a time.
+    :param retries: Number of times to resume after the connection drops.
+    :param progress: Callable which is called after each chunk with the number
+                     of bytes downloaded so far, the total size of the file (or
+                     None if unknown), and the throughput in bytes per second.
+    """
+    if hasattr(output, 'write'):
+      return self._download_to(filename, output, 0, chunk_size, retries, progress)[0]
+
+    if resume and exists(output):
+      with open(output, 'r+b') as f:
+        f.seek(0, 2)
+        return self._download_to(filename, f, f.tell(), chunk_size, retries, progress)[0]
+
+    with open(output, 'wb') as f:
+      return self._download_to(filename, f, 0, chunk_size, retries, progress)[0]
+
+
+  def cached_download(self, filename, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                      retries=DOWNLOAD_RETRIES, progress=None):
+    """
+    Downloads a static resource into the cache, unless the cached copy is
+    still current.
 
-    return self._session.get(OPENDATA_DIRECT + filename, allow_redirects=False)
+    This makes a conditional request with the ETag and Last-Modified date of
+    the cached copy, so if the server replies 304 Not Modified, nothing is
+    downloaded.
 
+    Returns the path to the cached file.  This requires that the ``OpenData``
+    was created with a ``cache_dir``.
 
-  def direct_gtfs(self):
+    Other parameters are the same as for ``download``.
+    """
+    assert self._cache is not None, 'cache_dir is required for cached downloads'
+
+    tmp = self._cache.temp_file()
+    try:
+      with open(tmp, 'wb') as f:
+        done, headers = self._download_to(filename, f, 0, chunk_size, retries,
+          progress, self._cache.conditional_headers(filename))
+
+      if done is None:
+        # 304 Not Modified, use what we have.
+        return self._cache.touch(filename)
+
+      return self._cache.store(filename, tmp, headers)
+    finally:
+      if exists(tmp):
+        remove(tmp)
+
+
+  def _download_to(self, filename, f, done, chunk_size, retries, progress, conditional=None):
+    """
+    Streams a static resource into an open file, starting at byte ``done``.
+
+    Returns a tuple of the size of the file and the response headers.  If
+    ``conditional`` headers are given and the server replies 304 Not Modified,
+    the size is None.
+    """
+    url = self._url(OPENDATA_DIRECT + filename)
+    base = f.tell() - done
+    started = time()
+    start_bytes = done
+    total = None
+    response_headers = {}
+    # ETag or Last-Modified of the file we are receiving, for If-Range.
+    validator = None
+
+    def restart():
+      f.seek(base)
+      f.truncate()
+      return 0, time()
+
+    while True:
+      # Conditional headers only go on the first request.  Once we have
+      # started receiving the file, we are just resuming it.
+      headers = dict(conditional or {})
+      conditional = None
+      if done:
+        headers['Range'] = 'bytes=%d-' % done
+        if validator:
+          headers['If-Range'] = validator
+
+      response = self._request(url, headers=headers, stream=True)
+      try:
+        if response.status_code == 304:
+          return None, response.headers
+
+        if done and response.status_code == 416:
+          # Content-Range: bytes */2000
+          if _content_range(response.headers)[1] == done:
+            # We already have the whole file.
+            return done, response_headers
+
+          # What we have isn't a prefix of the file, so start again.
+          done, started = restart()
+          start_bytes = 0
+          continue
+
+        assert response.status_code in (200, 206), 'unexpected response code (%d)' % response.status_code
+
+        if response.status_code == 206:
+          # Content-Range: bytes 1000-1999/2000
+          first, total = _content_range(response.headers)
+          if first != done:
+            # Not the part we asked for, so start again.
+            assert done, 'unexpected Content-Range (%s)' % response.headers.get('Content-Range')
+            done, started = restart()
+            start_bytes = 0
+            total = None
+            continue
+        else:
+          if done:
+            # The server ignored our Range header (or the file changed), so
+            # start again.
+            done, started = restart()
+            start_bytes = 0
+
+          if 'Content-Length' in response.headers:
+            total = int(response.headers['Content-Length'])
+          response_headers = response.headers
+          validator = _validator(response.headers)
+
+        for chunk in response.iter_content(chunk_size):
+          f.write(chunk)
+          done += len(chunk)
+
+          if progress:
+            elapsed = time() - started
+            progress(done, total, ((done - start_bytes) / elapsed) if elapsed else 0.)
+
+        if total is None or done >= total:
+          f.flush()
+          return done, response_headers
+
+        # The server closed the connection early.
+      except (ChunkedEncodingError, ConnectionError, Timeout):
+        pass
+      finally:
+        response.close()
+
+      if retries <= 0:
+        raise Exception, 'Download of %s failed after %d of %r bytes.' % (filename, done, total)
+      retries -= 1
+      if self._metrics:
+        self._metrics.retry(endpoint_name(url), 'download interrupted')
+
+
+  def direct_gtfs(self, output=None, **kwargs):
     """
     Requests the static GTFS data.
+
+    If ``output`` is given, the data is streamed into it with ``download``.
+    Otherwise, if a ``cache_dir`` was given, the path to the cached copy from
+    ``cached_download`` is returned.
     """
+    if output is not None:
+      return self.download(DIRECT_GTFS, output, **kwargs)
+    if self._cache is not None:
+      return self.cached_download(DIRECT_GTFS, **kwargs)
     return self.direct_download(DIRECT_GTFS)
 
 
-  def direct_txc(self):
+  def direct_txc(self, output=None, **kwargs):
     """
     Requests the TransXChange data.
+
+    If ``output`` is given, the data is streamed into it with ``download``.
+    Otherwise, if a ``cache_dir`` was given, the path to the cached copy from
+    ``cached_download`` is returned.
     """
+    if output is not None:
+      return self.download(DIRECT_TXC, output, **kwargs)
+    if self._cache is not None:
+      return self.cached_download(DIRECT_TXC, **kwargs)
     return self.direct_download(DIRECT_TXC)
 
     
-  def direct_facilities(self):
+  def direct_facilities(self, output=None, **kwargs):
     """
     Requests the Facilities and Operators data.
+
+    If ``output`` is given, the data is streamed into it with ``download``.
+    Otherwise, if a ``cache_dir`` was given, the path to the cached copy from
+    ``cached_download`` is returned.
     """
+    if output is not None:
+      return self.download(DIRECT_FACILITIES, output, **kwargs)
+    if self._cache is not None:
+      return self.cached_download(DIRECT_FACILITIES, **kwargs)
     return self.direct_download(DIRECT_FACILITIES)
 
   
-  def direct_parking(self):
+  def direct_parking(self, output=None, **kwargs):
     """
     Requests the Off-street Parking data.
+
+    If ``output`` is given, the data is streamed into it with ``download``.
+    Otherwise, if a ``cache_dir`` was given, the path to the cached copy from
+    ``cached_download`` is returned.
     """
+    if output is not None:
+      return self.download(DIRECT_PARKING, output, **kwargs)
+    if self._cache is not None:
+      return self.cached_download(DIRECT_PARKING, **kwargs)
     return self.direct_download(DIRECT_PARKING)
 
 
-  def direct_loading(self):
+  def direct_loading(self, output=None, **kwargs):
     """
     Requests the Loading Zone data.
+
+    If ``output`` is given, the data is streamed into it with ``download``.
+    Otherwise, if a ``cache_dir`` was given, the path to the cached copy from
+    ``cached_download`` is returned.
     """
+    if output is not None:
+      return self.download(DIRECT_LOADING, output, **kwargs)
+    if self._cache is not None:
+      return self.cached_download(DIRECT_LOADING, **kwargs)
     return self.direct_download(DIRECT_LOADING)
 
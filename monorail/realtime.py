@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/realtime.py - Client for the TfNSW API, driven by a swaggify schema
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .credentials import CredentialPool
+from .opendata import MeteredSession
+
+from json import load
+from os import write
+import re
+import requests
+from requests.adapters import HTTPAdapter
+
+# Size of each chunk read when streaming a payload.
+CHUNK_SIZE = 256 * 1024
+
+# Number of connections to keep open to the API server.
+DEFAULT_POOL_SIZE = 10
+
+STD_HEADERS = {'User-Agent': 'monorail/0.1'}
+
+
+def method_name(operation_id):
+  """
+  Turns an operationId into the method name swagger-codegen would give it, eg:
+  ``vehiclePositions`` -> ``vehicle_positions``.
+  """
+  return re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', operation_id).lower()
+
+
+class RealtimeClient(object):
+  def __init__(self, schema, tokens, root=None, pool_size=DEFAULT_POOL_SIZE, metrics=None):
+    """
+    Client for the GET operations in a Swagger schema (made by ``swaggify``),
+    sharing one pool of keep-alive connections.
+
+    Operations are named the same way as in the generated ``tfnsw_api``
+    bindings: by their tag (eg: ``sydneytrains``) and the snake_case of their
+    operationId (eg: ``vehicle_positions``).
+
+    Payloads are returned as bytes (with ``get``), or streamed into a file
+    (with ``download``), rather than going through a temporary file.
+
+    :param schema: Path to the schema, a file-like object, or the parsed
+                   schema as a dict.
+    :param tokens: ``monorail.tokens.TokenManager`` to authenticate with,
+                   or a ``monorail.credentials.CredentialPool`` whose keys
+                   each have a ``TokenManager`` as their ``tokens``, to
+                   spread requests across.
+    :param root: URL to make requests to instead of the schema's host and
+                 basePath (eg: ``monorail.tools.mock_portal``).
+    :param pool_size: Number of connections to keep open.  Set this to the
+                      number of threads sharing the client.
+    :param metrics: ``monorail.metrics.Metrics`` to record every request in.
+    """
+    if not isinstance(schema, dict):
+      if hasattr(schema, 'read'):
+        schema = load(schema)
+      else:
+        with open(schema, 'rb') as f:
+          schema = load(f)
+
+    assert schema['swagger'] == '2.0'
+    if root is None:
+      root = '%s://%s%s' % ((schema.get('schemes') or ['https'])[0], schema['host'],
+                            schema.get('basePath', ''))
+    self.root = root.rstrip('/')
+    # Otherwise _request would have no key to make requests with.
+    assert not isinstance(tokens, CredentialPool) or len(tokens), 'the CredentialPool has no API keys'
+    self.tokens = tokens
+
+    # (tag, method) -> path
+    self.operations = {}
+    for path, handler in schema['paths'].items():
+      action = handler.get('get')
+      if action is None or 'operationId' not in action:
+        continue
+      for tag in action.get('tags') or ():
+        self.operations[(tag, method_name(action['operationId']))] = path
+
+    self._session = MeteredSession(metrics) if metrics else requests.Session()
+    self._session.headers.update(STD_HEADERS)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self._session.mount('http://', adapter)
+    self._session.mount('https://', adapter)
+
+
+  def url(self, tag, method, **params):
+    """
+    Gets the URL of an operation.  Path parameters (``{name}``) are filled in
+    from ``params``.
+    """
+    try:
+      path = self.operations[(tag, method)]
+    except KeyError:
+      raise KeyError('no operation %s.%s in schema' % (tag, method))
+    return self.root + path.format(**params)
+
+
+  def _request(self, url, params, stream):
+    """
+    Makes an authenticated GET request, getting a new token and retrying once
+    if the server rejects ours.
+    """
+    if not isinstance(self.tokens, CredentialPool):
+      return self._check(self._authenticated(self.tokens, url, params, stream))
+
+    # Use the least loaded key, and tell the pool how it went.  If the key is
+    # over quota, try another which isn't.
+    for attempt in range(len(self.tokens)):
+      credential = self.tokens.acquire()
+      response = None
+      try:
+        response = self._authenticated(credential.tokens, url, params, stream)
+      finally:
+        if response is None:
+          self.tokens.release(credential)
+        else:
+          self.tokens.release(credential, response.status_code, response.headers)
+
+      if response.status_code != 429 or not self.tokens.available():
+        break
+      response.close()
+    return self._check(response)
+
+
+  def _authenticated(self, tokens, url, params, stream):
+    response = self._session.get(url, params=params, stream=stream,
+      headers={'Authorization': tokens.header()})
+
+    if response.status_code == 401:
+      response.close()
+      tokens.refresh(force=True)
+      response = self._session.get(url, params=params, stream=stream,
+        headers={'Authorization': tokens.header()})
+    return response
+
+
+  def _check(self, response):
+    if response.status_code != 200:
+      response.close()
+      response.raise_for_status()
+      raise requests.HTTPError('unexpected response code (%d)' % response.status_code,
+                               response=response)
+    return response
+
+
+  def get(self, tag, method, **params):
+    """
+    Calls an operation, returning the payload as bytes.
+
+    Raises ``requests.HTTPError`` if the server doesn't return 200 OK.
+    Parameters not used in the path are sent as query parameters.
+    """
+    url = self.url(tag, method, **params)
+    query = dict((k, v) for k, v in params.items() if '{%s}' % k not in self.operations[(tag, method)])
+    return self._request(url, query, False).content
+
+
+  def download(self, tag, method, output, chunk_size=CHUNK_SIZE, **params):
+    """
+    Calls an operation, streaming the payload into ``output`` as it arrives.
+
+    Returns the number of bytes written.
+
+    :param output: A file-like object opened in binary mode, or a file
+                   descriptor.
+    """
+    url = self.url(tag, method, **params)
+    query = dict((k, v) for k, v in params.items() if '{%s}' % k not in self.operations[(tag, method)])
+    response = self._request(url, query, True)
+    size = 0
+    try:
+      for chunk in response.iter_content(chunk_size):
+        if isinstance(output, int):
+          view = memoryview(chunk)
+          while view:
+            view = view[write(output, view):]
+        else:
+          output.write(chunk)
+        size += len(chunk)
+    finally:
+      response.close()
+    return size
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/relay.py - Serves the latest realtime snapshots to many readers
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .snapshot import MANIFEST_FILE
+
+from email.utils import formatdate
+from json import dumps, load
+from os.path import exists, join
+from threading import Condition, Lock, Thread
+from time import sleep, time
+import zlib
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urlparse import parse_qs, urlsplit
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import parse_qs, urlsplit
+
+# Longest a reader may wait for a new snapshot, in seconds.
+MAX_WAIT = 300
+
+# Send a comment to event stream readers this often, in seconds, so proxies
+# don't close the connection.
+KEEPALIVE = 15
+
+# How often to check the manifest when following a directory, in seconds.
+FOLLOW_INTERVAL = .25
+
+GZIP_LEVEL = 6
+
+
+class Snapshot(object):
+  def __init__(self, name, data, sequence, timestamp=None):
+    """
+    One version of a feed, held in memory.
+
+    The gzipped copy is only made when a reader first asks for it, and then
+    kept for every other reader.
+    """
+    self.name = name
+    self.data = data
+    self.sequence = sequence
+    self.timestamp = timestamp
+    self.etag = '"%d"' % sequence
+    self.published = time()
+    self._gzip = None
+    self._lock = Lock()
+
+
+  def gzipped(self):
+    with self._lock:
+      if self._gzip is None:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._gzip = compressor.compress(self.data) + compressor.flush()
+      return self._gzip
+
+
+  def info(self):
+    return dict(name=self.name, sequence=self.sequence, timestamp=self.timestamp,
+                size=len(self.data), published=self.published)
+
+
+class Relay(object):
+  def __init__(self):
+    """
+    Keeps the latest snapshot of every feed in memory, and serves them over
+    HTTP to any number of readers.
+
+    Snapshots are given to the relay with ``publish`` (``SnapshotWriter``
+    does this when given a ``relay``), or read from another process's output
+    directory with ``follow``.
+
+    HTTP endpoints:
+
+    ``/feeds``
+      JSON index of the current snapshots.
+
+    ``/feeds/<name>``
+      The latest snapshot of a feed.  The ETag is its sequence number, so
+      ``If-None-Match`` gives 304 Not Modified if it hasn't changed.  Add
+      ``?wait=<seconds>`` to wait for the next version instead (long poll),
+      or ``?after=<sequence>`` to wait for a version newer than that.
+      Snapshots are gzipped if the reader accepts it.
+
+    ``/events``
+      Server-sent events: one ``update`` event (JSON, like ``/feeds``) for
+      each new snapshot, with the sequence number as the event ID.  Use
+      ``?feeds=a,b`` to only get some feeds.
+    """
+    self._snapshots = {}
+    self._changed = Condition()
+    self.sequence = 0
+
+
+  def publish(self, name, data, sequence=None, timestamp=None):
+    """
+    Makes a snapshot the latest version of a feed, and wakes up any readers
+    waiting for it.
+
+    :param sequence: Sequence number of the snapshot (eg: from the
+                     manifest).  Must increase with every publish.  By
+                     default, one more than the last.
+    """
+    with self._changed:
+      if sequence is None:
+        sequence = self.sequence + 1
+      self.sequence = max(self.sequence, sequence)
+      self._snapshots[name] = Snapshot(name, data, sequence, timestamp)
+      self._changed.notify_all()
+
+
+  def get(self, name):
+    """
+    Gets the latest ``Snapshot`` of a feed, or None.
+    """
+    return self._snapshots.get(name)
+
+
+  def index(self):
+    """
+    Gets a dict of feed name -> ``Snapshot.info()``.
+    """
+    return dict((name, snapshot.info()) for name, snapshot in list(self._snapshots.items()))
+
+
+  def wait(self, name, after=0, etag=None, timeout=MAX_WAIT):
+    """
+    Waits for a snapshot of a feed newer than sequence ``after`` (and not
+    matching ``etag``).
+
+    Returns the snapshot, or None if there wasn't one in time.
+    """
+    deadline = time() + timeout
+    with self._changed:
+      while True:
+        snapshot = self._snapshots.get(name)
+        if snapshot is not None and snapshot.sequence > after and snapshot.etag != etag:
+          return snapshot
+        remaining = deadline - time()
+        if remaining <= 0:
+          return None
+        self._changed.wait(remaining)
+
+
+  def updates(self, after=0, names=None, timeout=KEEPALIVE):
+    """
+    Waits for snapshots newer than sequence ``after``, and returns them in
+    order (or an empty list, after ``timeout`` seconds).
+
+    :param names: Only include these feeds.
+    """
+    deadline = time() + timeout
+    with self._changed:
+      while True:
+        found = [snapshot for name, snapshot in self._snapshots.items()
+                 if snapshot.sequence > after and (names is None or name in names)]
+        if found:
+          return sorted(found, key=lambda snapshot: snapshot.sequence)
+        remaining = deadline - time()
+        if remaining <= 0:
+          return []
+        self._changed.wait(remaining)
+
+
+  def follow(self, output_dir, interval=FOLLOW_INTERVAL):
+    """
+    Publishes new realtime snapshots written to ``output_dir`` by another
+    process (eg: ``gtfs_realtime``), by watching its manifest.  Runs forever.
+    """
+    manifest_path = join(output_dir, MANIFEST_FILE)
+    seen = {}
+
+    while True:
+      if exists(manifest_path):
+        try:
+          with open(manifest_path, 'rb') as f:
+            manifest = load(f)
+        except ValueError:
+          manifest = dict(files={})
+
+        for name, entry in sorted(manifest['files'].items(), key=lambda item: item[1]['sequence']):
+          if entry['timestamp'] is None or seen.get(name) == entry['sequence']:
+            continue
+          try:
+            with open(join(output_dir, name), 'rb') as f:
+              data = f.read()
+          except IOError:
+            # Replaced as we looked; we'll get it next time.
+            continue
+          seen[name] = entry['sequence']
+          self.publish(name, data, entry['sequence'], entry['timestamp'])
+
+      sleep(interval)
+
+
+  def serve(self, port, host=''):
+    """
+    Serves the snapshots over HTTP from background threads.
+
+    Returns the server; call ``shutdown()`` on it to stop.
+    """
+    server = _Server((host, port), _Handler)
+    server.relay = self
+    thread = Thread(target=server.serve_forever, name='relay')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+
+  def _send(self, status, body=b'', headers=None):
+    self.send_response(status)
+    for k, v in (headers or {}).items():
+      self.send_header(k, v)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def do_GET(self):
+    relay = self.server.relay
+    url = urlsplit(self.path)
+    query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+
+    if url.path == '/feeds':
+      self._send(200, dumps(relay.index()).encode('utf-8'), {'Content-Type': 'application/json'})
+    elif url.path.startswith('/feeds/'):
+      self._feed(relay, url.path[len('/feeds/'):], query)
+    elif url.path == '/events':
+      self._events(relay, query)
+    else:
+      self._send(404, b'Not Found')
+
+
+  def _feed(self, relay, name, query):
+    etag = self.headers.get('If-None-Match')
+    try:
+      wait = float(query.get('wait', 0))
+      after = int(query.get('after', 0))
+    except ValueError:
+      wait = after = None
+    # Also catches NaN.
+    if wait is None or not wait >= 0:
+      self._send(400, b'Bad Request')
+      return
+    wait = min(MAX_WAIT, wait)
+
+    snapshot = relay.get(name)
+    if wait and etag is None and not after and snapshot is not None:
+      # Nothing to compare with, so wait for the next version.
+      after = snapshot.sequence
+
+    if wait or (after and (snapshot is None or snapshot.sequence <= after)):
+      snapshot = relay.wait(name, after, etag, wait or MAX_WAIT)
+      if snapshot is None:
+        # Nothing new in time.
+        current = relay.get(name)
+        if current is None:
+          self._send(404, b'Not Found')
+        else:
+          self._send(304, headers={'ETag': current.etag})
+        return
+
+    if snapshot is None:
+      self._send(404, b'Not Found')
+      return
+
+    headers = {
+      'ETag': snapshot.etag,
+      'X-Sequence': str(snapshot.sequence),
+      'Vary': 'Accept-Encoding',
+      'Content-Type': 'application/octet-stream',
+      'Cache-Control': 'no-cache',
+    }
+    if snapshot.timestamp is not None:
+      headers['Last-Modified'] = formatdate(snapshot.timestamp, usegmt=True)
+
+    if etag == snapshot.etag:
+      self._send(304, headers=headers)
+      return
+
+    body = snapshot.data
+    if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+      body = snapshot.gzipped()
+      headers['Content-Encoding'] = 'gzip'
+    self._send(200, body, headers)
+
+
+  def _events(self, relay, query):
+    names = set(query['feeds'].split(',')) if query.get('feeds') else None
+    try:
+      after = int(self.headers.get('Last-Event-ID') or query.get('after', 0))
+    except ValueError:
+      self._send(400, b'Bad Request')
+      return
+
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Cache-Control', 'no-cache')
+    # No Content-Length, so the stream ends when the connection does.
+    self.send_header('Connection', 'close')
+    self.end_headers()
+    self.close_connection = True
+
+    try:
+      while True:
+        snapshots = relay.updates(after, names, KEEPALIVE)
+        if not snapshots:
+          self.wfile.write(b': keepalive\n\n')
+        for snapshot in snapshots:
+          self.wfile.write(('id: %d\nevent: update\ndata: %s\n\n' % (
+            snapshot.sequence, dumps(snapshot.info()))).encode('utf-8'))
+          after = snapshot.sequence
+        self.wfile.flush()
+    except (IOError, OSError):
+      # The reader went away.
+      pass
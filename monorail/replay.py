@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/replay.py - Time-indexed replay of harvested realtime snapshots
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .archive import DELTA_INDEX_EXT, INDEX_EXT, SEGMENT_EXT, read_index
+from .delta import KEYFRAME, DeltaDecoder, split_feed
+from .snapshot import HEADER_PEEK_SIZE, header_timestamp
+from .strings import NO_CODE, StringTable
+from .vehicles import VehicleTable, _decode_into
+from copy import copy
+from google.transit import gtfs_realtime_pb2
+from json import dumps, loads
+import numpy as np
+from os import close, fdopen, rename, stat, walk
+from os.path import abspath, basename, dirname, exists, join, relpath, splitext
+from tempfile import mkstemp
+from time import sleep, time
+from zlib import decompress
+
+INDEX_FILE = '.replay-index.npz'
+
+# Snapshots are loose files with this extension, or records in archive
+# segments.
+SNAPSHOT_EXT = '.pb'
+
+# Feeds with vehicle positions end with this.
+POSITIONS_SUFFIX = '_pos'
+
+# Columns of the index, and their types.  Rows are sorted by feed, then
+# timestamp.
+COLUMNS = (
+  ('feed', np.int32),
+  ('timestamp', np.int64),
+  ('file', np.int32),
+  ('offset', np.int64),
+  ('length', np.int64),
+  ('kind', np.int8),
+  # Offset of the keyframe a delta record is built on.
+  ('keyframe', np.int64),
+)
+
+
+def feed_name(path):
+  """
+  Gets the feed a loose snapshot file belongs to, from its name: everything
+  before the extension, or the first ``-`` (so that copies like
+  ``sydtrains_pos-20161010T1015.pb`` are the same feed as
+  ``sydtrains_pos.pb``).
+  """
+  return splitext(basename(path))[0].partition('-')[0]
+
+
+class _Reader(object):
+  def __init__(self, index):
+    """
+    Reads snapshots for a ``ReplayIndex``, keeping segments open and
+    remembering where it is in each, so reading forward through a
+    delta-coded segment only decodes each record once.
+    """
+    self.index = index
+    self._files = {}
+    # file -> (decoder, position in file rows of the last record decoded)
+    self._decoders = {}
+
+
+  def close(self):
+    for f in self._files.values():
+      f.close()
+    self._files.clear()
+    self._decoders.clear()
+
+
+  def _open(self, code):
+    f = self._files.get(code)
+    if f is None:
+      f = self._files[code] = open(join(self.index.path, self.index.files[code]['path']), 'rb')
+    return f
+
+
+  def _record(self, f, row):
+    index = self.index
+    f.seek(int(index.offset[row]))
+    return decompress(f.read(int(index.length[row])))
+
+
+  def read(self, row):
+    index = self.index
+    code = int(index.file[row])
+    f = self._open(code)
+    if not index.files[code]['segment']:
+      f.seek(0)
+      return f.read()
+
+    rows, offsets = index._file_rows(code)
+    pos = int(np.searchsorted(offsets, index.offset[row]))
+    state = self._decoders.get(code)
+
+    if index.kind[row] == KEYFRAME:
+      start = pos
+      decoder = DeltaDecoder()
+    elif state is not None and state[1] == pos - 1:
+      # The next record after the last one we read.
+      start = pos
+      decoder = state[0]
+    else:
+      start = int(np.searchsorted(offsets, index.keyframe[row]))
+      decoder = DeltaDecoder()
+
+    for i in range(start, pos + 1):
+      r = rows[i]
+      data = decoder.decode(int(index.kind[r]), self._record(f, r))
+    self._decoders[code] = (decoder, pos)
+    return data
+
+
+class ReplayIndex(object):
+  def __init__(self, path, index_path=None, update=True):
+    """
+    Index of every realtime snapshot harvested into a directory, by feed and
+    ``FeedHeader.timestamp``, so that they can be found and replayed without
+    decoding them all.
+
+    Snapshots can be loose ``.pb`` files anywhere under ``path``, or records
+    in a ``monorail.archive.SegmentArchive`` (including delta-coded ones).
+
+    The index is kept in ``.replay-index.npz`` in the directory, and
+    ``update`` only looks at files which are new or have changed since it
+    was written.
+
+    :param path: Directory to index.
+    :param index_path: Where to keep the index.
+    :param update: Bring the index up to date now.
+    """
+    self.path = abspath(path)
+    self.index_path = index_path or join(self.path, INDEX_FILE)
+    self.feeds = StringTable()
+    # file code -> dict(path, size, mtime, segment)
+    self.files = []
+    for name, dtype in COLUMNS:
+      setattr(self, name, np.empty(0, dtype=dtype))
+    self._by_file = {}
+
+    if exists(self.index_path):
+      self._load()
+    if update:
+      self.update()
+
+
+  def __len__(self):
+    return len(self.timestamp)
+
+
+  def _load(self):
+    with np.load(self.index_path) as saved:
+      meta = loads(saved['meta'].tobytes().decode('utf-8'))
+      for name, dtype in COLUMNS:
+        setattr(self, name, saved['column_' + name].astype(dtype))
+    self.feeds = StringTable(meta['feeds'])
+    self.files = meta['files']
+
+
+  def save(self):
+    """
+    Writes the index to disk.  This is done by ``update`` when something
+    changed.
+    """
+    meta = dumps(dict(feeds=self.feeds.strings, files=self.files)).encode('utf-8')
+    arrays = dict(('column_' + name, getattr(self, name)) for name, dtype in COLUMNS)
+    arrays['meta'] = np.frombuffer(meta, dtype=np.uint8)
+
+    fd, tmp = mkstemp(dir=dirname(self.index_path), prefix='.replay', suffix='.npz')
+    try:
+      f = fdopen(fd, 'wb')
+    except:
+      close(fd)
+      raise
+    with f:
+      np.savez(f, **arrays)
+    rename(tmp, self.index_path)
+
+
+  def _scan(self):
+    """
+    Finds everything which could be indexed.
+
+    Returns a dict of path (relative to the directory) -> (size, mtime,
+    segment), where size and mtime are of the file which says what records
+    there are (the index, for segments).
+    """
+    found = {}
+    for root, dirs, names in walk(self.path):
+      dirs[:] = [d for d in dirs if not d.startswith('.')]
+      for name in names:
+        if name.startswith('.'):
+          continue
+        if name.endswith(SNAPSHOT_EXT):
+          segment, source = False, join(root, name)
+          path = source
+        elif name.endswith(INDEX_EXT) or name.endswith(DELTA_INDEX_EXT):
+          segment, source = True, join(root, name)
+          path = join(root, splitext(name)[0] + SEGMENT_EXT)
+        else:
+          continue
+        st = stat(source)
+        found[relpath(path, self.path)] = (st.st_size, st.st_mtime, segment, source)
+    return found
+
+
+  def _index_file(self, code, path, segment, source):
+    """
+    Gets the index rows for one file, as a dict of column -> list.
+    """
+    rows = dict((name, []) for name, dtype in COLUMNS)
+
+    def add(feed, timestamp, offset, length, kind, keyframe):
+      rows['feed'].append(self.feeds.code(feed))
+      rows['timestamp'].append(timestamp)
+      rows['file'].append(code)
+      rows['offset'].append(offset)
+      rows['length'].append(length)
+      rows['kind'].append(kind)
+      rows['keyframe'].append(keyframe)
+
+    if segment:
+      # Archive segments are in a directory named after the feed.
+      feed = basename(dirname(source))
+      keyframe = 0
+      for timestamp, offset, length, kind in read_index(source):
+        if kind == KEYFRAME:
+          keyframe = offset
+        add(feed, timestamp, offset, length, kind, keyframe)
+    else:
+      with open(source, 'rb') as f:
+        timestamp = header_timestamp(f.read(HEADER_PEEK_SIZE))
+      if timestamp is not None:
+        add(feed_name(path), timestamp, 0, stat(source).st_size, KEYFRAME, 0)
+    return rows
+
+
+  def update(self):
+    """
+    Indexes new and changed files, and forgets about deleted ones.
+
+    Returns the number of files which were (re)indexed.
+    """
+    found = self._scan()
+    known = dict((info['path'], (code, info)) for code, info in enumerate(self.files))
+
+    # Keep rows for files which haven't changed, renumbering the files.
+    files = []
+    remap = np.full(len(self.files) + 1, NO_CODE, dtype=np.int32)
+    changed = []
+    for path, (size, mtime, segment, source) in sorted(found.items()):
+      code = len(files)
+      files.append(dict(path=path, size=size, mtime=mtime, segment=segment))
+      old = known.get(path)
+      if old is not None and (old[1]['size'], old[1]['mtime']) == (size, mtime):
+        remap[old[0]] = code
+      else:
+        changed.append((code, path, segment, source))
+
+    if not changed and len(files) == len(self.files):
+      return 0
+
+    keep = remap[self.file] != NO_CODE
+    columns = dict((name, [getattr(self, name)[keep]]) for name, dtype in COLUMNS)
+    columns['file'][0] = remap[self.file[keep]]
+    for code, path, segment, source in changed:
+      rows = self._index_file(code, path, segment, source)
+      for name, dtype in COLUMNS:
+        columns[name].append(np.array(rows[name], dtype=dtype))
+
+    for name, dtype in COLUMNS:
+      setattr(self, name, np.concatenate(columns[name]).astype(dtype))
+    self.files = files
+
+    order = np.lexsort((self.offset, self.file, self.timestamp, self.feed))
+    for name, dtype in COLUMNS:
+      setattr(self, name, getattr(self, name)[order])
+    self._by_file = {}
+    self.save()
+    return len(changed)
+
+
+  def select(self, rows):
+    """
+    Gets a copy of the index with only some rows (a sorted array of
+    indexes), and only the files they are in, eg: to hand part of it to
+    another process.
+
+    The copy isn't kept on disk, so it can't be updated.
+    """
+    index = copy(self)
+    codes = np.unique(self.file[rows])
+    index.index_path = None
+    index.files = [self.files[code] for code in codes]
+    for name, dtype in COLUMNS:
+      setattr(index, name, getattr(self, name)[rows])
+    index.file = np.searchsorted(codes, index.file).astype(np.int32)
+    index._by_file = {}
+    return index
+
+
+  def _file_rows(self, code):
+    """
+    Gets the rows for one file, and their offsets, in the order they are in
+    the file.
+    """
+    cached = self._by_file.get(code)
+    if cached is None:
+      rows = np.nonzero(self.file == code)[0]
+      rows = rows[np.argsort(self.offset[rows], kind='mergesort')]
+      cached = self._by_file[code] = (rows, self.offset[rows])
+    return cached
+
+
+  def _rows(self, feeds, start=None, end=None):
+    """
+    Gets the rows for some feeds between two times, in time order.
+    """
+    mask = np.zeros(len(self.feed), dtype=bool)
+    for feed in feeds:
+      code = self.feeds.lookup(feed)
+      if code != NO_CODE:
+        lo, hi = np.searchsorted(self.feed, [code, code + 1])
+        mask[lo:hi] = True
+    if start is not None:
+      mask &= self.timestamp >= start
+    if end is not None:
+      mask &= self.timestamp < end
+    rows = np.nonzero(mask)[0]
+    return rows[np.argsort(self.timestamp[rows], kind='mergesort')]
+
+
+  def find(self, feed, timestamp):
+    """
+    Gets the state of a feed at ``timestamp``: the last snapshot at or
+    before it.
+
+    Returns a tuple of the snapshot's timestamp and data, or None if there is
+    no snapshot that early.
+    """
+    code = self.feeds.lookup(feed)
+    if code == NO_CODE:
+      return None
+
+    lo, hi = np.searchsorted(self.feed, [code, code + 1])
+    pos = lo + int(np.searchsorted(self.timestamp[lo:hi], timestamp, side='right'))
+    if pos == lo:
+      return None
+
+    reader = _Reader(self)
+    try:
+      return int(self.timestamp[pos - 1]), reader.read(pos - 1)
+    finally:
+      reader.close()
+
+
+  def replay(self, feeds=None, start=None, end=None, rate=None):
+    """
+    Iterates over the snapshots of some feeds between two times, in time
+    order.
+
+    Yields tuples of feed, timestamp and data.
+
+    :param feeds: Names of feeds to include.  By default, all of them.
+    :param start: Only include snapshots at or after this timestamp.
+    :param end: Only include snapshots before this timestamp.
+    :param rate: Pace the snapshots as if they were arriving live, this many
+                 times faster than real time.  By default, they are given
+                 as fast as they can be read.
+    """
+    if feeds is None:
+      feeds = self.feeds.strings
+    elif not isinstance(feeds, (list, tuple, set)):
+      feeds = [feeds]
+
+    rows = self._rows(feeds, start, end)
+    reader = _Reader(self)
+    started = first = None
+    try:
+      for row in rows:
+        timestamp = int(self.timestamp[row])
+        data = reader.read(row)
+
+        if rate:
+          if first is None:
+            started, first = time(), timestamp
+          delay = (timestamp - first) / float(rate) - (time() - started)
+          if delay > 0:
+            sleep(delay)
+
+        yield self.feeds.strings[self.feed[row]], timestamp, data
+    finally:
+      reader.close()
+
+
+  def snapshots(self, feed, start=None, end=None):
+    """
+    Iterates over the snapshots of one feed between two times, in order.
+
+    Yields tuples of timestamp and data.
+    """
+    for name, timestamp, data in self.replay([feed], start, end):
+      yield timestamp, data
+
+
+  def trajectory(self, vehicle_id=None, trip_id=None, start=None, end=None, feeds=None):
+    """
+    Gets the positions of one vehicle (or the vehicle running one trip)
+    between two times, as a ``VehicleTable``.
+
+    Snapshots which don't mention the vehicle or trip are skipped without
+    being parsed, and only the entities which do are parsed from the rest.
+
+    :param feeds: VehiclePositions feeds to look in.  By default, every feed
+                  whose name ends with ``_pos``.
+    """
+    assert vehicle_id or trip_id, 'a vehicle_id or trip_id is required'
+    if feeds is None:
+      feeds = [feed for feed in self.feeds.strings if feed.endswith(POSITIONS_SUFFIX)]
+
+    needle = (vehicle_id or trip_id).encode('utf-8')
+    vehicle_ids, trip_ids, route_ids = StringTable(), StringTable(), StringTable()
+    rows = dict((name, []) for name, dtype in VehicleTable.COLUMNS)
+    snapshot = 0
+
+    for feed, timestamp, data in self.replay(feeds, start, end):
+      if needle not in data:
+        continue
+      try:
+        prefix, entities, suffix = split_feed(data)
+        data = prefix + b''.join([chunk for entity_id, chunk in entities if needle in chunk])
+      except ValueError:
+        pass
+
+      message = gtfs_realtime_pb2.FeedMessage()
+      message.ParseFromString(data)
+      _decode_into(message, snapshot, rows, vehicle_ids, trip_ids, route_ids)
+      snapshot += 1
+
+    columns = dict((name, np.array(rows[name], dtype=dtype))
+                   for name, dtype in VehicleTable.COLUMNS)
+    table = VehicleTable(columns, vehicle_ids, trip_ids, route_ids)
+
+    # The byte search can match other fields; only keep exact matches.
+    mask = np.ones(len(table), dtype=bool)
+    if vehicle_id:
+      mask &= (table.vehicle_id == vehicle_ids.lookup(vehicle_id)) & (table.vehicle_id != NO_CODE)
+    if trip_id:
+      mask &= (table.trip_id == trip_ids.lookup(trip_id)) & (table.trip_id != NO_CODE)
+    return table.select(mask)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/scheduler.py - Quota-aware scheduler for polling feeds
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock
+from time import time
+
+# Longest we will back off a failing feed for, in seconds.
+MAX_BACKOFF = 900
+
+# Longest the scheduler will sleep for without checking for work, in seconds.
+MAX_SLEEP = 1.
+
+
+def error_status(error):
+  """
+  Gets the HTTP status code out of an exception raised by a fetch, or None if
+  there isn't one (eg: the connection failed).
+
+  This understands exceptions from ``requests`` and the swagger-codegen
+  generated ``ApiException``.
+  """
+  status = getattr(error, 'status', None)
+  if status is None:
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+
+  try:
+    return int(status)
+  except (TypeError, ValueError):
+    return None
+
+
+def error_headers(error):
+  """
+  Gets the response headers out of an exception raised by a fetch, or None if
+  there aren't any.
+  """
+  headers = getattr(error, 'headers', None)
+  if headers is None:
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+  return headers
+
+
+def retry_after(headers):
+  """
+  Gets the number of seconds a Retry-After header asks us to wait, or 0 if
+  there isn't one (or it is a date).
+  """
+  try:
+    return max(0., float((headers or {}).get('Retry-After')))
+  except (TypeError, ValueError):
+    return 0.
+
+
+def next_backoff(backoff, interval, max_backoff=MAX_BACKOFF):
+  """
+  Gets how long to back off a feed for after it fails again.  The first
+  failure backs off for twice the feed's interval, and each one after that
+  doubles it, up to ``max_backoff`` seconds.
+  """
+  return min(max_backoff, max(interval * 2, backoff * 2))
+
+
+class TokenBucket(object):
+  def __init__(self, rate, capacity):
+    """
+    Rate limiter which allows bursts of up to ``capacity`` requests, refilling
+    at ``rate`` requests per second.
+    """
+    self.rate = float(rate)
+    self.capacity = float(capacity)
+    self._tokens = self.capacity
+    self._updated = time()
+    self._lock = Lock()
+
+
+  def _refill(self):
+    now = time()
+    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+
+  def consume(self, tokens=1):
+    """
+    Takes ``tokens`` from the bucket.
+
+    Returns 0 if they were taken, otherwise the number of seconds until
+    enough tokens will be available (and nothing is taken).
+    """
+    with self._lock:
+      self._refill()
+      if self._tokens >= tokens:
+        self._tokens -= tokens
+        return 0
+      return (tokens - self._tokens) / self.rate
+
+
+  def available(self):
+    """
+    Gets the number of tokens in the bucket.
+    """
+    with self._lock:
+      self._refill()
+      return self._tokens
+
+
+  def drain(self, seconds=0):
+    """
+    Empties the bucket, eg: after the server told us we are over quota.
+
+    :param seconds: Also take out what would refill in this many seconds
+                    (eg: from a Retry-After header), so nothing more is
+                    taken until then.
+    """
+    with self._lock:
+      self._refill()
+      self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class Feed(object):
+  def __init__(self, name, interval, fetch):
+    """
+    A feed which is fetched every ``interval`` seconds by calling ``fetch``.
+    """
+    self.name = name
+    self.interval = interval
+    self.fetch = fetch
+    self.next_due = 0
+    self.backoff = 0
+    self.running = False
+
+
+class Scheduler(object):
+  def __init__(self, rate, burst=1, jobs=1, max_backoff=MAX_BACKOFF, metrics=None):
+    """
+    Runs fetches for many feeds, each on its own interval, without going over
+    a shared request quota.
+
+    Fetches that are due are run concurrently, with up to ``jobs`` running at
+    once.  If a fetch fails with a 429 or 5xx response (or the connection
+    fails), that feed backs off exponentially (starting at twice its
+    interval), up to ``max_backoff`` seconds.  A 429 also pauses all other
+    feeds for as long as its Retry-After header asks, and until the quota has
+    refilled.
+
+    :param rate: Number of requests per second allowed by the quota.
+    :param burst: Number of requests which may be made at once.
+    :param jobs: Number of fetches to run at once.
+    :param max_backoff: Longest time to back off a failing feed, in seconds.
+    :param metrics: ``monorail.metrics.Metrics`` to record how long each fetch
+                    took, and how late it started.
+    """
+    self.bucket = TokenBucket(rate, burst)
+    self.jobs = jobs
+    self.max_backoff = max_backoff
+    self.metrics = metrics
+    self.feeds = []
+    self._lock = Lock()
+    self._wake = Event()
+    self._stop = Event()
+
+
+  def add(self, name, interval, fetch):
+    """
+    Adds a feed to the scheduler.  It will first be fetched as soon as the
+    scheduler is run.
+
+    :param name: Name of the feed, used in log messages.
+    :param interval: Number of seconds between fetches.
+    :param fetch: Callable which fetches the feed.
+    """
+    feed = Feed(name, interval, fetch)
+    self.feeds.append(feed)
+    return feed
+
+
+  def stop(self):
+    """
+    Stops the scheduler from starting any new fetches.
+    """
+    self._stop.set()
+    self._wake.set()
+
+
+  def _run_feed(self, feed):
+    start = time()
+    # Feeds are due immediately when first added.
+    lag = (start - feed.next_due) if feed.next_due else 0.
+    error = None
+    try:
+      feed.fetch()
+    except Exception as e:
+      error = e
+      status = error_status(e)
+      if status is None or status == 429 or status >= 500:
+        # Back off this feed
+        feed.backoff = next_backoff(feed.backoff, feed.interval, self.max_backoff)
+        if status == 429:
+          self.bucket.drain(retry_after(error_headers(e)))
+        print('%s: failed (%s), backing off for %gs' % (feed.name, e, feed.backoff))
+        next_due = time() + feed.backoff
+      else:
+        print('%s: failed (%s)' % (feed.name, e))
+        next_due = start + feed.interval
+    else:
+      feed.backoff = 0
+      next_due = start + feed.interval
+
+    if self.metrics:
+      self.metrics.fetch(feed.name, time() - start, lag, error)
+
+    with self._lock:
+      feed.next_due = next_due
+      feed.running = False
+    self._wake.set()
+
+
+  def run(self):
+    """
+    Runs fetches until ``stop`` is called.
+    """
+    pool = ThreadPool(self.jobs)
+    try:
+      while not self._stop.is_set():
+        self._wake.clear()
+        now = time()
+        sleep_for = MAX_SLEEP
+
+        with self._lock:
+          waiting = [feed for feed in self.feeds if not feed.running]
+
+        for feed in sorted(waiting, key=lambda feed: feed.next_due):
+          if feed.next_due > now:
+            sleep_for = min(sleep_for, feed.next_due - now)
+            break
+
+          wait = self.bucket.consume()
+          if wait:
+            sleep_for = min(sleep_for, wait)
+            break
+
+          with self._lock:
+            feed.running = True
+          pool.apply_async(self._run_feed, (feed,))
+
+        self._wake.wait(sleep_for)
+    finally:
+      pool.close()
+      pool.join()
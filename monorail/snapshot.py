@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/snapshot.py - Writes realtime snapshots only when they change
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .cache import file_digest
+from hashlib import sha256
+from json import dump, load
+from os import close, fdopen, remove, rename
+from os.path import exists, getsize, join, splitext
+from shutil import move
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+MANIFEST_FILE = 'manifest.json'
+
+# Number of bytes to read from the start of a file to find the FeedHeader.
+HEADER_PEEK_SIZE = 4096
+
+
+def _varint(data, pos):
+  """
+  Reads a protobuf varint from ``data`` at ``pos``.
+
+  Returns a tuple of the value and the position after it.
+  """
+  result = shift = 0
+  while True:
+    b = ord(data[pos:pos + 1])
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return result, pos
+    shift += 7
+
+
+def _fields(data, start=0, end=None):
+  """
+  Iterates over the fields of a protobuf message, without needing the schema.
+
+  Yields tuples of field number, wire type and value.  Length-delimited values
+  are returned as a tuple of their start and end position in ``data``.
+  """
+  pos = start
+  if end is None:
+    end = len(data)
+
+  while pos < end:
+    key, pos = _varint(data, pos)
+    field, wire_type = key >> 3, key & 7
+    if wire_type == 0:
+      value, pos = _varint(data, pos)
+    elif wire_type == 1:
+      value, pos = data[pos:pos + 8], pos + 8
+    elif wire_type == 2:
+      length, pos = _varint(data, pos)
+      value, pos = (pos, pos + length), pos + length
+    elif wire_type == 5:
+      value, pos = data[pos:pos + 4], pos + 4
+    else:
+      raise ValueError('unsupported wire type %d' % wire_type)
+    yield field, wire_type, value
+
+
+def header_timestamp(data):
+  """
+  Gets ``FeedHeader.timestamp`` from a serialised GTFS-realtime FeedMessage.
+
+  This only reads as far as the header, so it is much cheaper than parsing the
+  whole message.  Returns None if there is no timestamp, or ``data`` is not a
+  FeedMessage.
+  """
+  try:
+    # The header is always serialised first.
+    field, wire_type, value = next(_fields(data))
+    if field != 1 or wire_type != 2:
+      return None
+
+    version = timestamp = None
+    for hfield, hwire_type, hvalue in _fields(data, *value):
+      if hfield == 1 and hwire_type == 2:
+        # FeedHeader.gtfs_realtime_version
+        version = hvalue
+      elif hfield == 3 and hwire_type == 0:
+        # FeedHeader.timestamp
+        timestamp = hvalue
+
+    # gtfs_realtime_version is required, so this is probably not a FeedMessage
+    # if it is missing.
+    if version is not None:
+      return timestamp
+  except (StopIteration, TypeError, ValueError, IndexError):
+    pass
+  return None
+
+
+class SnapshotWriter(object):
+  def __init__(self, output_dir, archive=None, relay=None):
+    """
+    Writes realtime snapshots into a directory, skipping ones which have not
+    changed since the last write.
+
+    A snapshot is dropped if it has the same content as the current file, or
+    its ``FeedHeader.timestamp`` is older than the current file's.  Otherwise
+    it replaces the file atomically.
+
+    Each write updates ``manifest.json`` in the output directory, which lists
+    every file with its sequence number, header timestamp and SHA-256.  The
+    manifest also has a ``sequence`` which increases on every write, so
+    consumers only need to poll the manifest to find out about new data.
+
+    :param output_dir: Directory to write snapshots into.
+    :param archive: ``SegmentArchive`` to also append every new GTFS-realtime
+                    snapshot to.
+    :param relay: ``monorail.relay.Relay`` to also publish every new
+                  GTFS-realtime snapshot to.
+    """
+    self.output_dir = output_dir
+    self.archive = archive
+    self.relay = relay
+    self._manifest_path = join(output_dir, MANIFEST_FILE)
+    self._lock = Lock()
+
+    self.manifest = dict(sequence=0, files={})
+    if exists(self._manifest_path):
+      with open(self._manifest_path, 'rb') as f:
+        self.manifest = load(f)
+
+
+  def _save(self):
+    fd, tmp = mkstemp(dir=self.output_dir, prefix='.manifest')
+    with fdopen(fd, 'w') as f:
+      dump(self.manifest, f, indent=2)
+    rename(tmp, self._manifest_path)
+
+
+  def _changed(self, name, digest, timestamp):
+    """
+    Returns True if a snapshot with this hash and header timestamp should
+    replace the current file.
+    """
+    current = self.manifest['files'].get(name)
+    if current is None or not exists(join(self.output_dir, name)):
+      return True
+
+    if current['sha256'] == digest:
+      return False
+
+    if (timestamp is not None and current['timestamp'] is not None and
+        timestamp < current['timestamp']):
+      # Older than what we already have.
+      return False
+
+    return True
+
+
+  def _record(self, name, digest, timestamp, size, data=None):
+    # Only GTFS-realtime feeds have a timestamp, which keeps timetables out
+    # of the archive and relay.
+    if timestamp is not None and (self.archive is not None or self.relay is not None):
+      if data is None:
+        with open(join(self.output_dir, name), 'rb') as f:
+          data = f.read()
+      if self.archive is not None:
+        self.archive.append(splitext(name)[0], data, timestamp)
+
+    self.manifest['sequence'] += 1
+    self.manifest['files'][name] = dict(
+      sequence=self.manifest['sequence'],
+      timestamp=timestamp,
+      sha256=digest,
+      size=size,
+      updated=time(),
+    )
+    self._save()
+
+    if self.relay is not None and timestamp is not None:
+      self.relay.publish(name, data, self.manifest['sequence'], timestamp)
+
+
+  def write(self, name, data):
+    """
+    Writes a snapshot from a byte string.
+
+    Returns True if the file was replaced, or False if the snapshot was
+    dropped.
+    """
+    digest = sha256(data).hexdigest()
+    timestamp = header_timestamp(data)
+
+    with self._lock:
+      if not self._changed(name, digest, timestamp):
+        return False
+
+      fd, tmp = mkstemp(dir=self.output_dir, prefix='.' + name)
+      with fdopen(fd, 'wb') as f:
+        f.write(data)
+      rename(tmp, join(self.output_dir, name))
+      self._record(name, digest, timestamp, len(data), data)
+    return True
+
+
+  def move(self, name, path):
+    """
+    Moves a snapshot from a file into place, like ``shutil.move``.
+
+    If the snapshot is dropped, the file at ``path`` is removed.
+
+    Returns True if the file was replaced, or False if the snapshot was
+    dropped.
+    """
+    digest = file_digest(path)
+    with open(path, 'rb') as f:
+      timestamp = header_timestamp(f.read(HEADER_PEEK_SIZE))
+
+    with self._lock:
+      if not self._changed(name, digest, timestamp):
+        remove(path)
+        return False
+
+      # Move it into our directory first, so that the final rename is atomic.
+      fd, tmp = mkstemp(dir=self.output_dir, prefix='.' + name)
+      close(fd)
+      move(path, tmp)
+      size = getsize(tmp)
+      rename(tmp, join(self.output_dir, name))
+      self._record(name, digest, timestamp, size)
+    return True
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/spatial.py - Spatial index for stops and vehicles
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+
+# Default size of each grid cell, in metres.
+DEFAULT_CELL_SIZE = 250.
+
+# Cell coordinates are packed into one int64 key as x * CELL_KEY + y, so y must
+# be within +/- CELL_KEY / 2.
+CELL_KEY = 1 << 24
+
+# Maximum number of (query, cell) pairs to compare at once.
+CHUNK_PAIRS = 1 << 22
+
+# Look up neighbouring cells one at a time while there are this many times
+# fewer of them than occupied cells, otherwise compare with every occupied cell.
+NEIGHBOUR_RATIO = 8
+
+
+def _expand(starts, ends):
+  """
+  Turns ranges [start, end) into one flat array of every position in them.
+
+  Returns a tuple of the range each position came from, and the position.
+  """
+  counts = ends - starts
+  total = int(counts.sum())
+  ranges = np.repeat(np.arange(len(starts)), counts)
+  firsts = np.cumsum(counts) - counts
+  positions = np.arange(total) - np.repeat(firsts - starts, counts)
+  return ranges, positions
+
+
+class GridIndex(object):
+  def __init__(self, lat, lon, ids=None, cell_size=DEFAULT_CELL_SIZE, origin_lat=None):
+    """
+    Spatial index of points, bulk-loaded from arrays of coordinates.
+
+    Points are projected onto a flat plane in metres (equirectangular, centred
+    on ``origin_lat``), which is accurate enough at the scale of a city, then
+    bucketed into square cells of ``cell_size`` metres.
+
+    Queries take arrays of coordinates, and answer all of them at once.
+
+    :param lat: Array of latitudes.  Points with a NaN coordinate are skipped.
+    :param lon: Array of longitudes.
+    :param ids: Array of values to return for each point.  By default, the
+                index of the point in ``lat`` and ``lon``.
+    :param cell_size: Size of each grid cell, in metres.
+    :param origin_lat: Latitude to centre the projection on.  By default, the
+                       mean latitude of the points.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if ids is None:
+      ids = np.arange(len(lat))
+    ids = np.asarray(ids)
+
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    lat, lon, ids = lat[valid], lon[valid], ids[valid]
+
+    if origin_lat is None:
+      origin_lat = float(lat.mean()) if len(lat) else 0.
+    self.origin_lat = origin_lat
+    self._scale_x = EARTH_RADIUS * np.cos(np.radians(origin_lat))
+    self.cell_size = float(cell_size)
+
+    x, y = self.project(lat, lon)
+    cx, cy = self._cell(x, y)
+    keys = cx * CELL_KEY + cy
+
+    # Sort points by cell, so each cell is a contiguous range.
+    order = np.argsort(keys, kind='mergesort')
+    self.ids = ids[order]
+    self._x = x[order]
+    self._y = y[order]
+    keys = keys[order]
+
+    self._keys, starts = np.unique(keys, return_index=True)
+    self._bounds = np.append(starts, len(keys))
+    self._cell_x = (self._keys + CELL_KEY // 2) // CELL_KEY
+    self._cell_y = self._keys - self._cell_x * CELL_KEY
+
+
+  def __len__(self):
+    return len(self.ids)
+
+
+  def project(self, lat, lon):
+    """
+    Projects coordinates onto the index's plane, in metres.
+    """
+    x = np.radians(np.asarray(lon, dtype=np.float64)) * self._scale_x
+    y = np.radians(np.asarray(lat, dtype=np.float64)) * EARTH_RADIUS
+    return x, y
+
+
+  def _cell(self, x, y):
+    return (np.floor(x / self.cell_size).astype(np.int64),
+            np.floor(y / self.cell_size).astype(np.int64))
+
+
+  def _candidates(self, cx, cy, reach):
+    """
+    Finds every point in the cells within ``reach`` cells of each query cell.
+
+    Returns a tuple of query index and point position.
+    """
+    side = 2 * reach + 1
+    queries = []
+    cells = []
+
+    if side * side * NEIGHBOUR_RATIO <= len(self._keys):
+      # Look up each neighbouring cell.
+      for dx in range(-reach, reach + 1):
+        for dy in range(-reach, reach + 1):
+          keys = (cx + dx) * CELL_KEY + (cy + dy)
+          pos = np.searchsorted(self._keys, keys)
+          found = pos < len(self._keys)
+          found[found] = self._keys[pos[found]] == keys[found]
+          queries.append(np.nonzero(found)[0])
+          cells.append(pos[found])
+    else:
+      # The neighbourhood is bigger than the grid, so compare each query with
+      # every occupied cell instead.
+      step = max(1, CHUNK_PAIRS // max(1, len(self._keys)))
+      for first in range(0, len(cx), step):
+        near = ((np.abs(self._cell_x[None, :] - cx[first:first + step, None]) <= reach) &
+                (np.abs(self._cell_y[None, :] - cy[first:first + step, None]) <= reach))
+        q, c = np.nonzero(near)
+        queries.append(q + first)
+        cells.append(c)
+
+    if not queries:
+      return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    queries = np.concatenate(queries)
+    cells = np.concatenate(cells)
+    ranges, positions = _expand(self._bounds[cells], self._bounds[cells + 1])
+    return queries[ranges], positions
+
+
+  def _radius(self, x, y, distance):
+    """
+    Finds points within ``distance`` metres of projected query points.
+
+    Returns a tuple of query index, point position and distance, sorted by
+    query then distance.
+    """
+    cx, cy = self._cell(x, y)
+    reach = int(np.ceil(distance / self.cell_size))
+    queries, positions = self._candidates(cx, cy, reach)
+
+    distances = np.hypot(self._x[positions] - x[queries], self._y[positions] - y[queries])
+    close = distances <= distance
+    queries, positions, distances = queries[close], positions[close], distances[close]
+
+    order = np.lexsort((distances, queries))
+    return queries[order], positions[order], distances[order]
+
+
+  def radius(self, lat, lon, distance):
+    """
+    Finds every point within ``distance`` metres of each query point.
+
+    Returns a tuple of arrays (query, id, distance), with one entry for every
+    match.  ``query`` is the index of the query point, and results are sorted
+    by query and then distance.
+
+    :param lat: Latitude of each query point.
+    :param lon: Longitude of each query point.
+    :param distance: Search radius, in metres.
+    """
+    x, y = self.project(np.atleast_1d(lat), np.atleast_1d(lon))
+    queries, positions, distances = self._radius(x, y, distance)
+    return queries, self.ids[positions], distances
+
+
+  def nearest(self, lat, lon, k=1, max_distance=None):
+    """
+    Finds the ``k`` nearest points to each query point.
+
+    Returns a tuple of arrays (id, distance), each with a row for each query
+    point and ``k`` columns, nearest first.  If fewer than ``k`` points are
+    found, the remaining distances are infinite and ids are -1.
+
+    :param lat: Latitude of each query point.
+    :param lon: Longitude of each query point.
+    :param k: Number of points to find.
+    :param max_distance: Don't return points further than this many metres
+                         away.
+    """
+    x, y = self.project(np.atleast_1d(lat), np.atleast_1d(lon))
+    found_pos = np.full((len(x), k), -1, dtype=np.int64)
+    found_dist = np.full((len(x), k), np.inf)
+    want = min(k, len(self))
+
+    pending = np.arange(len(x))
+    distance = self.cell_size
+    while len(pending) and want:
+      last = max_distance is not None and distance >= max_distance
+      if last:
+        distance = max_distance
+
+      queries, positions, distances = self._radius(x[pending], y[pending], distance)
+      counts = np.bincount(queries, minlength=len(pending))
+
+      # Anything within the search radius is found, so if we found enough
+      # points, they must be the nearest ones.
+      done = (counts >= want) | last
+
+      # Rank of each match within its query (results are sorted by distance).
+      firsts = np.cumsum(counts) - counts
+      rank = np.arange(len(queries)) - firsts[queries]
+      keep = done[queries] & (rank < k)
+      rows = pending[queries[keep]]
+      found_pos[rows, rank[keep]] = positions[keep]
+      found_dist[rows, rank[keep]] = distances[keep]
+
+      pending = pending[~done]
+      distance *= 2
+
+    ids = np.where(found_pos >= 0, self.ids[np.maximum(found_pos, 0)] if len(self) else -1, -1)
+    return ids, found_dist
+
+
+def stop_index(feed, cell_size=DEFAULT_CELL_SIZE):
+  """
+  Builds a ``GridIndex`` of the stops in a compiled GTFS feed (from
+  ``monorail.gtfs``).
+
+  The ids returned by queries are ``stop_id`` codes, which can be turned back
+  into strings with ``feed.strings['stop_id']``.
+  """
+  stops = feed['stops']
+  return GridIndex(stops['stop_lat'], stops['stop_lon'], stops['stop_id'], cell_size)
+
+
+def vehicle_index(table, cell_size=DEFAULT_CELL_SIZE, origin_lat=None):
+  """
+  Builds a ``GridIndex`` of the vehicles in a ``VehicleTable`` (from
+  ``monorail.vehicles``), in one call.
+
+  The ids returned by queries are row numbers in ``table``.  Vehicles without
+  a position are skipped.
+
+  :param origin_lat: Latitude to centre the projection on.  Pass the
+                     ``origin_lat`` of a stop index to measure distances the
+                     same way.
+  """
+  return GridIndex(table.lat, table.lon, cell_size=cell_size, origin_lat=origin_lat)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/strings.py - Interned string tables
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import numpy as np
+
+# Code used for a missing string.
+NO_CODE = -1
+
+
+class StringTable(object):
+  def __init__(self, strings=None):
+    """
+    Interns strings, giving each a small integer code.
+
+    Codes are allocated in the order strings are first seen, so
+    ``table.strings[code]`` gets the string back.  Strings are never removed,
+    so a code stays valid for as long as the table exists.
+    """
+    self.strings = []
+    self.codes = {}
+    for s in strings or ():
+      self.code(s)
+
+
+  def __len__(self):
+    return len(self.strings)
+
+
+  def code(self, s):
+    """
+    Gets the code for a string, adding it to the table if required.
+    """
+    try:
+      return self.codes[s]
+    except KeyError:
+      code = self.codes[s] = len(self.strings)
+      self.strings.append(s)
+      return code
+
+
+  def lookup(self, s):
+    """
+    Gets the code for a string, or ``NO_CODE`` if it is not in the table.
+    """
+    return self.codes.get(s, NO_CODE)
+
+
+  def decode(self, codes):
+    """
+    Turns an array of codes back into a list of strings (or None).
+    """
+    strings = self.strings
+    return [strings[c] if c != NO_CODE else None for c in codes]
+
+
+  def pack(self):
+    """
+    Packs the table into two NumPy arrays, for writing to disk: the UTF-8
+    encoded strings joined together (uint8), and the offset of the end of each
+    string (int64).
+    """
+    encoded = [s if isinstance(s, bytes) else s.encode('utf-8') for s in self.strings]
+    offsets = np.cumsum([len(s) for s in encoded], dtype=np.int64)
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+class PackedStringTable(StringTable):
+  def __init__(self, data, offsets):
+    """
+    ``StringTable`` read from the arrays made by ``StringTable.pack``.
+
+    The strings are only decoded when they are first needed, so that opening a
+    table (eg: from a memory-mapped file) is cheap.
+    """
+    self._data = data
+    self._offsets = offsets
+    self._strings = None
+    self._codes = None
+
+
+  def _unpack(self):
+    data = self._data.tobytes()
+    ends = self._offsets.tolist()
+    starts = [0] + ends[:-1]
+    self._strings = [data[a:b].decode('utf-8') for a, b in zip(starts, ends)]
+    self._codes = dict((s, i) for i, s in enumerate(self._strings))
+
+
+  @property
+  def strings(self):
+    if self._strings is None:
+      self._unpack()
+    return self._strings
+
+
+  @property
+  def codes(self):
+    if self._codes is None:
+      self._unpack()
+    return self._codes
+
+
+  def __len__(self):
+    if self._strings is None:
+      return len(self._offsets)
+    return len(self._strings)
+
+
+  def pack(self):
+    if self._strings is None:
+      return self._data, self._offsets
+    return StringTable.pack(self)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/tokens.py - Shared OAuth2 token manager for the Transport for NSW API
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+from .credentials import TOKEN_URL
+from .opendata import MeteredSession
+
+from hashlib import sha256
+from json import dump, load
+from os import close, fdopen, rename
+from os.path import abspath, dirname, exists
+import requests
+from tempfile import mkstemp
+from threading import Event, Lock, Thread
+from time import time
+
+try:
+  import fcntl
+except ImportError:
+  # No file locking on this platform, so processes may each get their own
+  # token.  Threads in one process still share one.
+  fcntl = None
+
+# Refresh tokens this many seconds before they expire.
+REFRESH_MARGIN = 300
+
+# Wait this many seconds before retrying a failed background refresh.
+RETRY_DELAY = 10
+
+
+def get_oauth_token(client_id, client_secret, session=None, token_url=TOKEN_URL):
+  """
+  Gets an OAuth2 bearer token using an Application flow from the API server.
+
+  Returns a tuple of token, type, expiry (UNIX timestamp).
+  """
+  response = (session or requests).post(token_url, auth=(client_id, client_secret), data='')
+
+  assert response.status_code == 200, 'unexpected response code (%d)' % response.status_code
+  response = response.json()
+
+  # Parse the result
+  access_token = response['access_token']
+  token_type = response['token_type']
+  expiry = time() + int(response['expires_in'])
+  return access_token, token_type, expiry
+
+
+class TokenManager(object):
+  def __init__(self, client_id, client_secret, cache_path=None, margin=REFRESH_MARGIN,
+               token_url=TOKEN_URL, metrics=None):
+    """
+    Keeps an OAuth2 token for the API, refreshing it before it expires.
+
+    Threads share one token, and take it without locking while it is fresh.
+    If ``cache_path`` is given, the token is also stored there, so that other
+    processes using the same file (and this one, after a restart) can reuse it
+    rather than asking for a new one.  Refreshes are serialised with a lock on
+    the file, so only one process talks to the token endpoint at a time.
+
+    Call ``start()`` to refresh the token in a background thread, so that
+    fetches never wait for the token endpoint.
+
+    :param cache_path: File to share tokens through.  Tokens for several
+                       clients can be stored in the same file.
+    :param margin: Refresh the token this many seconds before it expires.
+    :param token_url: URL of the OAuth2 token endpoint.
+    :param metrics: ``monorail.metrics.Metrics`` to record token requests in.
+    """
+    self.client_id = client_id
+    self.client_secret = client_secret
+    self.cache_path = abspath(cache_path) if cache_path else None
+    self.margin = margin
+    self.token_url = token_url
+    self._key = sha256(client_id.encode('utf-8')).hexdigest()
+    self._session = MeteredSession(metrics) if metrics else requests.Session()
+    self._lock = Lock()
+    self._token = None
+    self._stopped = Event()
+    self._thread = None
+
+
+  def _fresh(self, token):
+    return token is not None and token[2] - self.margin > time()
+
+
+  def _read_cache(self):
+    if not exists(self.cache_path):
+      return {}
+    try:
+      with open(self.cache_path, 'rb') as f:
+        return load(f)
+    except ValueError:
+      # Damaged; we'll write a new one.
+      return {}
+
+
+  def _write_cache(self, tokens):
+    fd, tmp = mkstemp(dir=dirname(self.cache_path), prefix='.tokens-')
+    try:
+      f = fdopen(fd, 'w')
+    except:
+      close(fd)
+      raise
+    with f:
+      dump(tokens, f)
+    rename(tmp, self.cache_path)
+
+
+  def _refresh_cached(self, force):
+    """
+    Gets a fresh token via the cache file, holding a lock on it.
+    """
+    with open(self.cache_path + '.lock', 'a') as lock:
+      if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        tokens = self._read_cache()
+        cached = tokens.get(self._key)
+        if cached is not None:
+          cached = tuple(cached)
+          # Someone else may have refreshed the token while we waited.
+          if self._fresh(cached) and not (force and cached == self._token):
+            return cached
+
+        print('refreshing access token')
+        token = get_oauth_token(self.client_id, self.client_secret, self._session, self.token_url)
+
+        # Drop other clients' expired tokens while we're here.
+        now = time()
+        tokens = dict((k, v) for k, v in tokens.items() if v[2] > now)
+        tokens[self._key] = token
+        self._write_cache(tokens)
+        return token
+      finally:
+        if fcntl is not None:
+          fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+  def refresh(self, force=False):
+    """
+    Gets a new token if the current one is close to expiry.
+
+    :param force: Get a new token even if this one looks fresh (eg: because
+                  the server rejected it).
+    """
+    with self._lock:
+      if self._fresh(self._token) and not force:
+        return self._token
+
+      if self.cache_path:
+        self._token = self._refresh_cached(force)
+      else:
+        print('refreshing access token')
+        self._token = get_oauth_token(self.client_id, self.client_secret, self._session, self.token_url)
+      return self._token
+
+
+  def token(self):
+    """
+    Gets the current token, as a tuple of token, type, expiry (UNIX
+    timestamp).
+    """
+    token = self._token
+    if self._fresh(token):
+      return token
+    return self.refresh()
+
+
+  def header(self):
+    """
+    Gets the value to use in an Authorization header.
+    """
+    access_token, token_type, expiry = self.token()
+    return '%s %s' % (token_type, access_token)
+
+
+  def _run(self):
+    delay = 0
+    while not self._stopped.wait(delay):
+      try:
+        token = self.refresh()
+      except Exception as e:
+        print('token refresh failed (%s), retrying in %ds' % (e, RETRY_DELAY))
+        delay = RETRY_DELAY
+      else:
+        delay = max(RETRY_DELAY, token[2] - self.margin - time())
+
+
+  def start(self):
+    """
+    Starts refreshing the token in a background thread.
+    """
+    if self._thread is not None:
+      return
+    self._stopped.clear()
+    self._thread = Thread(target=self._run, name='token refresh')
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def stop(self):
+    """
+    Stops the background refresh thread.
+    """
+    if self._thread is None:
+      return
+    self._stopped.set()
+    self._thread.join()
+    self._thread = None
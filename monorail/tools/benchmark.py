@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/tools/benchmark.py - Benchmarks the tools against a mock portal
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+from ..opendata import DIRECT_GTFS, OpenData
+from .mock_portal import MockPortal
+
+from argparse import ArgumentParser
+from json import dump, loads
+from multiprocessing import Process, Queue
+from os import devnull
+from os.path import join
+import requests
+from resource import RUSAGE_SELF, getrusage
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+from time import time
+
+BENCHMARKS = ('get_swagger', 'get_keys', 'direct_download', 'download', 'gtfs_realtime')
+
+
+def percentile(values, p):
+  """
+  Gets the ``p``th percentile of a list of numbers (nearest rank).
+  """
+  if not values:
+    return 0.
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+def _run_portal(options, queue):
+  portal = MockPortal(latency=options.latency, rate=options.rate, burst=options.burst,
+    apis=options.apis, swagger_size=options.swagger_size,
+    direct_size=options.direct_size, entities=options.entities)
+  queue.put((portal.url, portal.api_root, portal.token_url, portal.username,
+             portal.password, portal.client_id, portal.client_secret,
+             portal.api_schema()))
+  portal.serve_forever()
+
+
+def _workload(name, portal, options, work_dir):
+  """
+  Runs one benchmark against the mock portal.
+  """
+  url, api_root, token_url, username, password, client_id, client_secret, schema = portal
+
+  if name == 'get_swagger':
+    from .get_swagger import get_swagger
+    get_swagger(username, password, work_dir, options.jobs, root=url)
+  elif name == 'get_keys':
+    from .get_keys import get_keys
+    get_keys(username, password, True, root=url)
+  elif name == 'direct_download':
+    OpenData(username, password, root=url).direct_download(DIRECT_GTFS).content
+  elif name == 'download':
+    OpenData(username, password, root=url).download(DIRECT_GTFS, join(work_dir, DIRECT_GTFS))
+  elif name == 'gtfs_realtime':
+    from .gtfs_realtime import gtfs_realtime
+    schema_path = join(work_dir, 'schema.json')
+    with open(schema_path, 'w') as f:
+      dump(schema, f)
+    gtfs_realtime(client_id, client_secret, join(work_dir, 'realtime'), options.frequency,
+      rate=1000., burst=options.jobs, jobs=options.jobs, token_url=token_url,
+      duration=options.duration, schema=schema_path)
+
+
+def _run_workload(name, portal, options, queue):
+  """
+  Runs a benchmark in its own process, so that its peak memory use is its
+  own.  Puts the elapsed time, peak RSS (bytes) and any error on ``queue``.
+  """
+  work_dir = mkdtemp(prefix='monorail-bench-')
+  error = None
+  start = time()
+  try:
+    with open(devnull, 'w') as null:
+      stdout = sys.stdout
+      sys.stdout = null
+      try:
+        _workload(name, portal, options, work_dir)
+      finally:
+        sys.stdout = stdout
+  except ImportError as e:
+    error = 'skipped (%s)' % e
+  except Exception as e:
+    error = 'failed (%s)' % e
+  finally:
+    elapsed = time() - start
+    rmtree(work_dir, ignore_errors=True)
+
+  # ru_maxrss is in KiB on Linux, bytes on macOS.
+  rss = getrusage(RUSAGE_SELF).ru_maxrss
+  if sys.platform != 'darwin':
+    rss *= 1024
+  queue.put((elapsed, rss, error))
+
+
+def benchmark(options):
+  """
+  Runs each benchmark against a mock portal in another process, and returns a
+  list of results.
+  """
+  queue = Queue()
+  server = Process(target=_run_portal, args=(options, queue))
+  server.daemon = True
+  server.start()
+  portal = queue.get()
+  stats_url = portal[0] + '_stats'
+  results = []
+
+  try:
+    for name in options.benchmarks:
+      requests.get(stats_url, params=dict(reset='1'))
+      worker = Process(target=_run_workload, args=(name, portal, options, queue))
+      worker.start()
+      elapsed, rss, error = queue.get()
+      worker.join()
+      stats = loads(requests.get(stats_url, params=dict(reset='1')).text)
+
+      result = dict(
+        name=name,
+        error=error,
+        elapsed=elapsed,
+        requests=stats['requests'],
+        bytes=stats['bytes'],
+        connections=stats['connections'],
+        statuses=stats['statuses'],
+        requests_per_sec=stats['requests'] / elapsed if elapsed else 0.,
+        bytes_per_sec=stats['bytes'] / elapsed if elapsed else 0.,
+        p50=percentile(stats['latencies'], 50),
+        p99=percentile(stats['latencies'], 99),
+        peak_rss=rss,
+      )
+      results.append(result)
+      print_result(result)
+  finally:
+    server.terminate()
+    server.join()
+
+  return results
+
+
+def print_result(result):
+  if result['error']:
+    print('%-16s %s' % (result['name'], result['error']))
+    return
+
+  print('%-16s %6d req %8.1f req/s %8.2f MiB/s  p50 %7.1fms  p99 %7.1fms  '
+        'RSS %6.1f MiB  %d conn  %.2fs' % (
+    result['name'], result['requests'], result['requests_per_sec'],
+    result['bytes_per_sec'] / 1048576., result['p50'] * 1000., result['p99'] * 1000.,
+    result['peak_rss'] / 1048576., result['connections'], result['elapsed']))
+
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument('benchmarks',
+    nargs='*',
+    default=BENCHMARKS,
+    help='Benchmarks to run (%s) [default: all]' % ', '.join(BENCHMARKS))
+
+  parser.add_argument('-o', '--output',
+    help='Also write the results to this file as JSON.')
+
+  parser.add_argument('-j', '--jobs',
+    type=int,
+    default=4,
+    help='Number of requests the tools may make at once [default: %(default)s]')
+
+  parser.add_argument('-d', '--duration',
+    type=float,
+    default=10.,
+    help='Seconds to run the gtfs_realtime loop for [default: %(default)s]')
+
+  parser.add_argument('-f', '--frequency',
+    type=int,
+    default=1,
+    help='Seconds between gtfs_realtime updates [default: %(default)s]')
+
+  parser.add_argument('-l', '--latency',
+    type=float,
+    default=0.,
+    help='Delay every response from the mock portal by this many seconds [default: %(default)s]')
+
+  parser.add_argument('-r', '--rate',
+    type=float,
+    help='Mock portal answers 429 to requests over this many per second [default: unlimited]')
+
+  parser.add_argument('-b', '--burst',
+    type=int,
+    default=10,
+    help='Number of requests allowed in a burst, with --rate [default: %(default)s]')
+
+  parser.add_argument('-n', '--apis',
+    type=int,
+    default=20,
+    help='Number of APIs in the mock catalogue [default: %(default)s]')
+
+  parser.add_argument('-S', '--swagger-size',
+    type=int,
+    default=64 * 1024,
+    help='Size of each Swagger document, in bytes [default: %(default)s]')
+
+  parser.add_argument('-D', '--direct-size',
+    type=int,
+    default=16 * 1024 * 1024,
+    help='Size of each direct download, in bytes [default: %(default)s]')
+
+  parser.add_argument('-e', '--entities',
+    type=int,
+    default=500,
+    help='Number of entities in each realtime feed [default: %(default)s]')
+
+  options = parser.parse_args()
+  for name in options.benchmarks:
+    if name not in BENCHMARKS:
+      parser.error('unknown benchmark %r' % name)
+
+  results = benchmark(options)
+  if options.output:
+    with open(options.output, 'w') as f:
+      dump(results, f, indent=2)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/tools/export.py - Exports harvested snapshots to Parquet / Arrow
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+from ..export import DEFAULT_BATCH_SIZE, FORMATS, export
+from .replay import parse_time
+
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+from time import time
+
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument('-i', '--input-dir',
+    required=True,
+    help='Directory of harvested snapshots (loose .pb files and/or an archive).')
+
+  parser.add_argument('-o', '--output-dir',
+    required=True,
+    help='Directory to write partitions into.')
+
+  parser.add_argument('-f', '--format',
+    choices=sorted(FORMATS),
+    default='parquet',
+    help='Format to write [default: %(default)s]')
+
+  parser.add_argument('-j', '--jobs',
+    type=int,
+    default=cpu_count(),
+    help='Number of processes to decode snapshots in [default: %(default)s]')
+
+  parser.add_argument('-b', '--batch-size',
+    type=int,
+    default=DEFAULT_BATCH_SIZE,
+    help='Rows each process decodes before writing them out [default: %(default)s]')
+
+  parser.add_argument('-F', '--feed',
+    action='append',
+    help='Only export this feed (eg: sydtrains_pos).  Give more than once for several feeds [default: all]')
+
+  parser.add_argument('-s', '--start',
+    type=parse_time,
+    help='Start at the day this time is on (UNIX timestamp, or local YYYY-MM-DDTHH:MM) [default: the beginning]')
+
+  parser.add_argument('-e', '--end',
+    type=parse_time,
+    help='Stop at the end of the day this time is on (or before it, if it is midnight) [default: the end]')
+
+  parser.add_argument('--force',
+    action='store_true',
+    help='Export every partition again, even if it is up to date.')
+
+  options = parser.parse_args()
+
+  started = time()
+  partitions = snapshots = rows = 0
+  for path, count, written, bad, elapsed in export(
+      options.input_dir, options.output_dir, options.feed, options.start,
+      options.end, options.format, options.jobs, options.batch_size, options.force):
+    print('Exported %d snapshot(s), %d row(s) in %.2fs' % (count, written, elapsed))
+    print('  %s' % path)
+    if bad:
+      print('  %d snapshot(s) could not be decoded' % bad)
+    partitions += 1
+    snapshots += count
+    rows += written
+
+  elapsed = time() - started
+  print('Exported %d partition(s), %d snapshot(s), %d row(s) in %.2fs (%.0f snapshots/sec)' % (
+    partitions, snapshots, rows, elapsed, snapshots / elapsed if elapsed else 0))
+
+if __name__ == '__main__':
+  main()
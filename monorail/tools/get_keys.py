@@ -18,16 +18,22 @@
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import, print_function
-from ..opendata import OpenData
+from ..opendata import APPLICATION_SELECT, OPENDATA_ROOT, OpenData
 
 from argparse import ArgumentParser
 
 
-def get_keys(username, password, no_secret):
-  portal = OpenData(username, password)
-  apps = portal.applications()
-  
-  print('You have %d application(s) registered to %r.' % (len(apps), username))
+def get_keys(username, password, no_secret, root=OPENDATA_ROOT):
+  portal = OpenData(username, password, root=root)
+  select = 'Uuid,Name,ApiKey' if no_secret else APPLICATION_SELECT
+  apps = portal.iter_applications(select=select)
+  total = apps.total
+  if total is None:
+    # The server didn't count them for us.
+    apps = list(apps)
+    total = len(apps)
+
+  print('You have %d application(s) registered to %r.' % (total, username))
   print('')
 
   for app in apps:
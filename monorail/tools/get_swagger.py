@@ -18,35 +18,77 @@
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import, print_function
-from ..opendata import OpenData
+from ..opendata import OPENDATA_ROOT, OpenData
 
 from argparse import ArgumentParser
 from json import dump
+from multiprocessing.pool import ThreadPool
 from os import makedirs
 from os.path import exists, join
+from time import time
 
 
-def get_swagger(username, password, output_dir):
-  if not exists(output_dir):
-    makedirs(output_dir)
-  portal = OpenData(username, password)
+def fetch_swagger(portal, service, output_dir):
+  """
+  Fetches the Swagger for a single service and writes it out.
 
-  print('Getting service catalogue...')
-  catalogue = portal.catalogs()
-  
-  for service in catalogue:
-    slug_name = str(service['SsgUrl']).strip('*/').replace('/', '_') + '.json'
-    print('Fetching %r...' % str(service['Name']))
-    print('  %s' % slug_name)
-    
+  Returns a tuple of the service, the file name, the time taken in seconds,
+  and the exception raised (or None on success).
+  """
+  slug_name = str(service['SsgUrl']).strip('*/').replace('/', '_') + '.json'
+  start = time()
+
+  try:
     # Get the Swagger
     swagger = portal.swagger(service['Uuid'])
-    
+
     # Write it out
     with open(join(output_dir, slug_name), 'wb') as f:
       dump(swagger, f, indent=2)
+  except Exception as e:
+    return service, slug_name, time() - start, e
+
+  return service, slug_name, time() - start, None
+
+
+def get_swagger(username, password, output_dir, jobs=1, root=OPENDATA_ROOT):
+  if not exists(output_dir):
+    makedirs(output_dir)
+  portal = OpenData(username, password, pool_size=jobs, root=root)
+
+  print('Getting service catalogue...')
+  catalogue = portal.iter_catalogs(select='Uuid,Name,SsgUrl')
 
-  print('All done!')
+  # The catalogue request has logged us in, so all the threads can share that
+  # session.  Schemas are fetched as each page of the catalogue arrives.
+  pool = ThreadPool(jobs)
+  failed = []
+  fetched = 0
+  start = time()
+
+  try:
+    results = pool.imap_unordered(
+      lambda service: fetch_swagger(portal, service, output_dir), catalogue)
+
+    for service, slug_name, elapsed, error in results:
+      if error is None:
+        print('Fetched %r in %.2fs' % (str(service['Name']), elapsed))
+        print('  %s' % slug_name)
+        fetched += 1
+      else:
+        print('Failed %r after %.2fs: %s' % (str(service['Name']), elapsed, error))
+        failed.append(service)
+  finally:
+    pool.close()
+    pool.join()
+
+  print('Fetched %d API(s) in %.2fs.' % (fetched, time() - start))
+  if failed:
+    print('%d API(s) failed:' % len(failed))
+    for service in failed:
+      print('  %s' % str(service['Name']))
+  else:
+    print('All done!')
 
 def main():
   parser = ArgumentParser()
@@ -62,8 +104,13 @@ def main():
     required=True,
     help='Directory to output schemas into.  Will overwrite files.')
 
+  parser.add_argument('-j', '--jobs',
+    type=int,
+    default=4,
+    help='Number of schemas to fetch at once [default: %(default)s]')
+
   options = parser.parse_args()
-  get_swagger(options.username, options.password, options.output)
+  get_swagger(options.username, options.password, options.output, options.jobs)
 
 if __name__ == '__main__':
   main()
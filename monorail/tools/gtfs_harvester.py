@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/tools/gtfs_harvester.py - asyncio version of gtfs_realtime
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+# This tool requires Python 3.5+ and aiohttp.
+
+import aiohttp
+import asyncio
+from argparse import ArgumentParser
+from os import fdopen, makedirs, remove
+from os.path import exists
+from signal import SIGINT, SIGTERM
+from tempfile import mkstemp
+from time import time
+
+from ..credentials import TOKEN_URL, CredentialPool
+from ..delta import DEFAULT_KEYFRAME_INTERVAL
+from ..metrics import Metrics, endpoint_name
+from ..scheduler import TokenBucket, next_backoff, retry_after
+from ..archive import SegmentArchive
+from ..snapshot import SnapshotWriter
+
+API_ROOT = 'https://api.transport.nsw.gov.au/v1'
+
+# Refresh the token this many seconds before it expires.
+TOKEN_MARGIN = 300
+
+# Bytes to read at a time when streaming a timetable to disk.
+CHUNK_SIZE = 256 * 1024
+
+# Feeds available for each mode: feed name -> (path, output file suffix)
+FEEDS = {
+  'alerts': ('/gtfs/alerts/%s', '_alerts.pb'),
+  'stop_times': ('/gtfs/realtime/%s', '_stops.pb'),
+  'vehicle_positions': ('/gtfs/vehiclepos/%s', '_pos.pb'),
+  'timetables': ('/gtfs/schedule/%s', '_tt.zip'),
+}
+
+MODES = {
+  'sydtrains': 'sydneytrains',
+  'nswtrains': 'nswtrains',
+  'lightrail': 'lightrail',
+  'ferries': 'ferries',
+  'buses': 'buses',
+}
+
+
+class Harvester(object):
+  def __init__(self, client_id, client_secret, output_dir, intervals, rate=1.,
+               burst=5, connections=8, archive_dir=None, metrics=None,
+               keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, api_root=API_ROOT,
+               token_url=TOKEN_URL):
+    """
+    Downloads realtime feeds from TfNSW into a directory, using asyncio.
+
+    All feeds share one pool of keep-alive connections.  Fetching, writing
+    files and refreshing the OAuth token each run as separate tasks, so a slow
+    disk or token refresh doesn't hold up polling.
+
+    Requests are spread across API keys with a ``CredentialPool``, each with
+    its own token.
+
+    :param client_id: Client ID to authenticate with, or a list of them.
+    :param client_secret: Client secret, or a list of them in the same order
+                          as ``client_id``.
+    :param intervals: dict of feed name -> seconds between fetches.  Feeds
+                      not listed are not fetched.
+    :param rate: Maximum number of requests per second.
+    :param burst: Maximum number of requests to make at once.
+    :param connections: Maximum number of connections to the API server.
+    :param archive_dir: Directory to keep an archive of every snapshot in.
+    :param keyframe_interval: Delta-code the archive, with a whole snapshot
+                              this often.  0 stores every snapshot whole.
+    :param metrics: ``monorail.metrics.Metrics`` to record requests and
+                    fetches in.
+    :param api_root: URL of the API server (eg:
+                     ``monorail.tools.mock_portal``).
+    :param token_url: URL of the OAuth2 token endpoint.
+    """
+    if not isinstance(client_id, (list, tuple)):
+      client_id, client_secret = [client_id], [client_secret]
+    self.pool = CredentialPool(list(zip(client_id, client_secret)))
+    # The value for each key's Authorization header, once it has a token.
+    # (gtfs_realtime keeps a TokenManager in ``tokens`` instead.)
+    for credential in self.pool:
+      credential.authorization = None
+    self.output_dir = output_dir
+    self.intervals = intervals
+    self.bucket = TokenBucket(rate, burst)
+    self.connections = connections
+    self.archive_dir = archive_dir
+    self.keyframe_interval = keyframe_interval
+    self.metrics = metrics
+    self.api_root = api_root.rstrip('/')
+    self.token_url = token_url
+
+    self._token_ready = asyncio.Event()
+    self._stop = asyncio.Event()
+    self._writes = asyncio.Queue()
+
+
+  def stop(self):
+    """
+    Stops the harvester.  Pending writes are still completed.
+    """
+    self._stop.set()
+
+
+  async def _sleep(self, seconds):
+    """
+    Sleeps for a number of seconds, or until we are stopped.
+
+    Returns True if we were stopped.
+    """
+    try:
+      await asyncio.wait_for(self._stop.wait(), seconds)
+    except asyncio.TimeoutError:
+      return False
+    return True
+
+
+  async def _refresh_token(self, session, credential):
+    """
+    Keeps the OAuth2 token of one API key up to date, refreshing it before it
+    expires.
+    """
+    while not self._stop.is_set():
+      start = time()
+      try:
+        async with session.post(self.token_url, data='',
+            auth=aiohttp.BasicAuth(credential.client_id, credential.client_secret)) as response:
+          body = await response.read()
+          if self.metrics:
+            self.metrics.request(endpoint_name(self.token_url), response.status,
+                                 time() - start, len(body), response.headers)
+          assert response.status == 200, 'unexpected response code (%d)' % response.status
+          result = await response.json()
+      except Exception as e:
+        print('failed to refresh access token (%s)' % e)
+        if await self._sleep(30):
+          return
+        continue
+
+      print('refreshed access token')
+      credential.authorization = '%s %s' % (result['token_type'], result['access_token'])
+      self._token_ready.set()
+
+      if await self._sleep(max(30, int(result['expires_in']) - TOKEN_MARGIN)):
+        return
+
+
+  async def _stream(self, response, name):
+    """
+    Streams a response into a temporary file in the output directory, rather
+    than holding it in memory.
+
+    Returns the path to the file, and its size.
+    """
+    loop = asyncio.get_event_loop()
+    fd, tmp = mkstemp(dir=self.output_dir, prefix='.' + name)
+    size = 0
+    try:
+      with fdopen(fd, 'wb') as f:
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+          await loop.run_in_executor(None, f.write, chunk)
+          size += len(chunk)
+    except:
+      remove(tmp)
+      raise
+    return tmp, size
+
+
+  async def _fetch(self, session, mode, feed):
+    """
+    Fetches a single feed forever, queueing each response to be written out.
+    """
+    path, suffix = FEEDS[feed]
+    url = self.api_root + (path % MODES[mode])
+    filename = mode + suffix
+    endpoint = endpoint_name(url)
+    interval = self.intervals[feed]
+    backoff = 0
+    due = None
+
+    await self._token_ready.wait()
+
+    while not self._stop.is_set():
+      wait = self.bucket.consume()
+      if wait:
+        if await self._sleep(wait):
+          return
+        continue
+
+      try:
+        start = time()
+        status = None
+        headers = None
+        body = b''
+        path = None
+        size = 0
+        error = None
+        credential = self.pool.acquire(lambda c: c.authorization is not None)
+        try:
+          async with session.get(url, headers={'Authorization': credential.authorization}) as response:
+            status = response.status
+            headers = response.headers
+            if status == 200 and suffix.endswith('.zip'):
+              # Timetables are big, so go straight to a file rather than memory.
+              path, size = await self._stream(response, filename)
+            else:
+              body = await response.read()
+              size = len(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+          print('%s %s: failed (%s)' % (mode, feed, e))
+          error = e
+        finally:
+          self.pool.release(credential, status, headers)
+
+        if self.metrics:
+          self.metrics.request(endpoint, status, time() - start, size, headers)
+          if status != 200 and error is None:
+            error = 'unexpected response code (%d)' % status
+          self.metrics.fetch('%s %s' % (mode, feed), time() - start,
+                             (start - due) if due else 0., error)
+
+        if status == 200:
+          backoff = 0
+          if path is not None:
+            await self._writes.put(('move', filename, path))
+          else:
+            await self._writes.put(('write', filename, body))
+          delay = interval - (time() - start)
+        elif status == 429 and self.pool.available():
+          # That key is out of rotation, but another can take over now.
+          delay = 0
+        elif status is None or status == 429 or status >= 500:
+          backoff = next_backoff(backoff, interval)
+          if status == 429:
+            self.bucket.drain(retry_after(headers))
+          print('%s %s: failed (%s), backing off for %gs' % (mode, feed, status, backoff))
+          delay = backoff
+        else:
+          print('%s %s: unexpected response code (%d)' % (mode, feed, status))
+          delay = interval - (time() - start)
+      except Exception as e:
+        # Anything else (eg: a bug) would end this feed's task silently, so
+        # log it and keep polling.
+        backoff = next_backoff(backoff, interval)
+        print('%s %s: failed (%r), backing off for %gs' % (mode, feed, e, backoff))
+        delay = backoff
+
+      due = time() + max(0, delay)
+      if await self._sleep(max(0, delay)):
+        return
+
+
+  async def _writer(self):
+    """
+    Writes fetched feeds to disk, skipping any which have not changed.
+    """
+    loop = asyncio.get_event_loop()
+    archive = SegmentArchive(self.archive_dir, keyframe_interval=self.keyframe_interval) if self.archive_dir else None
+    writer = SnapshotWriter(self.output_dir, archive)
+    try:
+      while True:
+        item = await self._writes.get()
+        if item is None:
+          return
+        method, name, data = item
+        try:
+          await loop.run_in_executor(None, getattr(writer, method), name, data)
+        except Exception as e:
+          # Keep writing the other feeds.
+          print('%s: write failed (%r)' % (name, e))
+    finally:
+      if archive is not None:
+        archive.close()
+
+
+  async def run(self):
+    if not exists(self.output_dir):
+      makedirs(self.output_dir)
+
+    connector = aiohttp.TCPConnector(limit=self.connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+      writer = asyncio.ensure_future(self._writer())
+      tasks = [asyncio.ensure_future(self._refresh_token(session, credential))
+               for credential in self.pool]
+      refreshers = len(tasks)
+      for mode in MODES:
+        for feed in self.intervals:
+          if feed == 'alerts' and mode != 'sydtrains':
+            continue
+          tasks.append(asyncio.ensure_future(self._fetch(session, mode, feed)))
+
+      print('started %d feed(s) with %d API key(s)' % (len(tasks) - refreshers, refreshers))
+      await self._stop.wait()
+
+      # Let in-flight fetches finish, then flush writes
+      self._token_ready.set()
+      for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+          print('task failed (%r)' % result)
+      await self._writes.put(None)
+      await writer
+    print('stopped')
+
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument('-c', '--client-id',
+    action='append',
+    required=True,
+    help='Client ID (api key) to use to authenticate.  Give more than once to spread requests across several keys.')
+
+  parser.add_argument('-s', '--client-secret',
+    action='append',
+    required=True,
+    help='Client Secret (shared secret) to use to authenticate, once for each --client-id.')
+
+  parser.add_argument('-o', '--output-dir',
+    required=True,
+    help='Output directory for feed files.')
+
+  parser.add_argument('-f', '--frequency',
+    type=int,
+    help='Wait this many seconds between stop time updates [default: %(default)s]',
+    default=60)
+
+  parser.add_argument('-P', '--positions-frequency',
+    type=int,
+    help='Wait this many seconds between vehicle position updates [default: %(default)s]',
+    default=15)
+
+  parser.add_argument('-A', '--alerts-frequency',
+    type=int,
+    help='Wait this many seconds between alert updates [default: %(default)s]',
+    default=300)
+
+  parser.add_argument('-T', '--timetable-frequency',
+    type=int,
+    help='Wait this many seconds between timetable updates [default: %(default)s]',
+    default=86400)
+
+  parser.add_argument('-r', '--rate',
+    type=float,
+    help='Maximum number of requests per second, to stay within the API quota [default: %(default)s]',
+    default=1.)
+
+  parser.add_argument('-b', '--burst',
+    type=int,
+    help='Maximum number of requests to make at once [default: %(default)s]',
+    default=5)
+
+  parser.add_argument('-n', '--connections',
+    type=int,
+    help='Maximum number of connections to the API server [default: %(default)s]',
+    default=8)
+
+  parser.add_argument('-a', '--archive-dir',
+    help='Also keep every snapshot of the realtime feeds in an archive in this directory.')
+
+  parser.add_argument('-K', '--keyframe-interval',
+    type=int,
+    default=DEFAULT_KEYFRAME_INTERVAL,
+    help='Only store changed entities in the archive, with a whole snapshot this often (0 to store every snapshot whole) [default: %(default)s]')
+
+  parser.add_argument('-m', '--metrics-port',
+    type=int,
+    help='Serve metrics for Prometheus on this port.')
+
+  parser.add_argument('--api-root',
+    default=API_ROOT,
+    help='URL of the API server (eg: a mock_portal) [default: %(default)s]')
+
+  parser.add_argument('--token-url',
+    default=TOKEN_URL,
+    help='URL of the OAuth2 token endpoint [default: %(default)s]')
+
+  options = parser.parse_args()
+  if len(options.client_id) != len(options.client_secret):
+    parser.error('give a --client-secret for each --client-id')
+
+  intervals = {
+    'alerts': options.alerts_frequency,
+    'stop_times': options.frequency,
+    'vehicle_positions': options.positions_frequency,
+    'timetables': options.timetable_frequency,
+  }
+
+  metrics = None
+  if options.metrics_port:
+    metrics = Metrics()
+    metrics.serve(options.metrics_port)
+
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  harvester = Harvester(options.client_id, options.client_secret,
+    options.output_dir, intervals, options.rate, options.burst,
+    options.connections, options.archive_dir, metrics, options.keyframe_interval,
+    options.api_root, options.token_url)
+
+  for sig in (SIGINT, SIGTERM):
+    loop.add_signal_handler(sig, harvester.stop)
+
+  loop.run_until_complete(harvester.run())
+  loop.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -17,120 +17,187 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
-from __future__ import print_function
+from __future__ import absolute_import, print_function
 
 from argparse import ArgumentParser
-from datetime import datetime, timedelta
-from os import makedirs
-from os.path import exists, join
-import requests
-from shutil import move
-from time import sleep
-import tfnsw_api
+from os import close, makedirs, remove
+from os.path import exists
+from tempfile import mkstemp
+from threading import Timer
 
+from ..credentials import CredentialPool, discover_credentials
+from ..delta import DEFAULT_KEYFRAME_INTERVAL
+from ..metrics import Metrics
+from ..opendata import OPENDATA_ROOT, OpenData
+from ..realtime import RealtimeClient
+from ..scheduler import Scheduler
+from ..archive import SegmentArchive
+from ..relay import Relay
+from ..snapshot import SnapshotWriter
+from ..tokens import TOKEN_URL, TokenManager
 
 
-def get_oauth_token(client_id, client_secret):
-  """
-  Gets an OAuth2 bearer token using an Application flow from the API server.
-  
-  Returns a tuple of token, type, expiry(UTC)
+
+def gtfs_realtime(client_id, client_secret, output_dir, frequency,
+                  positions_frequency=None, alerts_frequency=300,
+                  timetable_frequency=86400, rate=1., burst=5, jobs=4,
+                  archive_dir=None, token_cache=None, api_root=None,
+                  token_url=TOKEN_URL, duration=None, metrics_port=None,
+                  schema=None, relay_port=None, username=None, password=None,
+                  portal_root=OPENDATA_ROOT, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
   """
-  response = requests.post('https://api.transport.nsw.gov.au/auth/oauth/v2/token?scope=user&grant_type=client_credentials',
-    auth=(client_id, client_secret), data='')
-  
-  assert response.status_code == 200, 'unexpected response code (%d)' % response.status_code
-  response = response.json()
-  
-  # Parse the result
-  access_token = response['access_token']
-  token_type = response['token_type']
-  expiry = datetime.utcnow() + timedelta(seconds=int(response['expires_in']))
-  return access_token, token_type, expiry
+  Downloads the realtime feeds into ``output_dir``, until interrupted.
 
+  :param client_id: Client ID to authenticate with, or a list of them to
+                    spread requests across.
+  :param client_secret: Client secret, or a list of them in the same order
+                        as ``client_id``.
 
-def gtfs_realtime(client_id, client_secret, output_dir, frequency):
+  :param api_root: URL of the API server, if not the one in the schema (eg:
+                   ``monorail.tools.mock_portal``).
+  :param token_url: URL of the OAuth2 token endpoint.
+  :param duration: Stop after this many seconds.
+  :param metrics_port: Serve metrics in the Prometheus text format on this
+                       port.
+  :param schema: Path to the API schema made by ``swaggify``.
+  :param relay_port: Serve the latest realtime snapshots over HTTP on this
+                     port (see ``monorail.relay``).
+  :param username: Log in to the portal with this username (and
+                   ``password``) to also use every application's API key.
+  :param portal_root: URL of the portal, for ``username``.
+  :param keyframe_interval: Delta-code the archive, with a whole snapshot this
+                            often (see ``monorail.delta``).  0 stores every
+                            snapshot whole.
+  """
+  assert schema, 'an API schema from swaggify is required'
   if not exists(output_dir):
     makedirs(output_dir)
 
-  next_update = None
-  access_token = token_type = expiry = None
-  update_num = 0
+  if positions_frequency is None:
+    positions_frequency = frequency
 
+  archive = SegmentArchive(archive_dir, keyframe_interval=keyframe_interval) if archive_dir else None
+  relay = server = None
+  if relay_port:
+    relay = Relay()
+    server = relay.serve(relay_port)
+  writer = SnapshotWriter(output_dir, archive, relay)
+  metrics = None
+  if metrics_port:
+    metrics = Metrics()
+    metrics.serve(metrics_port)
+
+  if isinstance(client_id, (list, tuple)):
+    credentials = list(zip(client_id, client_secret))
+  else:
+    credentials = [(client_id, client_secret)] if client_id else []
+  if username:
+    print('getting API keys from the portal')
+    for credential in discover_credentials(OpenData(username, password, root=portal_root)):
+      if credential not in credentials:
+        credentials.append(credential)
+  assert credentials, 'no API keys (the portal account has no applications with keys)'
+
+  tokens = CredentialPool(credentials)
+  for credential in tokens:
+    credential.tokens = TokenManager(credential.client_id, credential.client_secret,
+      token_cache, token_url=token_url, metrics=metrics)
+  print('using %d API key(s)' % len(tokens))
+  client = RealtimeClient(schema, tokens, api_root, pool_size=jobs, metrics=metrics)
+
+  # mode -> API tag in the schema
   apis = {
-    'sydtrains': tfnsw_api.SydneytrainsApi(),
-    #'nswtrains': tfnsw_api.NswtrainsApi(),
-    'lightrail': tfnsw_api.LightrailApi(),
-    'ferries': tfnsw_api.FerriesApi(),
-    #'buses': tfnsw_api.BusesApi(),
+    'sydtrains': 'sydneytrains',
+    #'nswtrains': 'nswtrains',
+    'lightrail': 'lightrail',
+    'ferries': 'ferries',
+    #'buses': 'buses',
   }
-  
-  # now run a loop!
-  while True:
+
+  def stream(name, api, method):
+    # Timetables are big, so go straight to a file rather than memory.
+    fd, tmp = mkstemp(dir=output_dir, prefix='.' + name)
     try:
-      # Wait a bit for next update
-      while (next_update is not None and next_update > datetime.utcnow()):
-        sleep(0.5)
-      
-      # Record the start of our execution
-      loop_start = datetime.utcnow()
-      print('starting loop')
-      
-      # Check if we need to refresh
-      if not expiry or expiry < (datetime.utcnow() + timedelta(seconds=frequency*5)):
-        # We need to refresh
-        print('refreshing access token')
-        access_token, token_type, expiry = get_oauth_token(client_id, client_secret)
-
-        tfnsw_api.Configuration().auth_settings = lambda: {'oauth2': {
-          'in': 'header',
-          'key': 'Authorization',
-          'value': ('%s %s' % (token_type, access_token))
-        }}
-      
-      # Start fetching the different APIs
-      print('fetching apis')
-      
-      for mode, api in apis.iteritems():
-        print ('...%s' % mode)
-        if mode == 'sydtrains':
-          alerts = api.alerts()
-          move(alerts, join(output_dir, mode + '_alerts.pb'))
-          sleep(1)
-
-        stop_times = api.stop_times()
-        move(stop_times, join(output_dir, mode + '_stops.pb'))
-        sleep(1)
-
-        vehicle_positions = api.vehicle_positions()
-        move(vehicle_positions, join(output_dir, mode + '_pos.pb'))
-        sleep(1)
-      
-        if update_num == 0:
-          print('Also fetching timetable')
-          # Every day, fetch the timetables
-          timetables = api.timetables()
-          move(timetables, join(output_dir, mode + '_tt.zip'))
-          sleep(1)
-      
-      # Schedule next update
-      next_update = loop_start + timedelta(seconds=frequency)
-      update_num += 1
-      if update_num > 3600:
-        update_num = 0
-      print('Done, waiting for next run')
-    except KeyboardInterrupt:
-      break
+      client.download(api, method, fd)
+    except:
+      close(fd)
+      remove(tmp)
+      raise
+    close(fd)
+    return writer.move(name, tmp)
+
+  def fetcher(mode, api, method, suffix):
+    def fetch():
+      if suffix.endswith('.zip'):
+        changed = stream(mode + suffix, api, method)
+      else:
+        changed = writer.write(mode + suffix, client.get(api, method))
+
+      if changed:
+        print('...%s %s' % (mode, method))
+      else:
+        print('...%s %s unchanged' % (mode, method))
+    return fetch
+
+  scheduler = Scheduler(rate, burst, jobs, metrics=metrics)
+
+  for mode, api in apis.iteritems():
+    if mode == 'sydtrains':
+      scheduler.add(mode + ' alerts', alerts_frequency,
+        fetcher(mode, api, 'alerts', '_alerts.pb'))
+
+    scheduler.add(mode + ' stop_times', frequency,
+      fetcher(mode, api, 'stop_times', '_stops.pb'))
+    scheduler.add(mode + ' vehicle_positions', positions_frequency,
+      fetcher(mode, api, 'vehicle_positions', '_pos.pb'))
+    scheduler.add(mode + ' timetables', timetable_frequency,
+      fetcher(mode, api, 'timetables', '_tt.zip'))
+
+  # now run a loop!
+  print('starting loop')
+  for credential in tokens:
+    credential.tokens.refresh()
+    credential.tokens.start()
+  timer = None
+  if duration:
+    timer = Timer(duration, scheduler.stop)
+    timer.start()
+
+  try:
+    scheduler.run()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if timer is not None:
+      timer.cancel()
+    for credential in tokens:
+      credential.tokens.stop()
+    if archive is not None:
+      archive.close()
+    if server is not None:
+      server.shutdown()
 
 def main():
   parser = ArgumentParser()
   parser.add_argument('-c', '--client-id',
-    required=True,
-    help='Client ID (api key) to use to authenticate.')
+    action='append',
+    default=[],
+    help='Client ID (api key) to use to authenticate.  Give more than once to spread requests across several keys.')
   
   parser.add_argument('-s', '--client-secret',
+    action='append',
+    default=[],
+    help='Client Secret (shared secret) to use to authenticate, once for each --client-id.')
+
+  parser.add_argument('-u', '--username',
+    help='Also use the API keys of every application registered to this portal account.')
+
+  parser.add_argument('-p', '--password',
+    help='Password for --username.')
+
+  parser.add_argument('-S', '--schema',
     required=True,
-    help='Client Secret (shared secret) to use to authenticate.')
+    help='API schema made by swaggify.')
 
   parser.add_argument('-o', '--output-dir',
     required=True,
@@ -141,8 +208,67 @@ def main():
     help='Wait this many seconds between updates [default: %(default)s]',
     default=60)
 
+  parser.add_argument('-P', '--positions-frequency',
+    type=int,
+    help='Wait this many seconds between vehicle position updates [default: same as --frequency]')
+
+  parser.add_argument('-A', '--alerts-frequency',
+    type=int,
+    help='Wait this many seconds between alert updates [default: %(default)s]',
+    default=300)
+
+  parser.add_argument('-T', '--timetable-frequency',
+    type=int,
+    help='Wait this many seconds between timetable updates [default: %(default)s]',
+    default=86400)
+
+  parser.add_argument('-r', '--rate',
+    type=float,
+    help='Maximum number of requests per second, to stay within the API quota [default: %(default)s]',
+    default=1.)
+
+  parser.add_argument('-b', '--burst',
+    type=int,
+    help='Maximum number of requests to make at once [default: %(default)s]',
+    default=5)
+
+  parser.add_argument('-j', '--jobs',
+    type=int,
+    help='Number of fetches to run at the same time [default: %(default)s]',
+    default=4)
+
+  parser.add_argument('-a', '--archive-dir',
+    help='Also keep every snapshot of the realtime feeds in an archive in this directory.')
+
+  parser.add_argument('-K', '--keyframe-interval',
+    type=int,
+    default=DEFAULT_KEYFRAME_INTERVAL,
+    help='Only store changed entities in the archive, with a whole snapshot this often (0 to store every snapshot whole) [default: %(default)s]')
+
+  parser.add_argument('-t', '--token-cache',
+    help='Share access tokens with other processes (and restarts) through this file.')
+
+  parser.add_argument('-m', '--metrics-port',
+    type=int,
+    help='Serve metrics for Prometheus on this port.')
+
+  parser.add_argument('-R', '--relay-port',
+    type=int,
+    help='Serve the latest realtime snapshots to other consumers over HTTP on this port.')
+
   options = parser.parse_args()
-  gtfs_realtime(options.client_id, options.client_secret, options.output_dir, options.frequency)
+  if len(options.client_id) != len(options.client_secret):
+    parser.error('give a --client-secret for each --client-id')
+  if not options.client_id and not options.username:
+    parser.error('give a --client-id and --client-secret, or a --username')
+
+  gtfs_realtime(options.client_id, options.client_secret, options.output_dir,
+    options.frequency, options.positions_frequency, options.alerts_frequency,
+    options.timetable_frequency, options.rate, options.burst, options.jobs,
+    options.archive_dir, options.token_cache, metrics_port=options.metrics_port,
+    schema=options.schema, relay_port=options.relay_port,
+    username=options.username, password=options.password,
+    keyframe_interval=options.keyframe_interval)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,584 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/tools/mock_portal.py - Local stand-in for the TfNSW portal and API
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+from ..scheduler import TokenBucket
+
+from argparse import ArgumentParser
+from base64 import b64decode
+from binascii import hexlify
+from google.transit import gtfs_realtime_pb2
+from json import dumps
+from os import urandom
+import re
+from threading import Lock, Thread
+from time import sleep, time
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urlparse import parse_qs, urlsplit
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import parse_qs, urlsplit
+
+# Size of each block written when sending a direct download.
+BLOCK_SIZE = 64 * 1024
+
+# Realtime feed paths on the API server: path -> kind of feed.
+FEED_PATH = re.compile(r'^/v1/gtfs/(alerts|realtime|vehiclepos|schedule)/([a-z]+)$')
+SWAGGER_PATH = re.compile(r'^/admin/apidescriptor/([0-9a-f-]+)/swagger$')
+
+# Realtime feeds: kind -> operationId, as named by swaggify.
+FEED_OPERATIONS = {
+  'alerts': 'alerts',
+  'realtime': 'stopTimes',
+  'vehiclepos': 'vehiclePositions',
+  'schedule': 'timetables',
+}
+
+MODES = ('sydneytrains', 'nswtrains', 'lightrail', 'ferries', 'buses')
+
+# Centre of the fake vehicle positions (Sydney CBD).
+CENTRE_LAT = -33.87
+CENTRE_LON = 151.21
+
+DIRECT_MODIFIED = 'Sat, 01 Oct 2016 00:00:00 GMT'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    # Stats are collected by the portal instead.
+    pass
+
+
+  def setup(self):
+    BaseHTTPRequestHandler.setup(self)
+    self.server.portal._connected()
+
+
+  def do_GET(self):
+    self.server.portal._handle(self, 'GET')
+
+
+  def do_POST(self):
+    self.server.portal._handle(self, 'POST')
+
+
+class MockPortal(object):
+  def __init__(self, host='127.0.0.1', port=0, latency=0., rate=None, burst=10,
+               apis=20, applications=5, swagger_size=64 * 1024,
+               direct_size=16 * 1024 * 1024, entities=500, session_lifetime=300,
+               token_lifetime=3600, username='user', password='password',
+               client_id='client', client_secret='secret', key_rate=None, key_burst=10):
+    """
+    HTTP server which pretends to be both the Open Data portal and the API
+    server, so that tools can be tested and benchmarked without touching the
+    real thing.
+
+    Point ``OpenData`` at it with ``root=portal.url``, the OAuth2 token
+    endpoint at ``portal.token_url``, and the API at ``portal.api_root``.
+
+    Every response is delayed by ``latency`` seconds.  If ``rate`` is given,
+    requests over that many per second (with bursts of ``burst``) get a 429.
+
+    :param apis: Number of APIs in the catalogue.
+    :param applications: Number of applications (API keys) registered.
+    :param swagger_size: Approximate size of each Swagger document, in bytes.
+    :param direct_size: Size of each direct download (and GTFS schedule), in
+                        bytes.
+    :param entities: Number of entities in each realtime feed.
+    :param session_lifetime: Seconds until a portal session expires.
+    :param token_lifetime: Seconds until an access token expires.
+    :param key_rate: Give each API key its own quota of this many feed
+                     requests per second (with bursts of ``key_burst``),
+                     reported in ``X-RateLimit-Remaining``.  Every
+                     application's key can get tokens.
+    """
+    self.latency = latency
+    self.bucket = TokenBucket(rate, burst) if rate else None
+    self.swagger_size = swagger_size
+    self.direct_size = direct_size
+    self.entities = entities
+    self.session_lifetime = session_lifetime
+    self.token_lifetime = token_lifetime
+    self.username = username
+    self.password = password
+    self.client_id = client_id
+    self.client_secret = client_secret
+
+    self.catalogue = [dict(
+      Uuid='00000000-0000-4000-8000-%012x' % i,
+      Name='API %d' % i,
+      Description='Mock API number %d' % i,
+      SsgUrl='/v1/api%d' % i,
+    ) for i in range(apis)]
+    self.applications = [dict(
+      Uuid='10000000-0000-4000-8000-%012x' % i,
+      Name='Application %d' % i,
+      Description='Mock application number %d' % i,
+      ApiKey=client_id if i == 0 else 'key%d' % i,
+      KeySecret=client_secret if i == 0 else 'secret%d' % i,
+    ) for i in range(applications)]
+    self.keys = dict((app['ApiKey'], app['KeySecret']) for app in self.applications)
+    self.keys[client_id] = client_secret
+    self._key_buckets = dict((key, TokenBucket(key_rate, key_burst))
+                             for key in self.keys) if key_rate else None
+
+    self._block = (b'monorail mock portal data\n' * (BLOCK_SIZE // 26 + 1))[:BLOCK_SIZE]
+    self._sessions = {}
+    self._tokens = {}
+    self._feeds = {}
+    self._swagger = {}
+    self._lock = Lock()
+    self.reset_stats()
+
+    self._server = _Server((host, port), _Handler)
+    self._server.portal = self
+    self._thread = None
+    host, port = self._server.server_address[:2]
+    self.url = 'http://%s:%d/' % (host, port)
+    self.api_root = self.url + 'v1'
+    self.token_url = self.url + 'auth/oauth/v2/token?scope=user&grant_type=client_credentials'
+
+
+  def start(self):
+    """
+    Starts serving requests in a background thread.
+    """
+    self._thread = Thread(target=self._server.serve_forever, name='mock portal')
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def serve_forever(self):
+    self._server.serve_forever()
+
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+
+  def api_schema(self):
+    """
+    Gets a Swagger schema for the realtime feeds, like the one ``swaggify``
+    makes, for use with ``monorail.realtime.RealtimeClient``.
+    """
+    paths = {}
+    for kind, operation in FEED_OPERATIONS.items():
+      for mode in MODES:
+        paths['/gtfs/%s/%s' % (kind, mode)] = dict(get=dict(
+          tags=[mode], operationId=operation,
+          responses={'200': dict(description='OK', schema=dict(type='file'))}))
+
+    return dict(swagger='2.0', host=self.url.split('/')[2], basePath='/v1',
+                schemes=['http'], paths=paths)
+
+
+  def reset_stats(self):
+    with self._lock:
+      self._stats = dict(requests=0, bytes=0, connections=0, statuses={}, latencies=[])
+
+
+  def stats(self, reset=False):
+    """
+    Gets counters of what the server has done, as a dict:
+
+    ``requests``, ``bytes`` (of response bodies), ``connections`` (opened),
+    ``statuses`` (status code -> count), and ``latencies`` (seconds taken to
+    serve each request, including the simulated latency).
+    """
+    with self._lock:
+      stats = self._stats
+      if reset:
+        self._stats = dict(requests=0, bytes=0, connections=0, statuses={}, latencies=[])
+      return stats
+
+
+  def _connected(self):
+    with self._lock:
+      self._stats['connections'] += 1
+
+
+  def _record(self, status, size, elapsed):
+    with self._lock:
+      stats = self._stats
+      stats['requests'] += 1
+      stats['bytes'] += size
+      stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+      stats['latencies'].append(elapsed)
+
+
+  def _send(self, handler, status, body=b'', headers=None):
+    """
+    Sends a whole response.  Returns the number of body bytes sent.
+    """
+    handler.send_response(status)
+    for k, v in (headers or {}).items():
+      handler.send_header(k, v)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    if handler.command != 'HEAD':
+      handler.wfile.write(body)
+    return len(body)
+
+
+  def _send_json(self, handler, value, headers=None):
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json'
+    return self._send(handler, 200, dumps(value).encode('utf-8'), headers)
+
+
+  def _handle(self, handler, method):
+    start = time()
+    url = urlsplit(handler.path)
+    path = url.path
+    query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+
+    if path == '/_stats':
+      # Not counted, delayed or rate limited.
+      self._send_json(handler, self.stats(query.get('reset') == '1'))
+      return
+
+    if self.latency:
+      sleep(self.latency)
+
+    status = 200
+    if self.bucket is not None and self.bucket.consume():
+      status, size = 429, self._send(handler, 429, b'Too Many Requests', {'Retry-After': '1'})
+    else:
+      try:
+        status, size = self._route(handler, method, path, query)
+      except Exception as e:
+        status, size = 500, self._send(handler, 500, str(e).encode('utf-8'))
+
+    self._record(status, size, time() - start)
+
+
+  def _route(self, handler, method, path, query):
+    """
+    Handles a request.  Returns a tuple of the status code and body size.
+    """
+    if method == 'POST' and path == '/admin/j_spring_security_check':
+      return 302, self._login(handler, query)
+    if method == 'POST' and path == '/auth/oauth/v2/token':
+      return self._token(handler)
+    if method != 'GET':
+      return 405, self._send(handler, 405)
+
+    match = FEED_PATH.match(path)
+    if match:
+      return self._feed(handler, match.group(1), match.group(2))
+
+    if path.startswith('/admin/') or path.startswith('/direct/'):
+      if not self._session_valid(handler):
+        if path == '/admin/sessionCheck':
+          return 401, self._send(handler, 401)
+        return 302, self._send(handler, 302, headers={'Location': self.url + 'app/login.html'})
+
+      if path == '/admin/sessionCheck':
+        return 200, self._send(handler, 200, b'OK', {'Set-Cookie': 'gateaugage=1; Path=/'})
+      if path == '/admin/Portal.svc/ApiCatalogs':
+        return 200, self._odata(handler, self.catalogue, query)
+      if path == '/admin/Portal.svc/Applications':
+        return 200, self._odata(handler, self.applications, query)
+
+      match = SWAGGER_PATH.match(path)
+      if match:
+        return self._swagger_doc(handler, match.group(1))
+
+      if path.startswith('/direct/'):
+        return self._direct(handler, path[len('/direct/'):])
+
+    return 404, self._send(handler, 404, b'Not Found')
+
+
+  def _cookie(self, handler, name):
+    for cookie in (handler.headers.get('Cookie') or '').split(';'):
+      k, _, v = cookie.strip().partition('=')
+      if k == name:
+        return v
+    return None
+
+
+  def _session_valid(self, handler):
+    session = self._cookie(handler, 'JSESSIONID')
+    with self._lock:
+      created = self._sessions.get(session)
+    return created is not None and time() - created < self.session_lifetime
+
+
+  def _login(self, handler, query):
+    if query.get('username') != self.username or query.get('password') != self.password:
+      return self._send(handler, 302, headers={'Location': self.url + 'app/login.html?error=true'})
+
+    session = hexlify(urandom(16)).decode('ascii')
+    with self._lock:
+      self._sessions[session] = time()
+    return self._send(handler, 302, headers={
+      'Location': self.url + 'app/dashboard.html',
+      'Set-Cookie': 'JSESSIONID=%s; Path=/' % session,
+    })
+
+
+  def _token(self, handler):
+    auth = handler.headers.get('Authorization') or ''
+    try:
+      client_id, _, client_secret = b64decode(auth[len('Basic '):]).decode('utf-8').partition(':')
+    except Exception:
+      client_id = client_secret = None
+
+    if not auth.startswith('Basic ') or self.keys.get(client_id) != client_secret:
+      return 401, self._send(handler, 401, b'Unauthorized')
+
+    token = hexlify(urandom(16)).decode('ascii')
+    with self._lock:
+      self._tokens[token] = (time() + self.token_lifetime, client_id)
+    return 200, self._send_json(handler, dict(
+      access_token=token, token_type='Bearer', expires_in=self.token_lifetime, scope='user'))
+
+
+  def _odata(self, handler, rows, query):
+    """
+    Sends a list of results like the portal's OData endpoints, honouring
+    ``$skip``, ``$top`` and ``$select``.
+    """
+    skip = int(query.get('$skip', 0))
+    top = int(query.get('$top', len(rows)))
+    results = rows[skip:skip + top]
+    if query.get('$select'):
+      fields = query['$select'].split(',')
+      results = [dict((k, row[k]) for k in fields if k in row) for row in results]
+    d = dict(results=results)
+    if query.get('$inlinecount') == 'allpages':
+      d['__count'] = str(len(rows))
+    return self._send_json(handler, dict(d=d))
+
+
+  def _swagger_doc(self, handler, uuid):
+    if uuid not in self._swagger:
+      services = [service for service in self.catalogue if service['Uuid'] == uuid]
+      if not services:
+        return 404, self._send(handler, 404, b'Not Found')
+
+      name = services[0]['SsgUrl'].strip('/').replace('/', '_')
+      paths = {}
+      doc = dict(swagger='2.0', host='api.transport.nsw.gov.au',
+                 basePath=services[0]['SsgUrl'], tags=[dict(name=name)], paths=paths)
+      size = len(dumps(doc))
+      while size < self.swagger_size or not paths:
+        path = dict(get=dict(tags=[name], operationId='%s_resource%d' % (name, len(paths)),
+          responses={'200': dict(description='OK', schema=dict(type='string'))}))
+        paths['/resource%d' % len(paths)] = path
+        size += len(dumps(path)) + 20
+      self._swagger[uuid] = dumps(doc).encode('utf-8')
+
+    return 200, self._send(handler, 200, self._swagger[uuid], {'Content-Type': 'application/json'})
+
+
+  def _direct(self, handler, filename, size=None):
+    """
+    Streams ``size`` bytes of filler, with support for conditional, Range and
+    If-Range requests.
+    """
+    size = self.direct_size if size is None else size
+    etag = '"%s-%d"' % (filename, size)
+    headers = {'ETag': etag, 'Last-Modified': DIRECT_MODIFIED, 'Accept-Ranges': 'bytes'}
+
+    if handler.headers.get('If-None-Match') == etag:
+      return 304, self._send(handler, 304, headers=headers)
+
+    start = 0
+    status = 200
+    ranges = handler.headers.get('Range') or ''
+    if handler.headers.get('If-Range') not in (None, etag, DIRECT_MODIFIED):
+      # Changed since the client started downloading it, so send all of it.
+      ranges = ''
+    if ranges.startswith('bytes=') and ranges.endswith('-'):
+      start = int(ranges[len('bytes='):-1])
+      if start >= size:
+        headers['Content-Range'] = 'bytes */%d' % size
+        return 416, self._send(handler, 416, headers=headers)
+      status = 206
+      headers['Content-Range'] = 'bytes %d-%d/%d' % (start, size - 1, size)
+
+    handler.send_response(status)
+    for k, v in headers.items():
+      handler.send_header(k, v)
+    handler.send_header('Content-Type', 'application/zip')
+    handler.send_header('Content-Length', str(size - start))
+    handler.end_headers()
+
+    block = self._block
+    pos = start
+    while pos < size:
+      offset = pos % BLOCK_SIZE
+      chunk = block[offset:offset + min(BLOCK_SIZE - offset, size - pos)]
+      handler.wfile.write(chunk)
+      pos += len(chunk)
+    return status, size - start
+
+
+  def _feed(self, handler, kind, mode):
+    auth = handler.headers.get('Authorization') or ''
+    expiry = client_id = None
+    if auth.startswith('Bearer '):
+      with self._lock:
+        expiry, client_id = self._tokens.get(auth[len('Bearer '):], (None, None))
+    if expiry is None or expiry < time():
+      return 401, self._send(handler, 401, b'Unauthorized')
+
+    headers = {'Content-Type': 'application/x-google-protobuf'}
+    if self._key_buckets is not None:
+      bucket = self._key_buckets[client_id]
+      if bucket.consume():
+        return 429, self._send(handler, 429, b'Too Many Requests',
+                               {'Retry-After': '1', 'X-RateLimit-Remaining': '0'})
+      headers['X-RateLimit-Remaining'] = str(int(bucket.available()))
+
+    if kind == 'schedule':
+      return self._direct(handler, mode + '.zip')
+
+    # Feeds change once per second, like a busy real feed.
+    now = int(time())
+    key = (kind, mode)
+    with self._lock:
+      cached = self._feeds.get(key)
+    if cached is None or cached[0] != now:
+      cached = (now, self._build_feed(kind, mode, now))
+      with self._lock:
+        self._feeds[key] = cached
+
+    return 200, self._send(handler, 200, cached[1], headers)
+
+
+  def _build_feed(self, kind, mode, now):
+    """
+    Makes a serialised FeedMessage full of made-up entities.
+    """
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = '1.0'
+    message.header.timestamp = now
+
+    count = self.entities if kind != 'alerts' else max(1, self.entities // 50)
+    for i in range(count):
+      entity = message.entity.add()
+      entity.id = '%s.%d' % (mode, i)
+      trip_id = '%s.%d' % (mode, i)
+
+      if kind == 'vehiclepos':
+        vehicle = entity.vehicle
+        vehicle.trip.trip_id = trip_id
+        vehicle.vehicle.id = 'V%d' % i
+        vehicle.position.latitude = CENTRE_LAT + ((i * 37 + now) % 1000 - 500) * 0.0002
+        vehicle.position.longitude = CENTRE_LON + ((i * 91 + now) % 1000 - 500) * 0.0002
+        vehicle.position.bearing = (i * 13) % 360
+        vehicle.timestamp = now
+      elif kind == 'realtime':
+        update = entity.trip_update
+        update.trip.trip_id = trip_id
+        for sequence in range(1, 11):
+          stu = update.stop_time_update.add()
+          stu.stop_sequence = sequence
+          stu.arrival.delay = (i + now) % 300
+      else:
+        alert = entity.alert
+        alert.informed_entity.add().route_id = 'R%d' % i
+        alert.header_text.translation.add().text = 'Mock alert %d on %s' % (i, mode)
+
+    return message.SerializeToString()
+
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument('-H', '--host',
+    default='127.0.0.1',
+    help='Address to listen on [default: %(default)s]')
+
+  parser.add_argument('-p', '--port',
+    type=int,
+    default=8080,
+    help='Port to listen on [default: %(default)s]')
+
+  parser.add_argument('-l', '--latency',
+    type=float,
+    default=0.,
+    help='Delay every response by this many seconds [default: %(default)s]')
+
+  parser.add_argument('-r', '--rate',
+    type=float,
+    help='Answer 429 to requests over this many per second [default: unlimited]')
+
+  parser.add_argument('-b', '--burst',
+    type=int,
+    default=10,
+    help='Number of requests allowed in a burst, with --rate [default: %(default)s]')
+
+  parser.add_argument('-n', '--apis',
+    type=int,
+    default=20,
+    help='Number of APIs in the catalogue [default: %(default)s]')
+
+  parser.add_argument('-S', '--swagger-size',
+    type=int,
+    default=64 * 1024,
+    help='Size of each Swagger document, in bytes [default: %(default)s]')
+
+  parser.add_argument('-D', '--direct-size',
+    type=int,
+    default=16 * 1024 * 1024,
+    help='Size of each direct download, in bytes [default: %(default)s]')
+
+  parser.add_argument('-e', '--entities',
+    type=int,
+    default=500,
+    help='Number of entities in each realtime feed [default: %(default)s]')
+
+  parser.add_argument('-k', '--key-rate',
+    type=float,
+    help='Give each API key its own quota of this many feed requests per second [default: unlimited]')
+
+  options = parser.parse_args()
+  portal = MockPortal(options.host, options.port, options.latency, options.rate,
+    options.burst, options.apis, swagger_size=options.swagger_size,
+    direct_size=options.direct_size, entities=options.entities, key_rate=options.key_rate)
+
+  print('Portal: %s (username %r, password %r)' % (portal.url, portal.username, portal.password))
+  print('API: %s (client id %r, secret %r)' % (portal.api_root, portal.client_id, portal.client_secret))
+  print('Token: %s' % portal.token_url)
+  try:
+    portal.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
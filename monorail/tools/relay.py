@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/tools/relay.py - Serves the latest snapshots in a directory over HTTP
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+from ..relay import FOLLOW_INTERVAL, Relay
+
+from argparse import ArgumentParser
+
+
+def relay(output_dir, port, host='', interval=FOLLOW_INTERVAL):
+  """
+  Serves the latest realtime snapshots written to ``output_dir`` (by
+  ``gtfs_realtime`` or ``gtfs_harvester``) over HTTP, until interrupted.
+  """
+  relay = Relay()
+  server = relay.serve(port, host)
+  print('serving %s on port %d' % (output_dir, port))
+  try:
+    relay.follow(output_dir, interval)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.shutdown()
+
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument('-o', '--output-dir',
+    required=True,
+    help='Directory the realtime tool is writing snapshots into.')
+
+  parser.add_argument('-H', '--host',
+    default='',
+    help='Address to listen on [default: all]')
+
+  parser.add_argument('-p', '--port',
+    type=int,
+    default=8081,
+    help='Port to listen on [default: %(default)s]')
+
+  parser.add_argument('-i', '--interval',
+    type=float,
+    default=FOLLOW_INTERVAL,
+    help='Seconds between checks of the manifest [default: %(default)s]')
+
+  options = parser.parse_args()
+  relay(options.output_dir, options.port, options.host, options.interval)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/tools/replay.py - Replays harvested realtime snapshots
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+from ..relay import Relay
+from ..replay import ReplayIndex
+from ..snapshot import SnapshotWriter
+
+from argparse import ArgumentParser
+from datetime import datetime
+from os import makedirs
+from os.path import exists
+from time import mktime
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+
+def parse_time(value):
+  """
+  Parses a UNIX timestamp, or a local date and time like
+  ``2016-10-10T08:30``.
+  """
+  try:
+    return int(value)
+  except ValueError:
+    pass
+
+  for fmt in TIME_FORMATS:
+    try:
+      return int(mktime(datetime.strptime(value, fmt).timetuple()))
+    except ValueError:
+      pass
+  raise ValueError('unknown time %r' % value)
+
+
+def replay(input_dir, output_dir=None, feeds=None, start=None, end=None, rate=1.,
+           relay_port=None):
+  """
+  Replays the snapshots harvested into ``input_dir`` as if they were being
+  fetched live: written into ``output_dir`` like ``gtfs_realtime`` does,
+  and/or served by a relay.
+  """
+  relay = server = None
+  if relay_port:
+    relay = Relay()
+    server = relay.serve(relay_port)
+
+  writer = None
+  if output_dir:
+    if not exists(output_dir):
+      makedirs(output_dir)
+    writer = SnapshotWriter(output_dir, relay=relay)
+
+  index = ReplayIndex(input_dir)
+  print('indexed %d snapshot(s) of %d feed(s)' % (len(index), len(index.feeds)))
+
+  count = 0
+  try:
+    for feed, timestamp, data in index.replay(feeds, start, end, rate):
+      if writer is not None:
+        writer.write(feed + '.pb', data)
+      elif relay is not None:
+        relay.publish(feed + '.pb', data, timestamp=timestamp)
+      count += 1
+      print('...%s %s' % (feed, datetime.fromtimestamp(timestamp).isoformat()))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if server is not None:
+      server.shutdown()
+  print('replayed %d snapshot(s)' % count)
+
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument('-i', '--input-dir',
+    required=True,
+    help='Directory of harvested snapshots (loose .pb files and/or an archive).')
+
+  parser.add_argument('-o', '--output-dir',
+    help='Write snapshots into this directory, like gtfs_realtime.')
+
+  parser.add_argument('-R', '--relay-port',
+    type=int,
+    help='Serve the snapshots over HTTP on this port, like gtfs_realtime -R.')
+
+  parser.add_argument('-F', '--feed',
+    action='append',
+    help='Only replay this feed (eg: sydtrains_pos).  Give more than once for several feeds [default: all]')
+
+  parser.add_argument('-s', '--start',
+    type=parse_time,
+    help='Start at this time (UNIX timestamp, or local YYYY-MM-DDTHH:MM) [default: the beginning]')
+
+  parser.add_argument('-e', '--end',
+    type=parse_time,
+    help='Stop before this time [default: the end]')
+
+  parser.add_argument('-r', '--rate',
+    type=float,
+    default=1.,
+    help='Replay this many times faster than real time, or 0 for as fast as possible [default: %(default)s]')
+
+  options = parser.parse_args()
+  if not options.output_dir and not options.relay_port:
+    parser.error('give an --output-dir and/or a --relay-port')
+
+  replay(options.input_dir, options.output_dir, options.feed, options.start,
+    options.end, options.rate, options.relay_port)
+
+if __name__ == '__main__':
+  main()
@@ -18,113 +18,270 @@
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import, print_function
-from ..opendata import OpenData
+from ..cache import file_digest
 
-from argparse import ArgumentParser, FileType
-from json import dump, load
-from os import makedirs
-from os.path import exists, join
+from argparse import ArgumentParser
+from hashlib import sha256
+from json import dump, dumps, load, loads
+from os import chmod, close, fdopen, makedirs, remove, rename, umask
+from os.path import abspath, dirname, exists, join
+import re
+from tempfile import mkstemp
 
+# Bump this when normalise_schema changes, so that cached schemas made by the
+# old version aren't used.
+CACHE_VERSION = 1
+
+# Records the inputs and cache entries of the last build of an output, in
+# the cache directory.
+BUILD_PREFIX = 'build-'
+CACHE_EXT = '.json'
+
+# Names of cache entries.  Nothing else in the cache directory is removed.
+CACHE_ENTRY = re.compile(r'^[0-9a-f]{64}\.json$')
+
+
+def normalise_schema(schema, template):
+  """
+  Rewrites the paths of one API's schema to fit into the merged schema:
+  prefixes them with the API's base path, makes responses ``file``, sets
+  content types and makes operationIds suck less.
+
+  This only depends on the schema and the template's ``host`` and
+  ``basePath``.
+
+  Returns a tuple of the schema's tags, and a dict of path -> handler.
+  """
+  assert schema['swagger'] == '2.0'
+  assert schema['host'] == template['host']
+  root_path = template['basePath']
+
+  # Strip off trailing /, and shift it across to exclude the root.
+  base_path = schema['basePath'].rstrip('/')
+  assert base_path.startswith(root_path)
+  base_path = base_path[len(root_path):]
+
+  paths = {}
+
+  # Iterate through paths
+  for path_str, handler in schema['paths'].items():
+    path_str = base_path + '/' + path_str.lstrip('/')
+
+    for method, action in handler.items():
+      for err, outf in action['responses'].items():
+        if '$ref' in outf['schema'] and outf['schema']['$ref'] == '#/definitions/Response':
+          del outf['schema']['$ref']
+          outf['schema']['type'] = 'file'
+
+      # Set correct content-types
+      description = action['description'].lower()
+
+      content_type = None
+      if 'geojson' in description:
+        content_type = 'application/vnd.geo+json'
+      elif 'developers.google.com/transit/gtfs-realtime/' in description:
+        content_type = 'application/octet-stream'
+      elif 'developers.google.com/transit/gtfs/' in description or 'www.transxchange.org.uk' in description:
+        content_type = 'application/zip'
+
+      if content_type:
+        action['produces'] = [content_type]
+
+      # Fix operationId to suck less
+      operationId = action['operationId']
+      summary = action['summary'].lower()
+
+      if 'realtime stop time update' in summary:
+        operationId = 'stopTimes'
+      elif 'realtime vehicle positions' in summary:
+        operationId = 'vehiclePositions'
+      elif 'realtime alerts' in summary:
+        operationId = 'alerts'
+      elif 'gtfs timetables' in summary:
+        operationId = 'timetables'
+      else:
+        if operationId.startswith('Trains_'):
+          operationId = 'SydneyTrains'
+        operationId = operationId.replace('sydneytrains', 'SydneyTrains')
+        operationId = operationId.replace('NSW', 'Nsw')
+        if operationId.lower().startswith('get'):
+          operationId = operationId[3:]
+
+        if len(operationId.split('_')) > 2:
+          operationId = '_'.join(operationId.split('_')[:-2])
+
+      action['operationId'] = operationId
+
+    # We've patched up the path, lets drop it in
+    paths[path_str] = handler
+
+  return schema['tags'], paths
+
+
+def merge_schemas(template, normalised):
+  """
+  Merges schemas from ``normalise_schema`` into the template, in order.
+
+  Tags which are already in the template (or an earlier schema) are skipped.
+  """
+  names = set(tag['name'] for tag in template['tags'])
+  for tags, paths in normalised:
+    for tag in tags:
+      if tag['name'] not in names:
+        names.add(tag['name'])
+        template['tags'].append(tag)
+    template['paths'].update(paths)
+  return template
+
+
+def _read(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+def _write(path, data):
+  """
+  Writes a file atomically.
+  """
+  fd, tmp = mkstemp(dir=dirname(abspath(path)), prefix='.swaggify')
+  try:
+    f = fdopen(fd, 'wb')
+  except:
+    close(fd)
+    raise
+  with f:
+    f.write(data)
+  # mkstemp makes the file only readable by us; give it the usual mode.
+  mask = umask(0)
+  umask(mask)
+  chmod(tmp, 0o666 & ~mask)
+  rename(tmp, path)
+
+
+def _digest(*parts):
+  h = sha256()
+  for part in parts:
+    h.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+    h.update(b'\x00')
+  return h.hexdigest()
+
+
+def _normalise_cached(data, digest, template, cache_dir):
+  """
+  Gets a schema from ``normalise_schema``, from the cache if it has been
+  normalised before.
+
+  Returns a tuple of the normalised schema and its cache file name.
+  """
+  name = _digest(str(CACHE_VERSION), template['host'], template['basePath'], digest) + CACHE_EXT
+  cache_path = join(cache_dir, name)
+  if exists(cache_path):
+    with open(cache_path, 'rb') as f:
+      tags, paths = load(f)
+    return (tags, paths), name
+
+  normalised = normalise_schema(loads(data.decode('utf-8')), template)
+  _write(cache_path, dumps(normalised).encode('utf-8'))
+  return normalised, name
+
+
+def swaggify(input_schemas, template_file, output, cache_dir=None):
+  """
+  Merges Swagger schemas from ``get_swagger`` into a single schema.
+
+  The output file is only replaced if it has changed.
+
+  If a ``cache_dir`` is given, each input is only normalised once, and
+  kept there (by its SHA-256) for the next build.  If none of the inputs
+  or the template have changed since the last build, nothing is done.
+  Entries which the last build of the same output used, but this one
+  doesn't, are removed.  Builds of other outputs may share the directory,
+  but entries they share with this build may be removed (and made again
+  the next time they are needed).
+
+  Returns True if the output file was written.
+
+  :param input_schemas: Paths to the schemas to merge, in order.
+  :param template_file: Path to the template schema.
+  :param output: Path to write the merged schema to.
+  :param cache_dir: Directory to cache normalised schemas in.
+  """
+  template_data = _read(template_file)
+  inputs = [_read(path) for path in input_schemas]
+  digests = [sha256(data).hexdigest() for data in inputs]
+  build = _digest(str(CACHE_VERSION), sha256(template_data).hexdigest(), *digests)
+
+  build_path = None
+  last = dict(entries=[])
+  if cache_dir is not None:
+    if not exists(cache_dir):
+      makedirs(cache_dir)
+    build_path = join(cache_dir, BUILD_PREFIX + _digest(abspath(output))[:16] + CACHE_EXT)
+    if exists(build_path):
+      with open(build_path, 'rb') as f:
+        last = load(f)
+      if exists(output) and last['build'] == build and last['output'] == file_digest(output):
+        return False
 
-def swaggify(input_schemas, template_file, output):
   # Load the template file first
-  template = load(template_file)
+  template = loads(template_data.decode('utf-8'))
   assert template['swagger'] == '2.0'
-  root_path = template['basePath']
-  
+
   # Now start processing the individual schemas
-  for schema in input_schemas:
-    schema = load(schema)
-    assert schema['swagger'] == '2.0'
-    assert schema['host'] == template['host']
-    
-    # Strip off trailing /, and shift it across to exclude the root.
-    base_path = schema['basePath'].rstrip('/')
-    assert base_path.startswith(root_path)
-    base_path = base_path[len(root_path):]
-    
-    # Figure out the default content type
-    content_type = None
-    for tag in schema['tags']:
-      if tag['name'] not in (x['name'] for x in template['tags']):
-        template['tags'].append(tag)
+  if cache_dir is None:
+    normalised = [normalise_schema(loads(data.decode('utf-8')), template) for data in inputs]
+  else:
+    normalised = []
+    used = []
+    for data, digest in zip(inputs, digests):
+      schema, name = _normalise_cached(data, digest, template, cache_dir)
+      normalised.append(schema)
+      used.append(name)
+
+    # Forget schemas which the last build used, but are no longer inputs.
+    for name in set(last['entries']) - set(used):
+      if CACHE_ENTRY.match(name) and exists(join(cache_dir, name)):
+        remove(join(cache_dir, name))
+
+  # Keys are sorted, so the same inputs always give the same bytes.
+  data = dumps(merge_schemas(template, normalised), indent=2, sort_keys=True)
+  data = data if isinstance(data, bytes) else data.encode('utf-8')
+
+  written = not exists(output) or _read(output) != data
+  if written:
+    _write(output, data)
+
+  if build_path is not None:
+    fd, tmp = mkstemp(dir=cache_dir, prefix='.build')
+    with fdopen(fd, 'w') as f:
+      dump(dict(build=build, output=sha256(data).hexdigest(), entries=used), f)
+    rename(tmp, build_path)
+  return written
 
-    # Iterate through paths
-    for path_str, handler in schema['paths'].iteritems():
-      path_str = base_path + '/' + path_str.lstrip('/')
-
-      for method, action in handler.iteritems():
-        for err, outf in action['responses'].iteritems():
-          if '$ref' in outf['schema'] and outf['schema']['$ref'] == '#/definitions/Response':
-            del outf['schema']['$ref']
-            outf['schema']['type'] = 'file'
-
-        # Set correct content-types
-        description = action['description'].lower()
-
-        content_type = None
-        if 'geojson' in description:
-          content_type = 'application/vnd.geo+json'
-        elif 'developers.google.com/transit/gtfs-realtime/' in description:
-          content_type = 'application/octet-stream'
-        elif 'developers.google.com/transit/gtfs/' in description or 'www.transxchange.org.uk' in description:
-          content_type = 'application/zip'
-
-        if content_type:
-          action['produces'] = [content_type]
-
-        # Fix operationId to suck less
-        operationId = action['operationId']
-        summary = action['summary'].lower()
-        
-        if 'realtime stop time update' in summary:
-          operationId = 'stopTimes'
-        elif 'realtime vehicle positions' in summary:
-          operationId = 'vehiclePositions'
-        elif 'realtime alerts' in summary:
-          operationId = 'alerts'
-        elif 'gtfs timetables' in summary:
-          operationId = 'timetables'
-        else:
-          if operationId.startswith('Trains_'):
-            operationId = 'SydneyTrains'
-          operationId = operationId.replace('sydneytrains', 'SydneyTrains')
-          operationId = operationId.replace('NSW', 'Nsw')
-          if operationId.lower().startswith('get'):
-          	 operationId = operationId[3:]
-          
-          if len(operationId.split('_')) > 2:
-            operationId = '_'.join(operationId.split('_')[:-2])
-        
-        action['operationId'] = operationId
-    
-      # We've patched up the path, lets drop it in
-      template['paths'][path_str] = handler
-
-  # We've done all the files, now write it out.
-  dump(template, output, indent=2)
 
 def main():
   parser = ArgumentParser()
 
   parser.add_argument('-o', '--output',
     required=True,
-    type=FileType('wb'),
-    help='File to output schema into.  Will overwrite file.')
+    help='File to output schema into.  Will overwrite file if it has changed.')
 
   parser.add_argument('input_schemas',
     nargs='+',
-    type=FileType('rb'),
     help='Input schema files')
 
   parser.add_argument('-t', '--template-file',
     required=True,
-    type=FileType('rb'),
     help='Template schema to use as the base')
 
+  parser.add_argument('-C', '--cache-dir',
+    help='Cache normalised schemas in this directory, and only process inputs which have changed since the last run.')
+
   options = parser.parse_args()
-  swaggify(options.input_schemas, options.template_file, options.output)
+  if swaggify(options.input_schemas, options.template_file, options.output, options.cache_dir):
+    print('Wrote %s' % options.output)
+  else:
+    print('%s is up to date' % options.output)
 
 if __name__ == '__main__':
   main()
-
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/txc.py - Streaming reader for TransXChange timetables
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .gtfs import parse_time
+from collections import namedtuple
+from multiprocessing import Pool, cpu_count
+import re
+from threading import Semaphore
+from zipfile import ZipFile
+
+try:
+  from xml.etree.cElementTree import iterparse
+except ImportError:
+  from xml.etree.ElementTree import iterparse
+
+# Members of a TransXChange zip which are parsed.
+XML_EXT = '.xml'
+
+# Members each worker process may have parsed but not yet handed back, which
+# bounds how many records are held at once.
+WINDOW = 2
+
+# Records.  Times are seconds (past midnight for departure times), and -1 if
+# missing.  Positions are NaN if missing.
+Stop = namedtuple('Stop', 'stop_id name lat lon')
+Route = namedtuple('Route', 'route_id private_code description sections')
+# The stops of a section in order, the run time from each stop to the next
+# (one fewer than the stops), and the wait time at each stop.
+JourneyPatternSection = namedtuple('JourneyPatternSection', 'section_id stops run_times wait_times')
+JourneyPattern = namedtuple('JourneyPattern', 'journey_pattern_id service_code route_ref direction sections')
+Service = namedtuple('Service', 'service_code lines operator_ref mode description start_date end_date')
+VehicleJourney = namedtuple('VehicleJourney', 'vehicle_journey_code service_ref line_ref journey_pattern_ref operator_ref departure_time private_code')
+
+# xs:duration, as used for run and wait times (eg: PT2M30S).
+DURATION = re.compile(r'^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d*)?)S)?)?$')
+
+
+def parse_duration(value):
+  """
+  Parses an xs:duration (days, hours, minutes and seconds only) into
+  seconds, or -1 if it is blank or can't be parsed.
+  """
+  match = DURATION.match((value or '').strip())
+  if match is None:
+    return -1
+  days, hours, minutes, seconds = match.groups()
+  return (int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 +
+          int(float(seconds or 0)))
+
+
+def _text(elem, ns, path, default=None):
+  """
+  Gets the stripped text of an element by path (eg: ``Descriptor/CommonName``)
+  in the document's namespace.
+  """
+  value = elem.findtext('/'.join(ns + step for step in path.split('/')))
+  return value.strip() if value is not None else default
+
+
+def _texts(elem, ns, path):
+  """
+  Gets the stripped text of every element on a path, as a tuple.
+  """
+  return tuple((e.text or '').strip()
+               for e in elem.findall('/'.join(ns + step for step in path.split('/'))))
+
+
+def _descendant_text(elem, ns, tag):
+  """
+  Gets the text of the first element with a tag anywhere inside ``elem``.
+  """
+  for e in elem.iter(ns + tag):
+    return (e.text or '').strip()
+  return None
+
+
+def _float(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return float('nan')
+
+
+def _children(elem, ns):
+  """
+  Gets the stripped text of each child of an element, by tag (without the
+  namespace).  This is quicker than finding the children one at a time.
+  """
+  skip = len(ns)
+  return dict((child.tag[skip:], (child.text or '').strip()) for child in elem)
+
+
+def _stop(elem, ns, context):
+  # StopPoint has an AtcoCode; AnnotatedStopPointRef has a StopPointRef.
+  return Stop(
+    _text(elem, ns, 'AtcoCode') or _text(elem, ns, 'StopPointRef'),
+    _descendant_text(elem, ns, 'CommonName'),
+    _float(_descendant_text(elem, ns, 'Latitude')),
+    _float(_descendant_text(elem, ns, 'Longitude')))
+
+
+def _route(elem, ns, context):
+  children = _children(elem, ns)
+  return Route(
+    elem.get('id'),
+    children.get('PrivateCode'),
+    children.get('Description'),
+    _texts(elem, ns, 'RouteSectionRef'))
+
+
+def _journey_pattern_section(elem, ns, context):
+  stops = []
+  run_times = []
+  wait_times = []
+  for link in elem.iterfind(ns + 'JourneyPatternTimingLink'):
+    wait = max(parse_duration(_text(link, ns, 'From/WaitTime')), 0)
+    if stops:
+      wait_times[-1] += wait
+    else:
+      stops.append(_text(link, ns, 'From/StopPointRef'))
+      wait_times.append(wait)
+    run_times.append(parse_duration(_text(link, ns, 'RunTime')))
+    stops.append(_text(link, ns, 'To/StopPointRef'))
+    wait_times.append(max(parse_duration(_text(link, ns, 'To/WaitTime')), 0))
+
+  return JourneyPatternSection(elem.get('id'), tuple(stops), tuple(run_times), tuple(wait_times))
+
+
+def _service_code(elem, ns, context):
+  # Comes before the service's journey patterns.
+  context['service_code'] = (elem.text or '').strip()
+
+
+def _journey_pattern(elem, ns, context):
+  children = _children(elem, ns)
+  return JourneyPattern(
+    elem.get('id'),
+    context.get('service_code'),
+    children.get('RouteRef'),
+    children.get('Direction'),
+    _texts(elem, ns, 'JourneyPatternSectionRefs'))
+
+
+def _service(elem, ns, context):
+  return Service(
+    context.pop('service_code', None),
+    _texts(elem, ns, 'Lines/Line/LineName'),
+    _text(elem, ns, 'RegisteredOperatorRef'),
+    _text(elem, ns, 'Mode'),
+    _text(elem, ns, 'Description'),
+    _text(elem, ns, 'OperatingPeriod/StartDate'),
+    _text(elem, ns, 'OperatingPeriod/EndDate'))
+
+
+def _vehicle_journey(elem, ns, context):
+  children = _children(elem, ns)
+  return VehicleJourney(
+    children.get('VehicleJourneyCode'),
+    children.get('ServiceRef'),
+    children.get('LineRef'),
+    children.get('JourneyPatternRef'),
+    children.get('OperatorRef'),
+    parse_time(children.get('DepartureTime', '')),
+    children.get('PrivateCode'))
+
+
+# Elements which are made into records: (parent, element, parser).  Parsers
+# return None for elements which only change the context.
+PARSERS = (
+  ('StopPoints', 'StopPoint', _stop),
+  ('StopPoints', 'AnnotatedStopPointRef', _stop),
+  ('Routes', 'Route', _route),
+  ('JourneyPatternSections', 'JourneyPatternSection', _journey_pattern_section),
+  ('Service', 'ServiceCode', _service_code),
+  ('StandardService', 'JourneyPattern', _journey_pattern),
+  ('Services', 'Service', _service),
+  ('VehicleJourneys', 'VehicleJourney', _vehicle_journey),
+)
+
+
+def iter_txc(f):
+  """
+  Parses a TransXChange document incrementally, yielding a record for each
+  stop (``Stop``), route (``Route``), journey pattern section
+  (``JourneyPatternSection``), journey pattern (``JourneyPattern``), service
+  (``Service``) and vehicle journey (``VehicleJourney``), in document order.
+
+  Each element is thrown away once its record has been made, so memory use
+  doesn't depend on the size of the document.  Journey patterns come before
+  the service they are in.
+
+  :param f: File-like object (or path) to read the XML from.
+  """
+  # Ancestors of the element being parsed.
+  stack = []
+  ns = ''
+  parsers = None
+  context = {}
+
+  for event, elem in iterparse(f, events=('start', 'end')):
+    if event == 'start':
+      if parsers is None:
+        if elem.tag.startswith('{'):
+          ns = elem.tag[:elem.tag.index('}') + 1]
+        parsers = dict((ns + tag, (ns + parent, parser)) for parent, tag, parser in PARSERS)
+      stack.append(elem)
+      continue
+
+    stack.pop()
+    if not stack:
+      break
+    parent = stack[-1]
+    parser = parsers.get(elem.tag)
+    record = None
+
+    if parser is not None and parser[0] == parent.tag:
+      record = parser[1](elem, ns, context)
+    elif len(stack) > 2:
+      # Part of a record (or something else inside a section), which goes
+      # when that does.
+      continue
+
+    parent.remove(elem)
+    if record is not None:
+      yield record
+
+
+def _members(zf):
+  return [info.filename for info in zf.infolist()
+          if info.filename.lower().endswith(XML_EXT)]
+
+
+def _parse_member(task):
+  """
+  Parses one member of a zip.  This runs in the worker processes.
+  """
+  path, member = task
+  with ZipFile(path) as zf:
+    with zf.open(member) as f:
+      return member, list(iter_txc(f))
+
+
+def iter_zip(path, members=None, processes=1):
+  """
+  Parses the TransXChange documents in a zip (eg: from
+  ``OpenData.direct_txc``), without extracting them.
+
+  Yields tuples of the member name and a record from ``iter_txc``.
+
+  With more than one process, members are parsed in parallel, and each
+  member's records are yielded together as soon as it has been parsed (so
+  members may be out of order).  Only a few members' records are held at
+  once, however many members there are.
+
+  :param path: Path to the zip file.
+  :param members: Names of members to parse.  By default, every ``.xml``
+                  file.
+  :param processes: Number of processes to parse in, or None for one per
+                    CPU.
+  """
+  if members is None:
+    with ZipFile(path) as zf:
+      members = _members(zf)
+
+  if processes == 1:
+    with ZipFile(path) as zf:
+      for member in members:
+        with zf.open(member) as f:
+          for record in iter_txc(f):
+            yield member, record
+    return
+
+  processes = processes or cpu_count()
+  pool = Pool(processes)
+  # Stops members being handed out faster than we can take their records.
+  window = Semaphore(WINDOW * processes)
+
+  def tasks():
+    for member in members:
+      window.acquire()
+      yield path, member
+
+  try:
+    for member, records in pool.imap_unordered(_parse_member, tasks()):
+      window.release()
+      for record in records:
+        yield member, record
+    pool.close()
+  finally:
+    # Let the task feeder finish, so the pool can shut down.
+    for member in members:
+      window.release()
+    pool.terminate()
+    pool.join()
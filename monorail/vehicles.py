@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- mode: python; indent-tabs-mode: nil; tab-width: 2 -*-
+#
+# monorail/vehicles.py - Decodes GTFS-realtime vehicle positions into arrays
+# Copyright 2016 Michael Farrell <micolous+git@gmail.com>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from .strings import NO_CODE, StringTable
+from google.transit import gtfs_realtime_pb2
+import numpy as np
+
+
+class VehicleTable(object):
+  # Columns, and their types.
+  COLUMNS = (
+    ('snapshot', np.int32),
+    ('feed_timestamp', np.int64),
+    ('vehicle_id', np.int32),
+    ('trip_id', np.int32),
+    ('route_id', np.int32),
+    ('lat', np.float64),
+    ('lon', np.float64),
+    ('bearing', np.float32),
+    ('speed', np.float32),
+    ('timestamp', np.int64),
+  )
+
+  def __init__(self, columns, vehicle_ids, trip_ids, route_ids):
+    """
+    Vehicle positions stored as a set of NumPy arrays, one per column.
+
+    String columns (``vehicle_id``, ``trip_id``, ``route_id``) are stored as
+    codes into a ``StringTable``.  Missing strings are ``NO_CODE``, missing
+    floats are NaN and missing timestamps are 0.
+
+    ``snapshot`` is the index of the snapshot that the row came from, and
+    ``feed_timestamp`` is that snapshot's ``FeedHeader.timestamp``.
+    """
+    for name, dtype in self.COLUMNS:
+      setattr(self, name, columns[name])
+    self.vehicle_ids = vehicle_ids
+    self.trip_ids = trip_ids
+    self.route_ids = route_ids
+
+
+  def __len__(self):
+    return len(self.lat)
+
+
+  def columns(self):
+    """
+    Gets a dict of column name -> array.
+    """
+    return dict((name, getattr(self, name)) for name, dtype in self.COLUMNS)
+
+
+  def select(self, rows):
+    """
+    Gets a new table with only some rows, given as a boolean mask or an array
+    of indexes.  The string tables are shared with this table.
+    """
+    return VehicleTable(
+      dict((name, column[rows]) for name, column in self.columns().items()),
+      self.vehicle_ids, self.trip_ids, self.route_ids)
+
+
+  def within(self, min_lat, min_lon, max_lat, max_lon):
+    """
+    Gets the vehicles inside a bounding box.  Vehicles without a position are
+    never included.
+    """
+    with np.errstate(invalid='ignore'):
+      return self.select((self.lat >= min_lat) & (self.lat <= max_lat) &
+                         (self.lon >= min_lon) & (self.lon <= max_lon))
+
+
+def _decode_into(message, snapshot, rows, vehicle_ids, trip_ids, route_ids):
+  """
+  Appends the vehicle positions in a FeedMessage to ``rows``, a dict of column
+  name -> list.
+  """
+  feed_timestamp = message.header.timestamp
+  nan = float('nan')
+
+  for entity in message.entity:
+    if not entity.HasField('vehicle'):
+      continue
+
+    vehicle = entity.vehicle
+    position = vehicle.position
+    has_position = vehicle.HasField('position')
+    trip = vehicle.trip
+
+    rows['snapshot'].append(snapshot)
+    rows['feed_timestamp'].append(feed_timestamp)
+    rows['vehicle_id'].append(
+      vehicle_ids.code(vehicle.vehicle.id) if vehicle.vehicle.id else NO_CODE)
+    rows['trip_id'].append(trip_ids.code(trip.trip_id) if trip.trip_id else NO_CODE)
+    rows['route_id'].append(route_ids.code(trip.route_id) if trip.route_id else NO_CODE)
+    rows['lat'].append(position.latitude if has_position else nan)
+    rows['lon'].append(position.longitude if has_position else nan)
+    rows['bearing'].append(position.bearing if position.HasField('bearing') else nan)
+    rows['speed'].append(position.speed if position.HasField('speed') else nan)
+    rows['timestamp'].append(vehicle.timestamp)
+
+
+def decode_vehicle_positions(snapshots, vehicle_ids=None, trip_ids=None, route_ids=None):
+  """
+  Decodes one or more VehiclePositions feeds into a single ``VehicleTable``.
+
+  :param snapshots: A serialised FeedMessage (bytes) or a parsed
+                    ``FeedMessage``, or a list of either.
+  :param vehicle_ids: ``StringTable`` to intern vehicle IDs into.  Pass the
+                      same tables in across calls to get consistent codes.
+  :param trip_ids: ``StringTable`` to intern trip IDs into.
+  :param route_ids: ``StringTable`` to intern route IDs into.
+  """
+  if isinstance(snapshots, (bytes, gtfs_realtime_pb2.FeedMessage)):
+    snapshots = [snapshots]
+
+  vehicle_ids = StringTable() if vehicle_ids is None else vehicle_ids
+  trip_ids = StringTable() if trip_ids is None else trip_ids
+  route_ids = StringTable() if route_ids is None else route_ids
+  rows = dict((name, []) for name, dtype in VehicleTable.COLUMNS)
+
+  for snapshot, message in enumerate(snapshots):
+    if not isinstance(message, gtfs_realtime_pb2.FeedMessage):
+      data = message
+      message = gtfs_realtime_pb2.FeedMessage()
+      message.ParseFromString(data)
+
+    _decode_into(message, snapshot, rows, vehicle_ids, trip_ids, route_ids)
+
+  columns = dict((name, np.array(rows[name], dtype=dtype))
+                 for name, dtype in VehicleTable.COLUMNS)
+  return VehicleTable(columns, vehicle_ids, trip_ids, route_ids)
+
+
+def load_vehicle_positions(*paths):
+  """
+  Decodes ``*_pos.pb`` files written by ``gtfs_realtime`` into a single
+  ``VehicleTable``.
+  """
+  def read(path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  return decode_vehicle_positions(read(path) for path in paths)